@@ -1,18 +1,86 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, stream_template, request, jsonify, session, redirect, url_for
 import os
 import json
+import uuid
+from datetime import datetime
+from itertools import islice
 from dotenv import load_dotenv
 import merchant_api
+import near_duplicates
 import analyzer
+import csrf
+import incremental
+import issue_index
+import snapshots
+import jobs
+import fanout
+import feed_files
+import fixes
+import identifiers
+import images
+import scheduler
+import storage
+import tracing
+from session_file import create_session_interface
+import supplemental_feed
+from supplemental_feed import feeds_bp
 
 load_dotenv()  # Загружаем переменные окружения из .env файла
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
+
+# Сессии хранятся на сервере, в cookie только идентификатор сессии
+app.config['SESSION_TYPE'] = os.environ.get('SESSION_TYPE', 'sqlite')
+# Cookie сессии не отправляется с POST-запросами с чужих сайтов
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+app.session_interface = create_session_interface(app)
+
+# Дополнительный фид для Merchant Center: /feeds/<merchant_id>/supplemental.tsv?token=...
+app.register_blueprint(feeds_bp, url_prefix='/feeds')
+
+# Трассировка запросов (JSON-строки в stderr) и метрики Prometheus на /metrics
+tracing.init_app(app)
+
+# Токен CSRF для форм, которые меняют данные (csrf_token() в шаблонах)
+csrf.init_app(app)
 
 # Путь к файлу сервисного аккаунта
 SERVICE_ACCOUNT_FILE = 'service-account-key.json'  # Замените на путь к вашему ключу
 
+# Размер страницы таблицы товаров в JSON API
+PRODUCTS_PER_PAGE = 50
+MAX_PRODUCTS_PER_PAGE = 200
+
+# Строк гистограммы проблем на странице анализа
+ISSUE_HISTOGRAM_ROWS = 30
+
+# Результаты анализа, сохраненные по отпечаткам содержимого товаров
+analysis_store = incremental.AnalysisStore()
+
+# Локальный кэш данных каталога, общий для всех воркеров gunicorn
+snapshot_cache = snapshots.SnapshotCache()
+
+# Анализ выполняется в фоновых задачах, а не в потоке запроса
+job_store = jobs.JobStore()
+job_runner = jobs.JobRunner(job_store)
+
+# Массовые исправления - отдельные задачи, чтобы не ждать завершения анализа
+fix_job_store = jobs.JobStore(storage.data_path('fix_jobs.sqlite'))
+fix_job_runner = jobs.JobRunner(fix_job_store)
+
+# Дополнительный фид с исправлениями, который регистрируется в Merchant Center
+SUPPLEMENTAL_FEED_NAME = 'Feed Optimizer'
+FEED_NOT_CONFIGURED = "Дополнительный фид недоступен: не задана переменная окружения FEED_TOKEN_SECRET."
+
+# Проверять ли изображения товаров при анализе (запросы к серверам изображений магазина).
+# По умолчанию выключено: анализ не должен ждать чужих серверов; отдельная проверка каталога - на /images
+IMAGE_CHECKS = os.environ.get('IMAGE_CHECKS', '0') == '1'
+
+def content_client():
+    """Клиент Content API для текущего потока (кэш обновляется в фоновых потоках)."""
+    return merchant_api.create_content_api_client(SERVICE_ACCOUNT_FILE)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -44,6 +112,121 @@ def connect():
     
     return render_template('connect.html')
 
+def run_analysis(merchant_id, refresh, progress):
+    """Загружает данные аккаунта и анализирует их; выполняется в фоновой задаче.
+    
+    Независимые запросы к API выполняются параллельно, каждый в своем потоке
+    со своим клиентом. Если запрос упал или не уложился в таймаут, анализ
+    строится по остальным данным, а проблема попадает в предупреждения.
+    """
+    # Размер каталога по прошлому анализу нужен для оценки оставшегося времени
+    progress.expect(analysis_store.products_count(merchant_id))
+    
+    def account_info():
+        return snapshot_cache.get(
+            merchant_id, 'account_info',
+            lambda: merchant_api.get_account_info(content_client(), merchant_id),
+            refresh=refresh
+        )
+    
+    def datafeeds():
+        return snapshot_cache.get(
+            merchant_id, 'datafeeds',
+            lambda: merchant_api.get_datafeeds(content_client(), merchant_id),
+            refresh=refresh
+        ) or []
+    
+    # Загруженные страницы учитываются в прогрессе задачи; фоновое обновление кэша их не сообщает
+    def page_fetched(page):
+        progress.page_fetched()
+    
+    def product_statuses():
+        return snapshot_cache.iter(
+            merchant_id, 'product_statuses',
+            lambda on_page: merchant_api.iter_product_statuses(content_client(), merchant_id, on_page=on_page),
+            refresh=refresh, on_page=page_fetched
+        )
+    
+    def products():
+        return snapshot_cache.iter(
+            merchant_id, 'products',
+            lambda on_page: merchant_api.iter_products(content_client(), merchant_id, on_page=on_page),
+            refresh=refresh, on_page=page_fetched
+        )
+    
+    def catalog():
+        # Статусы читаем потоком по всему каталогу; счетчики обновляются только по изменившимся товарам.
+        # Заодно статусы складываются в компактный индекс, по которому анализируются товары
+        status_index = analyzer.ProductStatusIndex()
+        
+        def indexed_statuses():
+            for status in product_statuses():
+                status_index.add(status)
+                yield status
+        
+        counts = analysis_store.update_account_stats(merchant_id, indexed_statuses())
+        
+        # Затем товары: пересчитываются только изменившиеся с прошлого анализа. В том же проходе строятся
+        # счетчики по кодам проблем (Merchant Center и собственных проверок) и индекс "проблема -> товары"
+        histogram = issue_index.IssueHistogram()
+        # Одинаковые GTIN или бренд+MPN и почти одинаковые названия и описания у разных предложений
+        # ищутся по всему каталогу
+        identifier_index = identifiers.IdentifierIndex()
+        near_duplicate_index = near_duplicates.NearDuplicateIndex()
+        
+        def analyses():
+            remaining = iter(products())
+            while True:
+                chunk = list(islice(remaining, incremental.CHUNK_SIZE))
+                if not chunk:
+                    return
+                results = analysis_store.analyze_products(chunk, status_index)
+                for product in chunk:
+                    identifier_index.add(product)
+                near_duplicate_index.add_batch(chunk)
+                if IMAGE_CHECKS:
+                    # Битые, слишком маленькие и не те по формату изображения; результаты проверок кэшируются
+                    images.check_results(results, chunk)
+                for result in results:
+                    histogram.add(status_index.get(result['product_id']), result)
+                    progress.product_analyzed()
+                    yield result
+        
+        # Таблица товаров читается из индекса постранично, а не из результата задачи
+        analysis_store.index_products(merchant_id, analyses())
+        histogram.finish()
+        
+        # Дубликаты известны только в конце прохода: их проблемы добавляются к уже сохраненным товарам
+        for duplicate_index, checks in ((identifier_index, identifiers.IDENTIFIER_CHECKS),
+                                        (near_duplicate_index, near_duplicates.NEAR_DUPLICATE_CHECKS)):
+            duplicates = duplicate_index.codes_by_product()
+            analysis_store.add_product_issues(merchant_id, duplicates, checks)
+            histogram.add_check_issues(duplicates, checks)
+        analysis_store.save_issue_histogram(merchant_id, histogram)
+        return counts, histogram.products_count
+    
+    results, errors = fanout.run_concurrently(
+        {
+            'account_info': account_info,
+            'datafeeds': datafeeds,
+            'catalog': catalog
+        },
+        timeouts={'catalog': None}
+    )
+    
+    # Анализируем аккаунт
+    account = results.get('account_info')
+    account_counts, products_indexed = results.get('catalog', ((None, None, None), 0))
+    account_analysis = analyzer.build_account_analysis(account, results.get('datafeeds'), *account_counts)
+    
+    return {
+        'account': account,
+        'account_analysis': account_analysis,
+        'products_indexed': products_indexed,
+        'fetched_at': snapshot_cache.fetched_at(merchant_id, 'product_statuses'),
+        'warnings': [f"Не удалось получить {name}: {error}" for name, error in errors.items()]
+    }
+
 @app.route('/analyze')
 def analyze():
     merchant_id = session.get('merchant_id')
@@ -51,48 +234,410 @@ def analyze():
     if not merchant_id:
         return redirect(url_for('connect'))
     
-    try:
-        # Создаем клиент API
-        client = merchant_api.create_content_api_client(SERVICE_ACCOUNT_FILE)
-        
-        # Получаем данные аккаунта
-        account_info = merchant_api.get_account_info(client, merchant_id)
-        datafeeds = merchant_api.get_datafeeds(client, merchant_id)
-        product_statuses = merchant_api.get_product_issues(client, merchant_id, max_results=100)
-        
-        # Анализируем аккаунт
-        account_analysis = analyzer.analyze_account(account_info, datafeeds, product_statuses)
-        
-        # Получаем несколько товаров для примера
-        products = merchant_api.get_products(client, merchant_id, max_results=10)
-        
-        # Анализируем товары
-        product_analyses = []
-        for product in products:
-            # Находим статус для этого товара
-            product_status = next((s for s in product_statuses if s.get('productId') == product.get('id')), None)
-            product_analysis = analyzer.analyze_product(product, product_status)
-            product_analyses.append(product_analysis)
-        
-        return render_template(
-            'analyze.html',
-            account=account_info,
-            account_analysis=account_analysis,
-            product_analyses=product_analyses
-        )
-        
-    except Exception as e:
-        error_message = f"Ошибка при анализе: {str(e)}"
+    job_id = request.args.get('job')
+    if not job_id:
+        # Кнопка "Обновить сейчас" игнорирует кэш и загружает данные заново
+        refresh = request.args.get('refresh') == '1'
+        job_id = job_runner.submit(merchant_id, lambda progress: run_analysis(merchant_id, refresh, progress))
+        # Результат хранится на сервере; в сессии только ссылка на задачу, ее переиспользует /optimize
+        session['analysis_job'] = job_id
+        return redirect(url_for('analyze', job=job_id))
+    
+    job = job_store.get(job_id)
+    if not job or job['merchant_id'] != merchant_id:
+        return redirect(url_for('analyze'))
+    
+    if job['state'] == 'failed':
+        error_message = f"Ошибка при анализе: {job['error']}"
         return render_template('analyze.html', error=error_message)
+    
+    if job['state'] != 'done':
+        # Страница опрашивает статус задачи и перезагружается, когда анализ готов
+        return render_template('analyze.html', job_id=job_id)
+    
+    result = job['result']
+    fetched_at = result['fetched_at']
+    
+    return render_template(
+        'analyze.html',
+        account=result['account'],
+        account_analysis=result['account_analysis'],
+        products_url=url_for('product_analyses'),
+        issue_codes=analysis_store.issue_codes(merchant_id),
+        issue_histogram=analysis_store.issue_histogram(merchant_id)[:ISSUE_HISTOGRAM_ROWS],
+        issue_products_url=url_for('issue_products'),
+        warnings=result.get('warnings', []),
+        fetched_at=fetched_at and datetime.fromtimestamp(fetched_at)
+    )
+
+def job_status(store, job_id):
+    """Прогресс фоновой задачи в JSON."""
+    job = store.get(job_id)
+    if not job or job['merchant_id'] != session.get('merchant_id'):
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    return jsonify({
+        'state': job['state'],
+        'pages_fetched': job['pages_fetched'],
+        'products_analyzed': job['products_analyzed'],
+        'products_expected': job['products_expected'],
+        'eta_seconds': job['eta'],
+        'error': job['error']
+    })
+
+@app.route('/analyze/status/<job_id>')
+def analyze_status(job_id):
+    """Прогресс фоновой задачи анализа в JSON."""
+    return job_status(job_store, job_id)
+
+def product_filters():
+    """Фильтры и сортировка таблицы товаров из параметров запроса; None, если они некорректны."""
+    status = request.args.get('status') or None
+    sort = request.args.get('sort') or incremental.DEFAULT_PRODUCT_SORT
+    if status not in (None, 'good', 'warning', 'critical') or sort not in incremental.PRODUCT_SORTS:
+        return None
+    return {'status': status, 'code': request.args.get('code') or None, 'sort': sort}
+
+@app.route('/api/products')
+def product_analyses():
+    """Страница результатов анализа товаров в JSON с фильтрами по статусу и коду проблемы."""
+    merchant_id = session.get('merchant_id')
+    if not merchant_id:
+        return jsonify({'error': 'Аккаунт не выбран'}), 401
+    
+    filters = product_filters()
+    if filters is None:
+        return jsonify({'error': 'Некорректный фильтр или сортировка'}), 400
+    
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(MAX_PRODUCTS_PER_PAGE, max(1, request.args.get('per_page', PRODUCTS_PER_PAGE, type=int)))
+    total, items = analysis_store.page_products(merchant_id, offset=(page - 1) * per_page, limit=per_page, **filters)
+    
+    return jsonify({
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+        'items': items
+    })
+
+@app.route('/api/issues/products')
+def issue_products():
+    """Товары с заданной проблемой (и, если указано, в заданном направлении) по индексу последнего полного прохода."""
+    merchant_id = session.get('merchant_id')
+    if not merchant_id:
+        return jsonify({'error': 'Аккаунт не выбран'}), 401
+    
+    code = request.args.get('code')
+    if not code:
+        return jsonify({'error': 'Не указан код проблемы'}), 400
+    
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(MAX_PRODUCTS_PER_PAGE, max(1, request.args.get('per_page', PRODUCTS_PER_PAGE, type=int)))
+    total, product_ids = analysis_store.issue_products(
+        merchant_id, code, request.args.get('destination'), offset=(page - 1) * per_page, limit=per_page
+    )
+    
+    return jsonify({
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+        'items': product_ids
+    })
 
-@app.route('/optimize')
+@app.route('/analyze/products')
+def analyze_products():
+    """Все товары по фильтру одной страницей; HTML отдается потоком по мере чтения из индекса."""
+    merchant_id = session.get('merchant_id')
+    if not merchant_id:
+        return redirect(url_for('connect'))
+    
+    filters = product_filters()
+    if filters is None:
+        return redirect(url_for('analyze'))
+    
+    return stream_template(
+        'products.html',
+        products=analysis_store.iter_indexed_products(merchant_id, **filters),
+        status=filters['status'],
+        code=filters['code']
+    )
+
+def run_fixes(merchant_id, fix_groups, dry_run, progress, feed=False):
+    """Проверяет все товары аккаунта и исправляет выбранные проблемы; выполняется в фоновой задаче.
+    
+    С `feed` исправления записываются в дополнительный фид аккаунта, а не отправляются в Content API.
+    """
+    progress.expect(analysis_store.products_count(merchant_id))
+    
+    # Товары читаем напрямую из API: исправления должны основываться на актуальных данных
+    products = merchant_api.iter_products(
+        content_client(), merchant_id, on_page=lambda page: progress.page_fetched(), fields=fixes.PRODUCT_FIELDS
+    )
+    report = fixes.fix_products(
+        content_client, merchant_id, products, fix_groups, dry_run=dry_run, progress=progress,
+        feed_store=supplemental_feed.get_override_store() if feed else None
+    )
+    
+    if report['updated'] and not feed:
+        # Товары изменились, кэшированные данные каталога устарели
+        snapshot_cache.invalidate(merchant_id)
+    return report
+
+@app.route('/optimize', methods=['GET', 'POST'])
 def optimize():
     merchant_id = session.get('merchant_id')
     
     if not merchant_id:
         return redirect(url_for('connect'))
     
-    return render_template('optimize.html')
+    # Последний завершенный анализ этого аккаунта, сохраненный на сервере
+    analysis = None
+    job_id = session.get('analysis_job')
+    job = job_store.get(job_id) if job_id else None
+    if job and job['state'] == 'done' and job['merchant_id'] == merchant_id:
+        analysis = job['result']
+    
+    if request.method == 'POST':
+        # Форма меняет товары в Merchant Center, поэтому принимается только со страницы приложения
+        if not csrf.form_valid():
+            return render_template('optimize.html', analysis=analysis, error="Форма устарела. Обновите страницу и отправьте ее снова."), 400
+        
+        fix_groups = [group for group in request.form.getlist('fix') if group in fixes.FIX_GROUPS]
+        if not fix_groups:
+            return render_template('optimize.html', analysis=analysis, error="Выберите хотя бы один тип ошибок.")
+        
+        # По умолчанию только показываем план изменений; товары меняются по кнопке "Исправить",
+        # а кнопка "Дополнительный фид" записывает исправления в фид, который забирает Merchant Center
+        mode = request.form.get('mode')
+        feed = mode == 'feed'
+        if feed and supplemental_feed.feed_token(merchant_id) is None:
+            return render_template('optimize.html', analysis=analysis, error=FEED_NOT_CONFIGURED)
+        dry_run = mode not in ('apply', 'feed')
+        fix_job_id, created = fix_job_runner.start(
+            merchant_id,
+            lambda progress: run_fixes(merchant_id, fix_groups, dry_run, progress, feed=feed)
+        )
+        if not created:
+            # Иначе пользователь увидел бы результат другой задачи (например, план вместо примененных исправлений)
+            return render_template(
+                'optimize.html',
+                analysis=analysis,
+                error="Предыдущая задача исправлений еще выполняется, новая не запущена. Дождитесь ее результата и отправьте форму снова.",
+                fix_job_id=fix_job_id
+            )
+        return redirect(url_for('optimize', job=fix_job_id))
+    
+    fix_job_id = request.args.get('job')
+    fix_job = fix_job_store.get(fix_job_id) if fix_job_id else None
+    if not fix_job or fix_job['merchant_id'] != merchant_id:
+        return render_template('optimize.html', analysis=analysis)
+    
+    if fix_job['state'] == 'failed':
+        error_message = f"Ошибка при исправлении: {fix_job['error']}"
+        return render_template('optimize.html', analysis=analysis, error=error_message)
+    
+    if fix_job['state'] != 'done':
+        return render_template('optimize.html', analysis=analysis, fix_job_id=fix_job_id)
+    
+    report = fix_job['result']
+    feed_url = supplemental_feed.feed_url(merchant_id) if report.get('feed') else None
+    return render_template('optimize.html', analysis=analysis, report=report, feed_url=feed_url)
+
+@app.route('/optimize/status/<job_id>')
+def optimize_status(job_id):
+    """Прогресс фоновой задачи исправлений в JSON."""
+    return job_status(fix_job_store, job_id)
+
+@app.route('/optimize/feed', methods=['POST'])
+def register_feed():
+    """Регистрирует дополнительный фид аккаунта в Merchant Center (datafeeds.insert)."""
+    merchant_id = session.get('merchant_id')
+    
+    if not merchant_id:
+        return redirect(url_for('connect'))
+    
+    if not csrf.form_valid():
+        return render_template('optimize.html', error="Форма устарела. Обновите страницу и отправьте ее снова."), 400
+    
+    feed_url = supplemental_feed.feed_url(merchant_id)
+    if feed_url is None:
+        return render_template('optimize.html', error=FEED_NOT_CONFIGURED)
+    
+    datafeed = merchant_api.create_supplemental_feed(content_client(), merchant_id, SUPPLEMENTAL_FEED_NAME, feed_url)
+    if not datafeed:
+        return render_template('optimize.html', error="Не удалось зарегистрировать фид в Merchant Center.", feed_url=feed_url)
+    return render_template('optimize.html', feed_url=feed_url, feed_registered=datafeed)
+
+# Проверки всего каталога и файлов фида; карточки для их запуска показываются на странице оптимизации
+catalog_checks = []
+
+app.jinja_env.globals['catalog_checks'] = catalog_checks
+
+def register_catalog_check(rule, endpoint, job_runner, run_check, template, card, upload=None, context=None):
+    """Регистрирует фоновую проверку: страницу `rule` и прогресс задачи в JSON на `rule`/status/<job_id>.
+    
+    POST запускает `run_check(merchant_id, progress)` в `job_runner`, GET с ?job= показывает
+    прогресс, а затем отчет в `template` (шаблон расширяет catalog_check.html). `card` - тексты
+    карточки и страницы. С `upload` проверяется загруженный файл: `run_check(path, progress)`,
+    файл удаляется после проверки.
+    """
+    check = dict(card, endpoint=endpoint, upload=upload)
+    catalog_checks.append(check)
+    
+    def render(**values):
+        return render_template(template, check=check, **(context or {}), **values)
+    
+    def page():
+        merchant_id = session.get('merchant_id')
+        
+        if not merchant_id:
+            return redirect(url_for('connect'))
+        
+        if request.method == 'POST':
+            if not csrf.form_valid():
+                return render(error="Форма устарела. Обновите страницу и отправьте ее снова."), 400
+            
+            if not upload:
+                # Повторный запуск во время проверки показывает прогресс уже запущенной
+                job_id = job_runner.submit(merchant_id, lambda progress: run_check(merchant_id, progress))
+                return redirect(url_for(endpoint, job=job_id))
+            
+            file = request.files.get(upload['field'])
+            if not file or not file.filename:
+                return render(error=upload['missing'])
+            
+            # Файл сохраняется на диск целиком и читается задачей потоком, не загружаясь в память
+            path = storage.data_path(f'upload-{uuid.uuid4().hex}')
+            file.save(path)
+            filename = file.filename
+            job_id, created = job_runner.start(
+                merchant_id,
+                lambda progress: run_upload_check(run_check, path, filename, progress)
+            )
+            if not created:
+                # Задача с другим файлом еще выполняется, а /tmp на App Engine находится в памяти
+                os.remove(path)
+                return render(error=upload['busy'], job_id=job_id)
+            return redirect(url_for(endpoint, job=job_id))
+        
+        job_id = request.args.get('job')
+        job = job_runner.store.get(job_id) if job_id else None
+        if not job or job['merchant_id'] != merchant_id:
+            return redirect(url_for('optimize'))
+        
+        if job['state'] == 'failed':
+            return render(error=f"{card['failure']}: {job['error']}")
+        
+        if job['state'] != 'done':
+            return render(job_id=job_id)
+        
+        return render(report=job['result'])
+    
+    def status(job_id):
+        return job_status(job_runner.store, job_id)
+    
+    app.add_url_rule(rule, endpoint, page, methods=['GET', 'POST'])
+    app.add_url_rule(f'{rule}/status/<job_id>', f'{endpoint}_status', status)
+
+def run_upload_check(run_check, path, filename, progress):
+    """Проверяет загруженный файл и удаляет его; выполняется в фоновой задаче."""
+    try:
+        report = run_check(path, progress)
+    finally:
+        os.remove(path)
+    report['filename'] = filename
+    return report
+
+def catalog_products(merchant_id, progress):
+    """Все товары аккаунта для проверки каталога; загруженные страницы учитываются в прогрессе."""
+    progress.expect(analysis_store.products_count(merchant_id))
+    return merchant_api.iter_products(content_client(), merchant_id, on_page=lambda page: progress.page_fetched())
+
+# Проверка ссылок на изображения по всему каталогу
+register_catalog_check(
+    '/images', 'check_images',
+    jobs.JobRunner(jobs.JobStore(storage.data_path('image_jobs.sqlite'))),
+    lambda merchant_id, progress: images.check_catalog(catalog_products(merchant_id, progress), progress=progress),
+    'images.html',
+    card={
+        'title': 'Проверка изображений',
+        'description': 'Проверяет основные и дополнительные изображения всех товаров: битые ссылки, '
+                       'неподдерживаемые форматы и изображения меньше 100×100 пикселей.',
+        'button': 'Проверить изображения',
+        'progress': 'Проверяем изображения',
+        'counter': 'Проверено товаров',
+        'failure': 'Ошибка при проверке изображений',
+    },
+    context={'image_checks': images.IMAGE_CHECKS}
+)
+
+# Проверка GTIN и повторяющихся идентификаторов по всему каталогу
+register_catalog_check(
+    '/identifiers', 'check_identifiers',
+    jobs.JobRunner(jobs.JobStore(storage.data_path('identifier_jobs.sqlite'))),
+    lambda merchant_id, progress: identifiers.check_catalog(catalog_products(merchant_id, progress), progress=progress),
+    'identifiers.html',
+    card={
+        'title': 'Проверка GTIN',
+        'description': 'Проверяет контрольные цифры GTIN всех товаров и находит GTIN и пары бренд+MPN, '
+                       'которые используются в разных предложениях.',
+        'button': 'Проверить идентификаторы',
+        'progress': 'Проверяем идентификаторы',
+        'counter': 'Проверено товаров',
+        'failure': 'Ошибка при проверке идентификаторов',
+    }
+)
+
+# Поиск почти одинаковых названий и описаний по всему каталогу
+register_catalog_check(
+    '/duplicates', 'check_duplicates',
+    jobs.JobRunner(jobs.JobStore(storage.data_path('duplicate_jobs.sqlite'))),
+    lambda merchant_id, progress: near_duplicates.check_catalog(catalog_products(merchant_id, progress), progress=progress),
+    'duplicates.html',
+    card={
+        'title': 'Поиск дубликатов',
+        'description': 'Находит группы разных предложений с почти одинаковыми названиями или описаниями. '
+                       'Варианты одного товара (общий item_group_id) дубликатами не считаются.',
+        'button': 'Найти дубликаты',
+        'progress': 'Ищем похожие товары',
+        'counter': 'Обработано товаров',
+        'failure': 'Ошибка при поиске дубликатов',
+    }
+)
+
+# Проверка файлов фида до загрузки в Merchant Center
+register_catalog_check(
+    '/feed-check', 'check_feed_file',
+    jobs.JobRunner(jobs.JobStore(storage.data_path('feed_jobs.sqlite'))),
+    lambda path, progress: feed_files.analyze_feed(path, progress=progress),
+    'feed_check.html',
+    card={
+        'title': 'Проверка файла фида',
+        'description': 'Проверяет основной фид (XML RSS/Atom или TSV, в том числе сжатый gzip) '
+                       'до загрузки в Merchant Center теми же правилами, что и анализ товаров.',
+        'button': 'Проверить файл',
+        'progress': 'Проверяем файл фида',
+        'counter': 'Проверено позиций',
+        'failure': 'Ошибка при проверке файла фида',
+    },
+    upload={
+        'field': 'feed',
+        'accept': '.xml,.rss,.atom,.tsv,.txt,.gz',
+        'missing': 'Выберите файл фида (XML или TSV).',
+        'busy': 'Проверка другого файла фида еще не закончена. Дождитесь ее результата и загрузите файл снова.',
+    }
+)
+
+@app.route('/quota')
+def quota():
+    """Счетчики использования квоты Content API для текущего аккаунта (в пределах этого воркера)."""
+    merchant_id = session.get('merchant_id')
+    if not merchant_id:
+        return jsonify({'error': 'Аккаунт не выбран'}), 401
+    
+    return jsonify({'merchant_id': merchant_id, 'methods': scheduler.stats(merchant_id)})
 
 if __name__ == '__main__':
     app.run(debug=True)
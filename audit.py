@@ -0,0 +1,316 @@
+"""Offline audit of exported catalog dumps, without the web app or API credentials.
+
+    python audit.py products.jsonl --statuses productstatuses.jsonl --output results.jsonl
+    python audit.py products.jsonl.gz --statuses statuses.jsonl.gz --output results.jsonl --workers 8 --resume
+
+Dumps hold one Content API resource per line (products or productstatuses);
+.gz files are decompressed on the fly. The dumps are split into shards by
+product ID, so a product and its status land in the same shard, and a pool of
+processes analyzes one shard at a time with analyzer.analyze_product. Results
+stream into one JSONL part per shard; once every shard is done the parts are
+joined into --output and an account summary (analyzer.build_account_analysis)
+is written next to it. Work files live in <output>.work until then, and
+--resume reuses the finished shards of an interrupted run over the same dumps.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import analyzer
+
+# A worker holds the statuses of one shard in memory as compact records, about 400 bytes each
+DEFAULT_SHARDS = 64
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+MANIFEST = 'manifest.json'
+
+# Products and statuses of each dump, and the attribute holding the product ID
+DUMP_KEYS = {'products': 'id', 'statuses': 'productId'}
+
+
+def shard_of(product_id, shards):
+    """Shard of a product ID; products and their statuses land in the same shard."""
+    return zlib.crc32(product_id.encode('utf-8')) % shards
+
+
+def split_ranges(path, parts):
+    """Splits a dump into byte ranges that can be read in parallel; a .gz dump is a single range."""
+    if path.endswith('.gz'):
+        return [(0, None)]
+    size = os.path.getsize(path)
+    step = max(1, -(-size // max(1, parts)))
+    return [(start, min(size, start + step)) for start in range(0, size, step)] or [(0, 0)]
+
+
+def read_lines(path, start, end):
+    """Yields the lines of a dump that start in the byte range [start, end) (end None: to the end)."""
+    if end is None:
+        with gzip.open(path, 'rb') as dump:
+            yield from dump
+        return
+
+    with open(path, 'rb') as dump:
+        position = start
+        if start:
+            # A line belongs to the range it starts in; skip the tail of the previous range's last line
+            dump.seek(start - 1)
+            position = start - 1 + len(dump.readline())
+        while position < end:
+            line = dump.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def part_path(work_dir, kind, chunk, shard):
+    return os.path.join(work_dir, f'{kind}-{chunk:03d}-{shard:04d}.jsonl')
+
+
+def result_path(work_dir, shard):
+    return os.path.join(work_dir, f'results-{shard:04d}.jsonl')
+
+
+def summary_path(work_dir, shard):
+    return os.path.join(work_dir, f'results-{shard:04d}.json')
+
+
+def partition_range(path, kind, chunk, start, end, work_dir, shards):
+    """Writes the lines of one byte range of a dump into per-shard files.
+
+    Returns (lines written, malformed lines skipped).
+    """
+    key = DUMP_KEYS[kind]
+    outputs = {}
+    written = skipped = 0
+    try:
+        for line in read_lines(path, start, end):
+            if not line.strip():
+                continue
+            try:
+                product_id = json.loads(line).get(key)
+            except (ValueError, AttributeError):
+                skipped += 1
+                continue
+            if not isinstance(product_id, str):
+                if kind == 'statuses':
+                    # A status without a product cannot be joined with anything
+                    skipped += 1
+                    continue
+                product_id = ''
+            shard = shard_of(product_id, shards)
+            output = outputs.get(shard)
+            if output is None:
+                output = outputs[shard] = open(part_path(work_dir, kind, chunk, shard), 'wb')
+            output.write(line if line.endswith(b'\n') else line + b'\n')
+            written += 1
+    finally:
+        for output in outputs.values():
+            output.close()
+    return written, skipped
+
+
+def iter_shard(work_dir, kind, chunks, shard):
+    """Yields the resources of one shard of a dump, across all of its byte ranges."""
+    for chunk in range(chunks):
+        path = part_path(work_dir, kind, chunk, shard)
+        if os.path.exists(path):
+            with open(path, 'rb') as part:
+                for line in part:
+                    yield json.loads(line)
+
+
+def analyze_shard(work_dir, chunks, shard):
+    """Analyzes the products of one shard and streams the results into its JSONL part.
+
+    The summary of the shard is written last and marks it as done. Returns the summary.
+    """
+    statuses = analyzer.ProductStatusIndex()
+    # (products, issues, disapproved products), counted like analyzer.count_statuses
+    counts = [0, 0, 0]
+    for status in iter_shard(work_dir, 'statuses', chunks['statuses'], shard):
+        statuses.add(status)
+        issues_count, disapproved = analyzer.status_counts(status)
+        counts = [counts[0] + 1, counts[1] + issues_count, counts[2] + disapproved]
+
+    summary = {
+        'products_analyzed': 0,
+        'products_without_status': 0,
+        'statuses': {'good': 0, 'warning': 0, 'critical': 0},
+    }
+    partial_path = result_path(work_dir, shard) + '.partial'
+    with open(partial_path, 'w', encoding='utf-8') as output:
+        for product in iter_shard(work_dir, 'products', chunks['products'], shard):
+            status = statuses.get(product.get('id'))
+            result = analyzer.analyze_product(product, status)
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            summary['products_analyzed'] += 1
+            summary['products_without_status'] += status is None
+            summary['statuses'][result['status']] += 1
+    os.replace(partial_path, result_path(work_dir, shard))
+
+    summary['status_counts'] = counts
+    with open(summary_path(work_dir, shard), 'w', encoding='utf-8') as output:
+        json.dump(summary, output)
+    return summary
+
+
+def input_signature(paths, shards):
+    """Identifies the dumps and settings of a run, so --resume never mixes two different runs."""
+    return {
+        'inputs': {kind: [os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns] for kind, path in paths.items()},
+        'shards': shards,
+        'checks_version': analyzer.CHECKS_VERSION,
+        'rules': sorted(analyzer.PRODUCT_CHECKS),
+    }
+
+
+def load_manifest(work_dir):
+    try:
+        with open(os.path.join(work_dir, MANIFEST), encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return None
+
+
+def partition(executor, paths, work_dir, shards, workers):
+    """Splits every dump into shards in parallel; returns the number of byte ranges per dump."""
+    tasks = {
+        kind: [
+            executor.submit(partition_range, path, kind, chunk, start, end, work_dir, shards)
+            for chunk, (start, end) in enumerate(split_ranges(path, workers))
+        ]
+        for kind, path in paths.items()
+    }
+    for kind, futures in tasks.items():
+        written = skipped = 0
+        for future in futures:
+            chunk_written, chunk_skipped = future.result()
+            written += chunk_written
+            skipped += chunk_skipped
+        print(f"Split {written} {kind} into {shards} shards" + (f", skipped {skipped} malformed lines" if skipped else ''))
+    return {kind: len(futures) for kind, futures in tasks.items()}
+
+
+def merge_results(work_dir, shards, output_path):
+    """Joins the result parts of all shards into one JSONL file, replacing it atomically."""
+    partial_path = output_path + '.partial'
+    with open(partial_path, 'wb') as output:
+        for shard in range(shards):
+            with open(result_path(work_dir, shard), 'rb') as part:
+                shutil.copyfileobj(part, output)
+    os.replace(partial_path, output_path)
+
+
+def account_summary(shard_summaries, account_info=None, datafeeds=None):
+    """Adds up the shard summaries into an analyzer.build_account_analysis result plus product counts."""
+    totals = [0, 0, 0]
+    products = {'products_analyzed': 0, 'products_without_status': 0, 'statuses': {}}
+    for summary in shard_summaries:
+        totals = [total + count for total, count in zip(totals, summary['status_counts'])]
+        products['products_analyzed'] += summary['products_analyzed']
+        products['products_without_status'] += summary['products_without_status']
+        for status, count in summary['statuses'].items():
+            products['statuses'][status] = products['statuses'].get(status, 0) + count
+    analysis = analyzer.build_account_analysis(account_info, datafeeds, *totals)
+    analysis['products'] = products
+    return analysis
+
+
+def load_json(path):
+    with open(path, encoding='utf-8') as source:
+        return json.load(source)
+
+
+def run(products_path, statuses_path, output_path, workers=DEFAULT_WORKERS, shards=DEFAULT_SHARDS, resume=False,
+        account_info=None, datafeeds=None, work_dir=None, keep_work_dir=False):
+    """Runs the audit; returns the account summary, which is also written to <output>.summary.json."""
+    work_dir = work_dir or output_path + '.work'
+    paths = {'products': products_path, 'statuses': statuses_path}
+    signature = input_signature(paths, shards)
+
+    manifest = load_manifest(work_dir) if resume else None
+    if manifest and {key: manifest.get(key) for key in signature} != signature:
+        print(f"{work_dir} belongs to a run over other dumps or settings; starting over")
+        manifest = None
+    if manifest is None and os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        if manifest is None:
+            chunks = partition(executor, paths, work_dir, shards, workers)
+            # Written only once every dump is split, so a resumed run can trust the shard files
+            manifest = dict(signature, chunks=chunks)
+            with open(os.path.join(work_dir, MANIFEST), 'w', encoding='utf-8') as output:
+                json.dump(manifest, output)
+
+        pending = [shard for shard in range(shards) if not os.path.exists(summary_path(work_dir, shard))]
+        if len(pending) < shards:
+            print(f"Resuming: {shards - len(pending)} of {shards} shards already analyzed")
+        futures = [executor.submit(analyze_shard, work_dir, manifest['chunks'], shard) for shard in pending]
+        for done, future in enumerate(futures, 1):
+            summary = future.result()
+            print(f"Analyzed shard {done}/{len(pending)}: {summary['products_analyzed']} products")
+
+    merge_results(work_dir, shards, output_path)
+    summary = account_summary(
+        (load_json(summary_path(work_dir, shard)) for shard in range(shards)),
+        account_info=account_info,
+        datafeeds=datafeeds,
+    )
+    with open(os.path.splitext(output_path)[0] + '.summary.json', 'w', encoding='utf-8') as output:
+        json.dump(summary, output, ensure_ascii=False, indent=2)
+    if not keep_work_dir:
+        shutil.rmtree(work_dir)
+
+    seconds = time.perf_counter() - started
+    analyzed = summary['products']['products_analyzed']
+    print(f"Analyzed {analyzed} products in {seconds:.1f} s ({analyzed / seconds if seconds else 0:.0f}/s), results in {output_path}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('products', help='JSONL dump of products (.gz allowed)')
+    parser.add_argument('--statuses', required=True, help='JSONL dump of productstatuses (.gz allowed)')
+    parser.add_argument('--output', required=True, help='JSONL file for the per-product results')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='processes (default: one per CPU)')
+    parser.add_argument('--shards', type=int, default=DEFAULT_SHARDS)
+    parser.add_argument('--resume', action='store_true', help='reuse the finished shards of an interrupted run')
+    parser.add_argument('--account-info', help='JSON of accounts.get, for the summary')
+    parser.add_argument('--datafeeds', help='JSON of datafeeds.list (or a list of feeds), for the summary')
+    parser.add_argument('--work-dir', help='directory for shard files (default: <output>.work)')
+    parser.add_argument('--keep-work-dir', action='store_true')
+    args = parser.parse_args(argv)
+
+    datafeeds = load_json(args.datafeeds) if args.datafeeds else None
+    if isinstance(datafeeds, dict):
+        datafeeds = datafeeds.get('resources', [])
+    try:
+        summary = run(
+            args.products, args.statuses, args.output,
+            workers=args.workers,
+            shards=max(1, args.shards),
+            resume=args.resume,
+            account_info=load_json(args.account_info) if args.account_info else None,
+            datafeeds=datafeeds,
+            work_dir=args.work_dir,
+            keep_work_dir=args.keep_work_dir,
+        )
+    except Exception as e:
+        print(f"Audit failed: {e}; rerun with --resume to continue from the finished shards")
+        return 1
+    print(json.dumps({'account_status': summary['account_status'], **summary['stats']}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
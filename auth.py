@@ -1,10 +1,12 @@
 import os
 import logging
 from flask import Blueprint, redirect, url_for, session, request, current_app
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-import google.auth.transport.requests
+
+from session_file import regenerate_session
+
+# Google client libraries are imported where they are used: together they
+# take longer to import than the rest of the app, and most requests never
+# touch them, so cold starts do not pay for them.
 
 # Create logger
 logger = logging.getLogger(__name__)
@@ -15,12 +17,15 @@ auth_bp = Blueprint('auth', __name__)
 # Minimal, specific scopes
 SCOPES = [
     'https://www.googleapis.com/auth/userinfo.email',
-    'https://www.googleapis.com/auth/userinfo.profile'
+    'https://www.googleapis.com/auth/userinfo.profile',
+    'https://www.googleapis.com/auth/content'
 ]
 
 def get_google_oauth_flow(redirect_uri):
     """Safely create OAuth flow without exposing credentials."""
     try:
+        from google_auth_oauthlib.flow import Flow
+        
         # Use environment variables securely
         client_config = {
             "web": {
@@ -44,6 +49,23 @@ def get_google_oauth_flow(redirect_uri):
         logger.error(f"OAuth flow creation error: {e}")
         return None
 
+def get_credentials():
+    """Rebuild OAuth credentials of the logged in user from the session."""
+    stored = session.get('credentials')
+    if not stored:
+        return None
+    
+    from google.oauth2.credentials import Credentials
+    
+    return Credentials(
+        token=stored.get('token'),
+        refresh_token=stored.get('refresh_token'),
+        token_uri=stored.get('token_uri'),
+        client_id=os.environ.get("GCP_CLIENT_ID"),
+        client_secret=os.environ.get("GCP_CLIENT_SECRET"),
+        scopes=stored.get('scopes')
+    )
+
 @auth_bp.route('/login')
 def login():
     """Initiate secure OAuth authentication."""
@@ -94,9 +116,13 @@ def callback():
         credentials = flow.credentials
         
         # Fetch minimal user info
+        from googleapiclient.discovery import build
         oauth2_client = build('oauth2', 'v2', credentials=credentials)
         user_info = oauth2_client.userinfo().get().execute()
         
+        # The session now holds tokens, so it gets a new ID (an ID set before login is not reused)
+        regenerate_session(session)
+        
         # Store user info in session
         session['user_info'] = {
             'email': user_info.get('email'),
@@ -104,6 +130,14 @@ def callback():
             'picture': user_info.get('picture')
         }
         
+        # Keep what is needed to rebuild credentials; client secret stays in the environment
+        session['credentials'] = {
+            'token': credentials.token,
+            'refresh_token': credentials.refresh_token,
+            'token_uri': credentials.token_uri,
+            'scopes': list(credentials.scopes or SCOPES)
+        }
+        
         # Clear sensitive state
         session.pop('oauth_state', None)
         
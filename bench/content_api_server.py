@@ -0,0 +1,386 @@
+"""Local HTTP stand-in for the Content API v2.1 endpoints the app calls.
+
+Serves accounts (get, authinfo, custombatch), datafeeds (list, insert), products
+(list, custombatch) and productstatuses (list, custombatch) over a synthetic
+catalog, plus an OAuth token endpoint for service-account keys. A `fields`
+query parameter trims responses like the API's partial responses. Latency and
+429 responses can be injected; GET /_stats reports request counts. Point the
+app at it with CONTENT_API_ENDPOINT=<url>/content/v2.1/.
+
+It also plays the merchant's image host: GET /img/<name> returns a synthetic
+image (or a broken link, an HTML page or a tiny image, decided by the name)
+with ETag and Range support, for the image link validator; GET
+/redirect/<name> redirects to /img/<name>.
+
+Run standalone:  python -m bench.content_api_server --size 100000 --latency-ms 50
+"""
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from bench import synthetic
+
+API_PREFIX = '/content/v2.1'
+MAX_PAGE_SIZE = 250
+
+IMAGE_PREFIX = '/img/'
+REDIRECT_PREFIX = '/redirect/'
+IMAGE_BYTES = 32 * 1024
+
+QUOTA_ERROR = {
+    'error': {
+        'code': 429,
+        'message': 'Quota exceeded for quota metric "Requests" (injected by the benchmark stand-in).',
+        'errors': [{'reason': 'rateLimitExceeded', 'domain': 'usageLimits', 'message': 'Rate limit exceeded'}],
+    }
+}
+
+
+class StandInConfig:
+    """Catalog and fault-injection settings shared by all handler threads."""
+
+    def __init__(self, size=1000, seed=0, merchant_ids=('1000',), latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.size = size
+        self.seed = seed
+        self.merchant_ids = [str(merchant_id) for merchant_id in merchant_ids]
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.injected_errors = 0
+
+    def merchant_seed(self, merchant_id):
+        # Each account gets its own catalog
+        return self.seed + int(merchant_id) if str(merchant_id).isdigit() else self.seed
+
+    def count(self, route, injected=False):
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.injected_errors += int(injected)
+
+
+class ContentApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle's algorithm and delayed
+    # ACKs stall small responses on keep-alive connections by ~40 ms
+    disable_nagle_algorithm = True
+    config = StandInConfig()
+
+    routes = [
+        ('GET', re.compile(r'^/accounts/authinfo$'), 'authinfo'),
+        ('POST', re.compile(r'^/accounts/batch$'), 'accounts_batch'),
+        ('GET', re.compile(r'^/(?P<merchant_id>\d+)/accounts/(?P<account_id>\d+)$'), 'account'),
+        ('GET', re.compile(r'^/(?P<merchant_id>\d+)/datafeeds$'), 'datafeeds'),
+        ('POST', re.compile(r'^/(?P<merchant_id>\d+)/datafeeds$'), 'datafeed_insert'),
+        ('GET', re.compile(r'^/(?P<merchant_id>\d+)/products$'), 'products'),
+        ('GET', re.compile(r'^/(?P<merchant_id>\d+)/productstatuses$'), 'productstatuses'),
+        ('POST', re.compile(r'^/products/batch$'), 'products_batch'),
+        ('POST', re.compile(r'^/productstatuses/batch$'), 'productstatuses_batch'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        path = url.path
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+
+        if method == 'POST' and path == '/token':
+            # A form-encoded JWT grant; any assertion is accepted
+            self.config.count('token')
+            return self.send_json(200, {'access_token': 'bench-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+        if path == '/_stats':
+            with self.config.lock:
+                stats = {'requests': dict(self.config.requests), 'injected_errors': self.config.injected_errors}
+            return self.send_json(200, stats)
+        if method == 'GET' and path.startswith(IMAGE_PREFIX):
+            return self.send_image(path[len(IMAGE_PREFIX):])
+        if method == 'GET' and path.startswith(REDIRECT_PREFIX):
+            self.config.count('redirect')
+            return self.send_json(302, {}, headers={'Location': IMAGE_PREFIX + path[len(REDIRECT_PREFIX):]})
+        body = json.loads(raw_body) if raw_body else {}
+
+        if path.startswith(API_PREFIX):
+            path = path[len(API_PREFIX):]
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.config.count('not_found')
+            return self.send_json(404, {'error': {'code': 404, 'message': f'No route for {method} {path}'}})
+
+        config = self.config
+        if config.latency_ms or config.jitter_ms:
+            delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+            time.sleep(max(0.0, delay) / 1000)
+
+        if config.error_rate and random.random() < config.error_rate:
+            config.count(name, injected=True)
+            return self.send_json(429, QUOTA_ERROR, headers={'Retry-After': '0'})
+
+        config.count(name)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        payload = getattr(self, f'handle_{name}')(body=body, query=query, **match.groupdict())
+        if query.get('fields'):
+            payload = select_fields(payload, parse_fields(query['fields']))
+        self.send_json(200, payload)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_image(self, name):
+        config = self.config
+        if config.latency_ms or config.jitter_ms:
+            delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+            time.sleep(max(0.0, delay) / 1000)
+        config.count('image')
+
+        content_type, data = synthetic_image(name)
+        if data is None:
+            return self.send_json(404, {'error': 'not found'})
+
+        etag = f'"{zlib.crc32(data):08x}"'
+        if self.headers.get('If-None-Match') == etag:
+            config.count('image_not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        status, headers = 200, {}
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(len(data) - 1, int(match.group(2) or len(data) - 1))
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start:end + 1]
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Handlers
+
+    def account_resource(self, merchant_id):
+        return {
+            'kind': 'content#account',
+            'id': str(merchant_id),
+            'name': f'Bench shop {merchant_id}',
+            'websiteUrl': f'https://shop{merchant_id}.example.com',
+        }
+
+    def handle_authinfo(self, body, query):
+        return {
+            'kind': 'content#accountsAuthInfoResponse',
+            'accountIdentifiers': [{'merchantId': merchant_id} for merchant_id in self.config.merchant_ids],
+        }
+
+    def handle_account(self, body, query, merchant_id, account_id):
+        return self.account_resource(account_id)
+
+    def handle_accounts_batch(self, body, query):
+        return {
+            'kind': 'content#accountsCustomBatchResponse',
+            'entries': [
+                {'batchId': entry['batchId'], 'account': self.account_resource(entry.get('accountId'))}
+                for entry in body.get('entries', [])
+            ],
+        }
+
+    def handle_datafeeds(self, body, query, merchant_id):
+        return {
+            'kind': 'content#datafeedsListResponse',
+            'resources': [
+                {'id': f'{merchant_id}{n}', 'name': f'Primary feed {n}', 'contentType': 'products'}
+                for n in range(2)
+            ],
+        }
+
+    def handle_datafeed_insert(self, body, query, merchant_id):
+        return dict(body, id=f'{merchant_id}99', kind='content#datafeed')
+
+    def page(self, merchant_id, query, generate):
+        size = self.config.size
+        start = int(query.get('pageToken') or 0)
+        end = min(size, start + min(MAX_PAGE_SIZE, int(query.get('maxResults') or MAX_PAGE_SIZE)))
+        seed = self.config.merchant_seed(merchant_id)
+        response = {'resources': [generate(seed, index) for index in range(start, end)]}
+        if end < size:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def handle_products(self, body, query, merchant_id):
+        return dict(self.page(merchant_id, query, synthetic.generate_product), kind='content#productsListResponse')
+
+    def handle_productstatuses(self, body, query, merchant_id):
+        return dict(self.page(merchant_id, query, synthetic.generate_status), kind='content#productstatusesListResponse')
+
+    def batch_entries(self, body, generate, key):
+        entries = []
+        for entry in body.get('entries', []):
+            index = synthetic.index_of(entry.get('productId', ''))
+            if index is None or index >= self.config.size:
+                entries.append({
+                    'batchId': entry['batchId'],
+                    'errors': {'code': 404, 'message': 'item not found', 'errors': [{'reason': 'notFound'}]},
+                })
+                continue
+            resource = generate(self.config.merchant_seed(entry.get('merchantId')), index)
+            if entry.get('method') in ('insert', 'update'):
+                resource.update(entry.get('product') or {})
+            entries.append({'batchId': entry['batchId'], key: resource})
+        return entries
+
+    def handle_products_batch(self, body, query):
+        return {
+            'kind': 'content#productsCustomBatchResponse',
+            'entries': self.batch_entries(body, synthetic.generate_product, 'product'),
+        }
+
+    def handle_productstatuses_batch(self, body, query):
+        return {
+            'kind': 'content#productstatusesCustomBatchResponse',
+            'entries': self.batch_entries(body, synthetic.generate_status, 'productStatus'),
+        }
+
+
+def parse_fields(spec):
+    """Parses a partial-response selection such as 'a,b(c,d)' into {'a': None, 'b': {'c': None, 'd': None}}."""
+    selection, stack, name = {}, [], ''
+    for char in spec + ',':
+        if char in ',()':
+            name = name.strip()
+            if char == '(':
+                stack.append(selection)
+                selection = selection.setdefault(name, {})
+            elif name:
+                selection[name] = None
+            if char == ')':
+                selection = stack.pop()
+            name = ''
+        else:
+            name += char
+    return selection
+
+
+def select_fields(value, selection):
+    """Keeps only the selected fields of a response; a selection applies to each item of a list."""
+    if selection is None:
+        return value
+    if isinstance(value, list):
+        return [select_fields(item, selection) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: select_fields(value[name], selection[name]) for name in selection if name in value}
+
+
+def synthetic_image(name):
+    """Returns (content type, body) of the image at /img/<name>; body None for a broken link.
+
+    The outcome only depends on the name: about 3% of links are broken, 2% return an
+    HTML page, 5% are too small, and some JPEGs carry metadata before the frame header.
+    """
+    rng = random.Random(zlib.crc32(name.encode('utf-8')))
+    roll = rng.random()
+    if roll < 0.03:
+        return 'text/html', None
+    if roll < 0.05:
+        return 'text/html; charset=utf-8', b'<!doctype html><title>Not an image</title>'.ljust(IMAGE_BYTES)
+    width = height = 60 if roll < 0.10 else rng.choice((400, 800, 1200))
+    image_format = rng.choices(('jpeg', 'png', 'webp', 'gif'), (70, 20, 8, 2))[0]
+
+    if image_format == 'jpeg':
+        # Large EXIF blocks push the frame header past the first few kilobytes
+        exif = b'Exif\x00\x00' + bytes(rng.choice((100, 100, 100, 12000)))
+        header = (
+            b'\xff\xd8'
+            + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+            + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+            + b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+        )
+    elif image_format == 'png':
+        ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+        header = (
+            b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr
+            + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+        )
+    elif image_format == 'webp':
+        header = (
+            b'RIFF' + struct.pack('<I', IMAGE_BYTES - 8) + b'WEBPVP8X' + struct.pack('<I', 10) + bytes(4)
+            + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+        )
+    else:
+        header = b'GIF89a' + struct.pack('<HH', width, height)
+    return f'image/{image_format}', header.ljust(IMAGE_BYTES, b'\x00')
+
+
+def serve(port=0, **options):
+    """Starts the stand-in in a background thread. Returns (server, base_url, config)."""
+    config = StandInConfig(**options)
+    handler = type('BenchContentApiHandler', (ContentApiHandler,), {'config': config})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='content-api-stand-in', daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}', config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--size', type=int, default=1000, help='products per account')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--merchants', default='1000', help='comma-separated merchant IDs returned by authinfo')
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with 429')
+    args = parser.parse_args()
+
+    server, url, _ = serve(
+        port=args.port,
+        size=args.size,
+        seed=args.seed,
+        merchant_ids=args.merchants.split(','),
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+    )
+    print(f'Content API stand-in listening on {url}{API_PREFIX}/')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
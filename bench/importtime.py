@@ -0,0 +1,117 @@
+"""Cold-start budget: how long the production entrypoint takes to import.
+
+    python -m bench.importtime                     # main, checked against the default budget
+    python -m bench.importtime --budget-ms 300 --top 20
+
+Run from the repository root. The entrypoint is imported in a fresh interpreter
+with `python -X importtime`; the best of --repeat runs is compared with the
+budget. Modules in DEFERRED_MODULES are only needed by some routes and must not
+be imported at startup at all, whatever the timing. The exit status is 1 if the
+budget is exceeded or a deferred module was imported.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+ENTRYPOINT = 'main'
+DEFAULT_BUDGET_MS = 400.0
+REPEAT = 3
+
+# Imported on first use by the routes that need them
+DEFERRED_MODULES = (
+    'pandas',
+    'numpy',
+    'googleapiclient.discovery',
+    'google_auth_oauthlib',
+    'google.oauth2.credentials',
+    'google.oauth2.service_account',
+    'httplib2',
+)
+
+
+def parse_importtime(output):
+    """Returns (module, depth, self_us, cumulative_us) for each line of -X importtime output."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        imports.append((stripped, depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure(entrypoint):
+    """Imports `entrypoint` in a fresh interpreter and returns the parsed import timings."""
+    with tempfile.TemporaryDirectory(prefix='feed-optimizer-importtime-') as data_dir:
+        env = dict(os.environ, FEED_OPTIMIZER_DATA_DIR=data_dir)
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {entrypoint}'],
+            cwd=ROOT_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+    if completed.returncode != 0:
+        raise RuntimeError(f'import {entrypoint} failed:\n{completed.stderr[-2000:]}')
+    return parse_importtime(completed.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entrypoint', default=ENTRYPOINT, help='module to import, as gunicorn does')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--top', type=int, default=10, help='slowest direct imports to list')
+    args = parser.parse_args()
+
+    # The first run also fills the bytecode cache, so only the fastest run counts
+    runs = [measure(args.entrypoint) for _ in range(max(1, args.repeat))]
+    totals = [
+        sum(cumulative for name, depth, _, cumulative in imports if depth == 0 and name == args.entrypoint)
+        for imports in runs
+    ]
+    best = min(range(len(runs)), key=totals.__getitem__)
+    imports, total_ms = runs[best], totals[best] / 1000
+
+    print(f'import {args.entrypoint}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms, best of {len(runs)})')
+    print(f"{'slowest imports':<48}{'cumulative ms':>14}")
+    # Direct imports of the entrypoint are where a regression is fixed; they are listed before it
+    direct, children = [], []
+    for entry in imports:
+        if entry[1] == 1:
+            children.append(entry)
+        elif entry[1] == 0:
+            if entry[0] == args.entrypoint:
+                direct = children
+            children = []
+    direct.sort(key=lambda entry: -entry[3])
+    for name, _, _, cumulative in direct[:args.top]:
+        print(f'{name:<48}{cumulative / 1000:>14.1f}')
+
+    loaded = {name for name, _, _, _ in imports}
+    deferred = [
+        module for module in DEFERRED_MODULES
+        if module in loaded or any(name.startswith(module + '.') for name in loaded)
+    ]
+
+    failed = False
+    if deferred:
+        failed = True
+        print(f"FAIL: imported at startup, should be deferred: {', '.join(deferred)}")
+    if total_ms > args.budget_ms:
+        failed = True
+        print(f'FAIL: import took {total_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget')
+    if not failed:
+        print('ok')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
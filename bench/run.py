@@ -0,0 +1,501 @@
+"""Benchmarks for the fetch and analysis paths against the local Content API stand-in.
+
+    python -m bench.run                              # all benchmarks, compared with bench/baselines.json
+    python -m bench.run --size 100000 --only fetch_product_statuses
+    python -m bench.run --latency-ms 40 --error-rate 0.02
+    python -m bench.run --update-baselines
+
+Run from the repository root. The stand-in runs in its own process, and each
+benchmark runs in a fresh subprocess with an empty data directory, so peak RSS
+and cache state are per benchmark. Results are compared with stored baselines
+recorded under the same settings. The exit status is 1 if throughput, p99
+latency or peak RSS regressed beyond --tolerance.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+
+MERCHANT_ID = '1000'
+DEFAULT_SIZE = 10000
+DEFAULT_TOLERANCE = 0.25
+REPEAT = 3
+STATUS_BATCH_SIZE = 250
+
+BENCHMARKS = (
+    'analyze_product',
+    'analyze_frame',
+    'fetch_products',
+    'fetch_product_statuses',
+    'fetch_statuses_by_id',
+    'index_statuses',
+    'analyze_account',
+    'analyze_route',
+    'validate_images',
+    'check_identifiers',
+    'find_near_duplicates',
+    'audit_dump',
+    'analyze_feed_files',
+)
+
+
+# Benchmarks; each returns (items processed, seconds, per-operation latencies in seconds)
+
+def bench_analyze_product(args):
+    import analyzer
+    from bench import synthetic
+
+    pairs = [
+        (synthetic.generate_product(args.seed, index), synthetic.generate_status(args.seed, index))
+        for index in range(args.size)
+    ]
+    latencies = []
+    started = time.perf_counter()
+    for product, status in pairs:
+        call_started = time.perf_counter()
+        analyzer.analyze_product(product, status)
+        latencies.append(time.perf_counter() - call_started)
+    return len(pairs), time.perf_counter() - started, latencies
+
+
+def bench_analyze_frame(args):
+    import analyzer
+    from bench import synthetic
+
+    # In the app, analysis runs once the API client libraries and pandas (imported by analyzer on
+    # first use) are loaded; load them up front so the timings do not include that one-off cost
+    import content_api
+    import pandas  # noqa: F401
+    content_api.warm_up()
+
+    pages = []
+    for start in range(0, args.size, 250):
+        end = min(args.size, start + 250)
+        pages.append((
+            list(synthetic.generate_products(end, args.seed, start)),
+            list(synthetic.generate_statuses(end, args.seed, start)),
+        ))
+    latencies = []
+    started = time.perf_counter()
+    for products, statuses in pages:
+        call_started = time.perf_counter()
+        analyzer.analyze_frame(products, statuses)
+        latencies.append(time.perf_counter() - call_started)
+    return args.size, time.perf_counter() - started, latencies
+
+
+def service_account_client(args):
+    import merchant_api
+    return merchant_api.create_content_api_client(write_service_account_key(args))
+
+
+def fetch_collection(args, iterate):
+    client = service_account_client(args)
+    latencies = []
+    last = [time.perf_counter()]
+
+    def on_page(page):
+        now = time.perf_counter()
+        latencies.append(now - last[0])
+        last[0] = now
+
+    started = time.perf_counter()
+    count = sum(1 for _ in iterate(client, MERCHANT_ID, on_page=on_page))
+    return count, time.perf_counter() - started, latencies
+
+
+def bench_fetch_products(args):
+    import merchant_api
+    return fetch_collection(args, merchant_api.iter_products)
+
+
+def bench_fetch_product_statuses(args):
+    import merchant_api
+    return fetch_collection(args, merchant_api.iter_product_statuses)
+
+
+def bench_fetch_statuses_by_id(args):
+    import merchant_api
+    from bench import synthetic
+
+    client = service_account_client(args)
+    product_ids = [synthetic.product_id(index) for index in range(args.size)]
+    latencies = []
+    count = 0
+    started = time.perf_counter()
+    for start in range(0, len(product_ids), STATUS_BATCH_SIZE):
+        call_started = time.perf_counter()
+        count += len(merchant_api.get_product_statuses_by_id(client, MERCHANT_ID, product_ids[start:start + STATUS_BATCH_SIZE]))
+        latencies.append(time.perf_counter() - call_started)
+    return count, time.perf_counter() - started, latencies
+
+
+def bench_index_statuses(args):
+    import analyzer
+    import merchant_api
+    from bench import synthetic
+
+    # Holds every status of the catalog, so peak RSS shows the size of the compact records
+    client = service_account_client(args)
+    started = time.perf_counter()
+    index = analyzer.ProductStatusIndex(merchant_api.iter_product_statuses(client, MERCHANT_ID))
+    latencies = []
+    for product_id in (synthetic.product_id(position) for position in range(args.size)):
+        call_started = time.perf_counter()
+        index.get(product_id)
+        latencies.append(time.perf_counter() - call_started)
+    return len(index), time.perf_counter() - started, latencies
+
+
+def bench_analyze_account(args):
+    from flask import Flask, session
+    import analyzer
+
+    # analyze_account reads OAuth credentials from the session, as in the app
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        with app.test_request_context():
+            session['credentials'] = {
+                'token': 'bench-token',
+                'refresh_token': None,
+                'token_uri': f'{args.server_url}/token',
+                'scopes': ['https://www.googleapis.com/auth/content'],
+            }
+            call_started = time.perf_counter()
+            analysis = analyzer.analyze_account(MERCHANT_ID)
+            latencies.append(time.perf_counter() - call_started)
+        if analysis['stats']['products_count'] != args.size:
+            raise RuntimeError(f"analyze_account saw {analysis['stats']['products_count']} of {args.size} products")
+    return args.size * REPEAT, time.perf_counter() - started, latencies
+
+
+def bench_analyze_route(args):
+    import app as app_module
+
+    # The stand-in issues tokens for this key, so the app's service-account path runs unchanged
+    app_module.SERVICE_ACCOUNT_FILE = write_service_account_key(args)
+    client = app_module.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['merchant_id'] = MERCHANT_ID
+
+    latencies = []
+    count = 0
+    started = time.perf_counter()
+    for run in range(REPEAT):
+        call_started = time.perf_counter()
+        # Later runs bypass the snapshot cache so every run fetches the catalog again
+        response = client.get('/analyze?refresh=1' if run else '/analyze')
+        job_id = response.headers['Location'].split('job=')[1]
+        while True:
+            job = client.get(f'/analyze/status/{job_id}').get_json()
+            if job['state'] == 'done':
+                break
+            if job['state'] == 'failed' or job.get('error'):
+                raise RuntimeError(f"Analysis job failed: {job.get('error')}")
+            time.sleep(0.01)
+        client.get('/api/products')
+        latencies.append(time.perf_counter() - call_started)
+        count += job['products_analyzed']
+    return count, time.perf_counter() - started, latencies
+
+
+class BatchTimer:
+    """Stands in for a job's progress and records the time between progress updates."""
+
+    def __init__(self):
+        self.latencies = []
+        self.last = time.perf_counter()
+
+    def product_analyzed(self, count=1):
+        now = time.perf_counter()
+        self.latencies.append(now - self.last)
+        self.last = now
+
+
+def bench_validate_images(args):
+    import images
+    from bench import synthetic
+
+    # Synthetic image links point at the stand-in, which also serves the images
+    products = []
+    for index in range(args.size):
+        product = synthetic.generate_product(args.seed, index)
+        for key in ('imageLink', 'additionalImageLinks'):
+            if key in product:
+                product[key] = json.loads(json.dumps(product[key]).replace('https://cdn.example.com', args.server_url))
+        products.append(product)
+
+    # The stand-in listens on loopback, which the validator refuses by default
+    validator = images.ImageValidator(allow_private=True)
+    timer = BatchTimer()
+    started = time.perf_counter()
+    report = images.check_catalog(products, validator, progress=timer, batch_size=STATUS_BATCH_SIZE)
+    seconds = time.perf_counter() - started
+    validator.close()
+    return report['images_checked'], seconds, timer.latencies
+
+
+def bench_check_identifiers(args):
+    import identifiers
+    from bench import synthetic
+
+    products = list(synthetic.generate_products(args.size, args.seed))
+    timer = BatchTimer()
+    started = time.perf_counter()
+    report = identifiers.check_catalog(products, progress=timer, batch_size=STATUS_BATCH_SIZE)
+    return report['products_checked'], time.perf_counter() - started, timer.latencies
+
+
+def bench_find_near_duplicates(args):
+    import near_duplicates
+    import numpy  # noqa: F401
+    from bench import synthetic
+
+    products = list(synthetic.generate_products(args.size, args.seed))
+    timer = BatchTimer()
+    started = time.perf_counter()
+    report = near_duplicates.check_catalog(products, progress=timer)
+    return report['products_checked'], time.perf_counter() - started, timer.latencies
+
+
+def bench_audit_dump(args):
+    import audit
+    from bench import synthetic
+
+    # Dumps go to the benchmark's data directory; writing them is not timed
+    data_dir = os.environ.get('FEED_OPTIMIZER_DATA_DIR') or tempfile.mkdtemp()
+    products_path = os.path.join(data_dir, 'products.jsonl')
+    statuses_path = os.path.join(data_dir, 'productstatuses.jsonl')
+    with open(products_path, 'w', encoding='utf-8') as products, open(statuses_path, 'w', encoding='utf-8') as statuses:
+        for index in range(args.size):
+            products.write(json.dumps(synthetic.generate_product(args.seed, index)) + '\n')
+            statuses.write(json.dumps(synthetic.generate_status(args.seed, index)) + '\n')
+
+    started = time.perf_counter()
+    summary = audit.run(products_path, statuses_path, os.path.join(data_dir, 'results.jsonl'))
+    seconds = time.perf_counter() - started
+    return summary['products']['products_analyzed'], seconds, [seconds]
+
+
+def bench_analyze_feed_files(args):
+    import feed_files
+    from bench import synthetic
+
+    # The catalog as an RSS and a tab-delimited feed file; writing them is not timed
+    data_dir = os.environ.get('FEED_OPTIMIZER_DATA_DIR') or tempfile.mkdtemp()
+    paths = [os.path.join(data_dir, 'feed.xml'), os.path.join(data_dir, 'feed.tsv')]
+    synthetic.write_feed_xml(paths[0], args.size, args.seed)
+    synthetic.write_feed_tsv(paths[1], args.size, args.seed)
+
+    latencies = []
+    items = 0
+    started = time.perf_counter()
+    for path in paths:
+        call_started = time.perf_counter()
+        items += feed_files.analyze_feed(path)['items_checked']
+        latencies.append(time.perf_counter() - call_started)
+    return items, time.perf_counter() - started, latencies
+
+
+# Harness
+
+def write_service_account_key(args):
+    """Writes a service-account key whose token_uri points at the stand-in."""
+    path = os.path.join(os.environ['FEED_OPTIMIZER_DATA_DIR'], 'bench-service-account.json')
+    if not os.path.exists(path):
+        key = {
+            'type': 'service_account',
+            'project_id': 'bench',
+            'private_key_id': 'bench',
+            'private_key': generate_private_key(),
+            'client_email': 'bench@bench.iam.gserviceaccount.com',
+            'client_id': '1',
+            'token_uri': f'{args.server_url}/token',
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(key, f)
+    return path
+
+
+def generate_private_key():
+    """RSA key in PEM, using whichever signer google-auth has installed."""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode('ascii')
+    except ImportError:
+        import rsa
+
+        _, private_key = rsa.newkeys(2048)
+        return private_key.save_pkcs1().decode('ascii')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_child(args):
+    """Runs one benchmark in this process and prints its result as JSON."""
+    items, seconds, latencies = globals()[f'bench_{args.child}'](args)
+    print(json.dumps({
+        'items': items,
+        'seconds': round(seconds, 4),
+        'throughput': round(items / seconds, 1) if seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_stand_in(args):
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'bench.content_api_server',
+            '--port', str(port),
+            '--size', str(args.size),
+            '--seed', str(args.seed),
+            '--merchants', MERCHANT_ID,
+            '--latency-ms', str(args.latency_ms),
+            '--jitter-ms', str(args.jitter_ms),
+            '--error-rate', str(args.error_rate),
+        ],
+        cwd=ROOT_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('The Content API stand-in did not start')
+
+
+def run_benchmark(name, args):
+    with tempfile.TemporaryDirectory(prefix='feed-optimizer-bench-') as data_dir:
+        env = dict(
+            os.environ,
+            FEED_OPTIMIZER_DATA_DIR=data_dir,
+            CONTENT_API_ENDPOINT=f'{args.server_url}/content/v2.1/',
+            SECRET_KEY='bench',
+        )
+        command = [
+            sys.executable, '-m', 'bench.run', '--child', name,
+            '--size', str(args.size), '--seed', str(args.seed), '--server-url', args.server_url,
+        ]
+        completed = subprocess.run(command, cwd=ROOT_DIR, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f'{name} failed:\n{completed.stderr.strip()}')
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(result, baseline, tolerance):
+    """Returns the list of regressions of `result` against `baseline`."""
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput']}/s < baseline {baseline['throughput']}/s")
+    for metric in ('p99_ms', 'peak_rss_mb'):
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f'{metric} {result[metric]} > baseline {baseline[metric]}')
+    return regressions
+
+
+def settings(args):
+    return {
+        'seed': args.seed,
+        'latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms,
+        'error_rate': args.error_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Feed optimizer benchmarks')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='products in the synthetic catalog (1k to 1M)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, help='run only these benchmarks')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every stand-in response')
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with 429')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--update-baselines', action='store_true')
+    parser.add_argument('--child', choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    process, args.server_url = start_stand_in(args)
+    failed = False
+    try:
+        print(f"{'benchmark':<28}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'RSS MB':>9}  result")
+        for name in args.only or BENCHMARKS:
+            key = f'{name}@{args.size}'
+            result = run_benchmark(name, args)
+            baseline = baselines.get(key)
+
+            if args.update_baselines:
+                baselines[key] = dict(result, settings=settings(args))
+                verdict = 'baseline updated'
+            elif baseline is None:
+                verdict = 'no baseline'
+            elif baseline.get('settings') != settings(args):
+                verdict = 'baseline recorded with other settings'
+            else:
+                regressions = compare(result, baseline, args.tolerance)
+                failed = failed or bool(regressions)
+                verdict = 'REGRESSION: ' + '; '.join(regressions) if regressions else 'ok'
+
+            print(f"{key:<28}{result['throughput']:>12}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+                  f"{result['peak_rss_mb']:>9}  {verdict}")
+    finally:
+        process.terminate()
+        process.wait()
+
+    if args.update_baselines:
+        with open(BASELINES_PATH, 'w', encoding='utf-8') as f:
+            json.dump(dict(sorted(baselines.items())), f, indent=2)
+            f.write('\n')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Seeded synthetic Merchant Center catalogs for benchmarks.
+
+Every item is derived from (seed, index) alone, so any page of a catalog of
+any size can be produced on demand without generating the items before it.
+"""
+import random
+from xml.sax.saxutils import escape
+
+WORDS = (
+    'classic', 'premium', 'cotton', 'leather', 'wireless', 'organic', 'stainless', 'vintage', 'compact',
+    'waterproof', 'lightweight', 'ergonomic', 'handmade', 'portable', 'slim', 'deluxe', 'outdoor', 'kids',
+    'running', 'kitchen', 'garden', 'travel', 'office', 'sports', 'winter', 'summer', 'smart', 'eco',
+)
+NOUNS = (
+    'jacket', 'sneakers', 'backpack', 'headphones', 'lamp', 'mug', 'watch', 'chair', 'kettle', 'blanket',
+    'bottle', 'wallet', 'scarf', 'speaker', 'tent', 'knife', 'pillow', 'charger', 'helmet', 'notebook',
+)
+BRANDS = ('Acme', 'Northwind', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Stark', 'Wayne', 'Soylent', 'Custom')
+COLORS = ('black', 'white', 'red', 'blue', 'green', 'grey', 'beige', 'navy')
+SIZES = ('XS', 'S', 'M', 'L', 'XL', '38', '40', '42', '44')
+PRODUCT_TYPES = ('Apparel > Outerwear', 'Electronics > Audio', 'Home > Kitchen', 'Sports > Camping', 'Home > Decor')
+DESTINATIONS = ('Shopping', 'SurfacesAcrossGoogle')
+
+# (code, attributeName, servability, detail, weight); weights follow what large accounts typically show
+ISSUE_TYPES = (
+    ('missing_item_attribute_for_product_type', 'color', 'demoted', 'Missing value [color]', 18),
+    ('invalid_upc', 'gtin', 'demoted', 'Invalid value [gtin]', 12),
+    ('image_link_broken', 'image link', 'disapproved', 'Invalid image [image_link]', 8),
+    ('missing_shipping', 'shipping', 'disapproved', 'Missing shipping information', 7),
+    ('price_mismatch', 'price', 'disapproved', 'Mismatched value (page crawl) [price]', 6),
+    ('availability_mismatch', 'availability', 'disapproved', 'Mismatched value (page crawl) [availability]', 5),
+    ('image_too_small', 'image link', 'unaffected', 'Image too small [image_link]', 10),
+    ('title_too_long', 'title', 'unaffected', 'Text too long [title]', 6),
+    ('landing_page_error', 'link', 'disapproved', 'Unavailable desktop landing page', 4),
+    ('pending_initial_policy_review', None, 'unaffected', 'Pending initial review', 9),
+    ('policy_violation', None, 'disapproved', 'Violation of Shopping ads policy', 1),
+)
+ISSUE_WEIGHTS = [issue[-1] for issue in ISSUE_TYPES]
+
+# The analyzer classifies item-level issues by `severity`, so it is set alongside `servability`
+SEVERITY_BY_SERVABILITY = {'disapproved': 'error', 'demoted': 'warning', 'unaffected': 'suggestion'}
+
+# Share of products with 0, 1, 2, 3 and 4 item-level issues
+ISSUE_COUNT_WEIGHTS = (55, 25, 12, 5, 3)
+
+
+def item_random(seed, index):
+    return random.Random(seed * 1_000_003 + index)
+
+
+def product_id(index):
+    return f'online:en:US:SKU-{index:07d}'
+
+
+def gtin(seed, index):
+    """Returns the valid GTIN-13 of item `index`; different items get different GTINs."""
+    body = f'{400_000_000_000 + (seed * 1_000_003 + index) % 10 ** 11:012d}'
+    total = sum(int(digit) * (1 if position % 2 == 0 else 3) for position, digit in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_product(seed, index):
+    """Returns product `index` of the catalog identified by `seed`."""
+    rng = item_random(seed, index)
+    brand = rng.choice(BRANDS)
+    noun = rng.choice(NOUNS)
+    product = {
+        'kind': 'content#product',
+        'id': product_id(index),
+        'offerId': f'SKU-{index:07d}',
+        'channel': 'online',
+        'contentLanguage': 'en',
+        'targetCountry': 'US',
+        'link': f'https://shop.example.com/p/{index}',
+        'price': {'value': f'{rng.uniform(5, 500):.2f}', 'currency': 'USD'},
+        'availability': rng.choices(('in stock', 'out of stock', 'preorder'), (85, 12, 3))[0],
+        'condition': 'new',
+        'productTypes': [rng.choice(PRODUCT_TYPES)],
+    }
+
+    roll = rng.random()
+    if roll < 0.05:
+        pass  # no title
+    elif roll < 0.20:
+        product['title'] = noun.capitalize()
+    else:
+        product['title'] = f'{brand} {_sentence(rng, rng.randint(2, 6))} {noun}'.strip()
+
+    roll = rng.random()
+    if roll < 0.08:
+        pass  # no description
+    elif roll < 0.28:
+        product['description'] = _sentence(rng, rng.randint(3, 10))
+    else:
+        product['description'] = '. '.join(_sentence(rng, rng.randint(6, 14)) for _ in range(rng.randint(2, 8)))
+
+    if rng.random() < 0.9:
+        product['brand'] = brand
+    if rng.random() < 0.7:
+        # A few GTINs have a wrong check digit or belong to another item of the catalog
+        roll = rng.random()
+        if roll < 0.03:
+            product['gtin'] = f'{rng.randrange(10 ** 12, 10 ** 13)}'
+        elif roll < 0.05 and index:
+            product['gtin'] = gtin(seed, rng.randrange(index))
+        else:
+            product['gtin'] = gtin(seed, index)
+    if rng.random() < 0.5:
+        product['mpn'] = f'MPN-{rng.randrange(10 ** 6):06d}'
+    if rng.random() < 0.97:
+        product['imageLink'] = f'https://cdn.example.com/img/{index}.jpg'
+    if rng.random() < 0.4:
+        product['additionalImageLinks'] = [f'https://cdn.example.com/img/{index}-{n}.jpg' for n in range(rng.randint(1, 4))]
+    if rng.random() < 0.6:
+        product['color'] = rng.choice(COLORS)
+    if rng.random() < 0.4:
+        product['sizes'] = [rng.choice(SIZES)]
+    return product
+
+
+def generate_status(seed, index):
+    """Returns the productstatus of product `index`, consistent with its issues."""
+    rng = item_random(seed + 1, index)
+    issue_count = rng.choices(range(len(ISSUE_COUNT_WEIGHTS)), ISSUE_COUNT_WEIGHTS)[0]
+    issues = []
+    for code, attribute, servability, detail, _ in rng.choices(ISSUE_TYPES, ISSUE_WEIGHTS, k=issue_count):
+        issue = {
+            'code': code,
+            'servability': servability,
+            'severity': SEVERITY_BY_SERVABILITY[servability],
+            'resolution': 'merchant_action',
+            'destination': rng.choice(DESTINATIONS),
+            'description': detail,
+            'detail': detail,
+        }
+        if attribute:
+            issue['attributeName'] = attribute
+            issue['attribute'] = attribute
+        issues.append(issue)
+
+    disapproved = any(issue['servability'] == 'disapproved' for issue in issues)
+    destination_statuses = []
+    for destination in DESTINATIONS:
+        if disapproved:
+            status = 'disapproved'
+        else:
+            status = rng.choices(('approved', 'pending'), (92, 8))[0]
+        destination_statuses.append({
+            'destination': destination,
+            'status': status,
+            'approvedCountries': ['US'] if status == 'approved' else [],
+            'disapprovedCountries': ['US'] if status == 'disapproved' else [],
+        })
+
+    return {
+        'kind': 'content#productStatus',
+        'productId': product_id(index),
+        'title': generate_product(seed, index).get('title', ''),
+        'link': f'https://shop.example.com/p/{index}',
+        'destinationStatuses': destination_statuses,
+        'itemLevelIssues': issues,
+    }
+
+
+def index_of(product_id_value):
+    """Returns the catalog index of a product ID produced by product_id(), or None."""
+    try:
+        return int(product_id_value.rsplit('SKU-', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def generate_products(size, seed=0, start=0):
+    for index in range(start, size):
+        yield generate_product(seed, index)
+
+
+def generate_statuses(size, seed=0, start=0):
+    for index in range(start, size):
+        yield generate_status(seed, index)
+
+
+# Content API attribute -> feed attribute, for writing the catalog as a primary feed file
+FEED_ATTRIBUTES = (
+    ('offerId', 'id'), ('title', 'title'), ('description', 'description'), ('link', 'link'),
+    ('imageLink', 'image_link'), ('additionalImageLinks', 'additional_image_link'), ('gtin', 'gtin'), ('mpn', 'mpn'),
+    ('brand', 'brand'), ('identifierExists', 'identifier_exists'), ('itemGroupId', 'item_group_id'),
+    ('productTypes', 'product_type'), ('price', 'price'), ('availability', 'availability'), ('condition', 'condition'),
+)
+
+
+def feed_values(product, attribute):
+    """Values of a product attribute as feed text; list attributes give one value per item."""
+    value = product.get(attribute)
+    if value is None:
+        return []
+    if attribute == 'identifierExists':
+        return ['yes' if value else 'no']
+    if attribute == 'price':
+        return [f"{value['value']} {value['currency']}"]
+    return list(value) if isinstance(value, list) else [value]
+
+
+def write_feed_tsv(path, size, seed=0):
+    """Writes the catalog as a tab-delimited primary feed."""
+    with open(path, 'w', encoding='utf-8', newline='') as feed:
+        feed.write('\t'.join(column for _, column in FEED_ATTRIBUTES) + '\r\n')
+        for product in generate_products(size, seed):
+            feed.write('\t'.join(','.join(feed_values(product, attribute)) for attribute, _ in FEED_ATTRIBUTES) + '\r\n')
+
+
+def write_feed_xml(path, size, seed=0):
+    """Writes the catalog as a Google-format RSS 2.0 primary feed."""
+    with open(path, 'w', encoding='utf-8') as feed:
+        feed.write('<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n')
+        feed.write('<channel><title>Synthetic catalog</title><link>https://shop.example.com</link>\n')
+        for product in generate_products(size, seed):
+            elements = [
+                f'<{tag}>{escape(value)}</{tag}>'
+                for attribute, column in FEED_ATTRIBUTES
+                for tag in [column if column in ('title', 'description', 'link') else f'g:{column}']
+                for value in feed_values(product, attribute)
+            ]
+            feed.write(f"<item>{''.join(elements)}</item>\n")
+        feed.write('</channel>\n</rss>\n')
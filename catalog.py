@@ -0,0 +1,90 @@
+import queue
+import threading
+
+import scheduler
+import tracing
+
+# Content API caps maxResults for products and productstatuses at 250
+MAX_PAGE_SIZE = 250
+DEFAULT_PREFETCH = 1
+
+# Partial responses: list calls download only the attributes the app reads. Products: the
+# analyzer checks and the image, identifier and near-duplicate checks; statuses: issues and
+# destination states (the API reports servability, not a severity)
+PRODUCT_FIELDS = (
+    'id', 'offerId', 'itemGroupId', 'title', 'description', 'brand', 'gtin', 'mpn', 'identifierExists',
+    'imageLink', 'additionalImageLinks',
+)
+STATUS_FIELDS = (
+    'productId',
+    'itemLevelIssues(code,servability,attributeName,destination,detail)',
+    'destinationStatuses(destination,status)',
+)
+
+_DONE = object()
+
+
+def list_fields(resource_fields):
+    """The `fields` parameter of a list call that returns only `resource_fields` of each resource."""
+    return f"nextPageToken,resources({','.join(resource_fields)})"
+
+
+def iter_pages(collection, merchant_id, page_size=MAX_PAGE_SIZE, prefetch=DEFAULT_PREFETCH, on_page=None, **params):
+    """Yields pages of a Content API collection, fetching ahead in a background thread.
+
+    `collection` is a collection resource such as `client.products()`. At most
+    `prefetch` pages are buffered ahead of the consumer, so memory stays bounded
+    no matter how large the catalog is. Errors raised while fetching are re-raised
+    in the consumer. `on_page`, if given, is called with each page as it is consumed.
+    """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    pages = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for room in the buffer, but give up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch():
+        try:
+            request = collection.list(merchantId=merchant_id, maxResults=page_size, **params)
+            page = 0
+            while request is not None and not stop.is_set():
+                page += 1
+                response = scheduler.execute(request, merchant_id, page=page)
+                if not put(response.get('resources', [])):
+                    return
+                request = collection.list_next(request, response)
+            put(_DONE)
+        except Exception as e:
+            put(e)
+
+    worker = threading.Thread(target=tracing.in_context(fetch), name='catalog-prefetch', daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                break
+            if isinstance(page, Exception):
+                raise page
+            if on_page:
+                on_page(page)
+            yield page
+    finally:
+        # Stop the fetcher before returning so the client is not used from two threads
+        stop.set()
+        worker.join()
+
+
+def iter_resources(collection, merchant_id, page_size=MAX_PAGE_SIZE, prefetch=DEFAULT_PREFETCH, on_page=None, **params):
+    """Yields resources one by one across all pages of a Content API collection."""
+    for page in iter_pages(collection, merchant_id, page_size=page_size, prefetch=prefetch, on_page=on_page, **params):
+        yield from page
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+API_NAME = 'content'
+API_VERSION = 'v2.1'
+CONTENT_SCOPE = 'https://www.googleapis.com/auth/content'
+
+# Base URL override, e.g. the local Content API stand-in in bench/ (http://127.0.0.1:8765/content/v2.1/)
+API_ENDPOINT = os.environ.get('CONTENT_API_ENDPOINT')
+
+# How many service objects to keep and for how long
+POOL_MAX_SIZE = 64
+POOL_TTL = 3600
+
+# Idle transports kept per credentials, about the number of requests a merchant has in flight
+POOL_MAX_IDLE_TRANSPORTS = 16
+
+
+@lru_cache(maxsize=None)
+def get_discovery_document():
+    """Returns the Content API discovery document bundled with googleapiclient, parsed.
+
+    The document is read and parsed once per process; no discovery request is
+    ever made. build_from_document() fills in method parameters in the document
+    it is given, so every resource is built once before the document is shared;
+    later builds only rewrite those entries with equal values.
+    """
+    # googleapiclient is imported on first use rather than at startup
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    document = get_static_doc(API_NAME, API_VERSION)
+    if document is None:
+        raise RuntimeError(f'No bundled discovery document for {API_NAME} {API_VERSION}')
+    document = json.loads(document)
+
+    def build_resources(resource, description):
+        for name, nested in (description.get('resources') or {}).items():
+            build_resources(getattr(resource, name)(), nested)
+
+    build_resources(build_from_document(document, credentials=AnonymousCredentials()), document)
+    return document
+
+
+class ServicePool:
+    """LRU pool of Content API service objects with a time-to-live.
+
+    A service only builds requests, so one per credentials is shared by every
+    thread; the httplib2 transports that send them are not thread-safe and are
+    checked out of a TransportPool for each request instead.
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE, ttl=POOL_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """Returns the pooled service for `key`, creating it with `factory` on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._services.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._services.move_to_end(key)
+                return entry[1]
+
+        service = factory()
+
+        with self._lock:
+            self._services[key] = (now, service)
+            self._services.move_to_end(key)
+            while len(self._services) > self.max_size:
+                self._services.popitem(last=False)
+        return service
+
+    def clear(self):
+        """Drops every pooled service."""
+        with self._lock:
+            self._services.clear()
+
+
+class TransportPool:
+    """Idle authorized httplib2 transports per credentials, lent out for one request at a time.
+
+    A transport keeps its connections alive between requests, so threads that
+    come and go (fan-out calls, prefetchers, snapshot refreshes) reuse the
+    connections of earlier ones. Transports are dropped with their credentials.
+    """
+
+    def __init__(self, max_idle=POOL_MAX_IDLE_TRANSPORTS):
+        self.max_idle = max_idle
+        self._idle = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, http):
+        """Yields a transport with the credentials of `http` (a request's own transport).
+
+        A transport whose request failed below HTTP is closed rather than returned to the pool.
+        """
+        credentials = getattr(http, 'credentials', None)
+        if credentials is None:
+            # Not an authorized transport (e.g. a mock); use it as it is
+            yield http
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(credentials, [])
+            transport = idle.pop() if idle else None
+        if transport is None:
+            import google_auth_httplib2
+            from googleapiclient.http import build_http
+
+            transport = google_auth_httplib2.AuthorizedHttp(credentials, http=build_http())
+
+        try:
+            yield transport
+        except Exception as e:
+            # An HTTP error response leaves the connection usable; a reset or timeout may not
+            from googleapiclient.errors import HttpError
+
+            self._release(credentials, transport, reusable=isinstance(e, HttpError))
+            raise
+        self._release(credentials, transport, reusable=True)
+
+    def _release(self, credentials, transport, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(credentials, [])
+                if len(idle) < self.max_idle:
+                    idle.append(transport)
+                    return
+        transport.close()
+
+    def clear(self):
+        """Closes every idle transport."""
+        with self._lock:
+            idle = [transport for transports in self._idle.values() for transport in transports]
+            self._idle.clear()
+        for transport in idle:
+            transport.close()
+
+
+_pool = ServicePool()
+transports = TransportPool()
+
+
+def credential_key(credentials):
+    """Returns a stable pool key for a credentials object without keeping raw secrets."""
+    email = getattr(credentials, 'service_account_email', None)
+    if email:
+        raw = f'service_account:{email}'
+    else:
+        secret = getattr(credentials, 'refresh_token', None) or getattr(credentials, 'token', None)
+        raw = f'user:{getattr(credentials, "client_id", "")}:{secret}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def build_service(credentials):
+    """Builds a new Content API service from the bundled discovery document."""
+    from googleapiclient.discovery import build_from_document
+
+    client_options = {'api_endpoint': API_ENDPOINT} if API_ENDPOINT else None
+    return build_from_document(get_discovery_document(), credentials=credentials, client_options=client_options)
+
+
+def warm_up():
+    """Imports the client libraries and loads the discovery document ahead of the first API call."""
+    from googleapiclient.discovery import build_from_document  # noqa: F401
+    from google.oauth2.credentials import Credentials  # noqa: F401
+
+    get_discovery_document()
+
+
+def get_service(credentials):
+    """Returns a pooled Content API service for the given credentials."""
+    if not credentials:
+        return None
+    return _pool.get(credential_key(credentials), lambda: build_service(credentials))
+
+
+def get_service_account_service(service_account_file):
+    """Returns a pooled Content API service for a service account key file."""
+    def factory():
+        from google.oauth2 import service_account
+
+        credentials = service_account.Credentials.from_service_account_file(
+            service_account_file,
+            scopes=[CONTENT_SCOPE]
+        )
+        return build_service(credentials)
+
+    return _pool.get(f'service_account_file:{service_account_file}', factory)
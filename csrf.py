@@ -0,0 +1,25 @@
+import hmac
+import secrets
+
+from flask import request, session
+
+FORM_FIELD = 'csrf_token'
+
+
+def token():
+    """Returns the session's token for forms that change data, creating it on first use."""
+    token = session.get('csrf_token')
+    if not token:
+        token = session['csrf_token'] = secrets.token_urlsafe(32)
+    return token
+
+
+def form_valid():
+    """Checks the token of a form submitted with POST."""
+    token = session.get('csrf_token')
+    return bool(token) and hmac.compare_digest(request.form.get(FORM_FIELD, ''), token)
+
+
+def init_app(app):
+    """Makes token() available, as csrf_token(), to the app's templates."""
+    app.jinja_env.globals['csrf_token'] = token
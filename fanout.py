@@ -0,0 +1,46 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import tracing
+
+# Seconds to wait for a call that has no timeout of its own
+DEFAULT_TIMEOUT = 30
+
+MAX_WORKERS = 8
+
+
+def run_concurrently(calls, timeouts=None, default_timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS):
+    """Runs independent zero-argument calls at the same time and collects what finishes.
+
+    `calls` maps a name to a callable. Each call runs in its own pool thread;
+    Content API clients are shared and lend each request a pooled transport,
+    so calls can use any client. `timeouts` maps names to seconds, measured
+    from the start; None means wait indefinitely.
+
+    Returns (results, errors). Calls that raise or time out are left out of
+    `results` and get a message in `errors` instead, so the caller can go on
+    with partial data. A timed-out call keeps running in the background.
+    """
+    timeouts = timeouts or {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls))), thread_name_prefix='fanout')
+    started = time.monotonic()
+    futures = {name: executor.submit(tracing.in_context(call)) for name, call in calls.items()}
+
+    results = {}
+    errors = {}
+    try:
+        for name, future in futures.items():
+            timeout = timeouts.get(name, default_timeout)
+            remaining = None if timeout is None else max(0, started + timeout - time.monotonic())
+            try:
+                results[name] = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                future.cancel()
+                errors[name] = f'timed out after {timeout} s'
+            except Exception as e:
+                errors[name] = str(e)
+    finally:
+        executor.shutdown(wait=False)
+
+    return results, errors
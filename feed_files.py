@@ -0,0 +1,297 @@
+"""Streaming reader for primary feed files, to check products before they are uploaded.
+
+    python feed_files.py products.xml
+    python feed_files.py products.tsv.gz --format tsv
+
+Reads Google-format RSS 2.0 / Atom XML feeds and tab-delimited feeds (plain or
+gzip-compressed), maps each item to a Content API product dict and runs
+analyzer.analyze_product on it as it streams by. Memory stays constant however
+large the file is.
+"""
+import argparse
+import codecs
+import gzip
+import json
+import mmap
+import sys
+import xml.etree.ElementTree as ElementTree
+
+import analyzer
+import tracing
+
+# Bytes decoded at a time; a multiple of the page size, so pages already read can be released
+CHUNK_BYTES = 1024 * 1024
+
+# Items with issues listed in a report
+REPORT_SAMPLE_SIZE = 50
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Tag prefix of elements in the Google namespace (g:id, g:price, ...)
+GOOGLE_TAG = '{http://base.google.com/ns/1.0}'
+
+# Feed attribute (TSV column or XML element, without the g: prefix) -> Content API product attribute
+FEED_ATTRIBUTES = {
+    'id': 'offerId',
+    'title': 'title',
+    'description': 'description',
+    'summary': 'description',
+    'link': 'link',
+    'image_link': 'imageLink',
+    'additional_image_link': 'additionalImageLinks',
+    'gtin': 'gtin',
+    'mpn': 'mpn',
+    'brand': 'brand',
+    'identifier_exists': 'identifierExists',
+    'item_group_id': 'itemGroupId',
+    'product_type': 'productTypes',
+    'google_product_category': 'googleProductCategory',
+    'color': 'color',
+    'material': 'material',
+    'pattern': 'pattern',
+    'size': 'sizes',
+    'price': 'price',
+    'availability': 'availability',
+    'condition': 'condition',
+}
+
+# Attributes that may be given several times; a TSV cell lists their values separated by commas
+LIST_ATTRIBUTES = {'additionalImageLinks', 'productTypes', 'sizes'}
+
+# Item elements of RSS 2.0 and Atom feeds
+ITEM_TAGS = {'item', 'entry'}
+
+IDENTIFIER_EXISTS_FALSE = {'no', 'false', 'n', '0'}
+
+
+def feed_attribute(name):
+    """Normalizes a TSV header or XML tag (`g:image_link`, `Image Link`) to a feed attribute name."""
+    name = name.rpartition('}')[2].strip().lower()
+    if name.startswith('g:'):
+        name = name[2:]
+    return name.replace(' ', '_')
+
+
+def parse_price(value):
+    """'15.00 USD' -> {'value': '15.00', 'currency': 'USD'}, the Content API price shape."""
+    amount, _, currency = value.partition(' ')
+    price = {'value': amount}
+    if currency.strip():
+        price['currency'] = currency.strip().upper()
+    return price
+
+
+def product_from_fields(fields, split_lists=False):
+    """Builds a product dict from (feed attribute, value) pairs.
+
+    Unknown attributes are ignored and the first value of a single-valued
+    attribute wins. With `split_lists`, list attributes are split on commas,
+    as in tab-delimited feeds.
+    """
+    product = {}
+    for name, value in fields:
+        attribute = FEED_ATTRIBUTES.get(name)
+        value = (value or '').strip()
+        if attribute is None or not value:
+            continue
+        if attribute in LIST_ATTRIBUTES:
+            values = [part.strip() for part in value.split(',')] if split_lists else [value]
+            product.setdefault(attribute, []).extend(part for part in values if part)
+        elif attribute in product:
+            continue
+        elif attribute == 'identifierExists':
+            product[attribute] = value.lower() not in IDENTIFIER_EXISTS_FALSE
+        elif attribute == 'price':
+            product[attribute] = parse_price(value)
+        else:
+            product[attribute] = value
+    # Without a channel, language and country the offer ID is the only product ID there is
+    product['id'] = product.get('offerId', '')
+    return product
+
+
+def open_binary(path):
+    """Opens a feed file for reading bytes, decompressing it if it is gzip-compressed."""
+    with open(path, 'rb') as raw:
+        compressed = raw.read(2) == GZIP_MAGIC
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def sniff_encoding(data):
+    """Encoding of a feed from its byte order mark; Google accepts UTF-8 and UTF-16 files."""
+    if data.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    return 'utf-8'
+
+
+def detect_format(path):
+    """'xml' if the file starts with markup, otherwise 'tsv'."""
+    with open_binary(path) as feed:
+        head = feed.read(4096)
+    text = head.decode(sniff_encoding(head), errors='ignore')
+    return 'xml' if text.lstrip('\ufeff \t\r\n').startswith('<') else 'tsv'
+
+
+def iter_xml_products(path):
+    """Yields the products of an RSS 2.0 or Atom feed one item at a time.
+
+    Elements in the Google namespace win over plain RSS/Atom ones (g:id over an
+    Atom id). Every item is cleared and detached from its parent once it is
+    read, so the tree never holds more than the item being parsed.
+    """
+    with open_binary(path) as feed:
+        parents = []
+        for event, element in ElementTree.iterparse(feed, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if feed_attribute(element.tag) not in ITEM_TAGS:
+                continue
+            yield product_from_fields(
+                (
+                    feed_attribute(child.tag),
+                    # Atom links carry the URL in href
+                    child.get('href') if feed_attribute(child.tag) == 'link' and child.get('href') else child.text,
+                )
+                for child in sorted(element, key=lambda child: not child.tag.startswith(GOOGLE_TAG))
+            )
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+
+
+def iter_chunks(path):
+    """Yields the bytes of a feed file in CHUNK_BYTES pieces.
+
+    A plain file is memory-mapped, and the pages of each chunk are released once
+    it has been decoded, so a multi-gigabyte file does not stay resident.
+    """
+    with open_binary(path) as feed:
+        if isinstance(feed, gzip.GzipFile):
+            yield from iter(lambda: feed.read(CHUNK_BYTES), b'')
+            return
+        feed.seek(0, 2)
+        if not feed.tell():
+            return
+        with mmap.mmap(feed.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), CHUNK_BYTES):
+                yield mapped[start:start + CHUNK_BYTES]
+                if hasattr(mmap, 'MADV_DONTNEED'):
+                    mapped.madvise(mmap.MADV_DONTNEED, start, min(CHUNK_BYTES, len(mapped) - start))
+
+
+def iter_lines(chunks):
+    """Decodes chunks of bytes incrementally and yields lines without their line breaks.
+
+    A character split between two chunks is decoded once the rest of it arrives;
+    undecodable bytes become U+FFFD rather than stopping the check.
+    """
+    decoder = None
+    pending = ''
+    for chunk in chunks:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(sniff_encoding(chunk))(errors='replace')
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if decoder is not None:
+        pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def unquote(cell):
+    """Removes the double quotes around a TSV cell, if any."""
+    if len(cell) >= 2 and cell[0] == cell[-1] == '"':
+        return cell[1:-1].replace('""', '"')
+    return cell
+
+
+def iter_tsv_products(path):
+    """Yields the products of a tab-delimited feed row by row; the first row names the attributes."""
+    lines = iter_lines(iter_chunks(path))
+    columns = None
+    for line in lines:
+        if not line.strip():
+            continue
+        cells = line.split('\t')
+        if columns is None:
+            columns = [feed_attribute(unquote(cell)) for cell in cells]
+            continue
+        yield product_from_fields(zip(columns, (unquote(cell) for cell in cells)), split_lists=True)
+
+
+FEED_READERS = {'xml': iter_xml_products, 'tsv': iter_tsv_products}
+
+
+def iter_products(path, feed_format=None):
+    """Yields the products of a feed file; the format is detected unless given as 'xml' or 'tsv'."""
+    return FEED_READERS[feed_format or detect_format(path)](path)
+
+
+@tracing.traced('feed_files', items=lambda report: report['items_checked'])
+def analyze_feed(path, feed_format=None, progress=None):
+    """Analyzes every item of a feed file as it is read and returns a report.
+
+    The report counts items per status and per issue and keeps the first
+    REPORT_SAMPLE_SIZE items with issues. A file that stops parsing part-way
+    (malformed XML) is reported with the items read up to that point and the
+    parse error. `progress` (a jobs.JobProgress) is told about each analyzed item.
+    """
+    feed_format = feed_format or detect_format(path)
+    report = {
+        'format': feed_format,
+        'items_checked': 0,
+        'statuses': {'good': 0, 'warning': 0, 'critical': 0},
+        'issues': {},
+        'examples': [],
+        'error': None,
+    }
+    try:
+        for product in iter_products(path, feed_format):
+            result = analyzer.analyze_product(product, None)
+            report['items_checked'] += 1
+            report['statuses'][result['status']] += 1
+            codes = []
+            for severity, issues in result['issues'].items():
+                for issue in issues:
+                    counter = report['issues'].setdefault(
+                        issue['code'],
+                        {'code': issue['code'], 'severity': severity, 'message': issue['message'],
+                         'attribute': issue['attribute'], 'items': 0}
+                    )
+                    counter['items'] += 1
+                    codes.append(issue['code'])
+            if codes and len(report['examples']) < REPORT_SAMPLE_SIZE:
+                report['examples'].append({
+                    'offer_id': result['product_id'],
+                    'title': result['title'],
+                    'status': result['status'],
+                    'codes': codes,
+                })
+            if progress:
+                progress.product_analyzed()
+    except ElementTree.ParseError as e:
+        report['error'] = f"XML parse error after {report['items_checked']} items: {e}"
+
+    report['issues'] = sorted(report['issues'].values(), key=lambda counter: (-counter['items'], counter['code']))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='feed file: RSS/Atom XML or tab-delimited, optionally gzip-compressed')
+    parser.add_argument('--format', choices=sorted(FEED_READERS), help='skip format detection')
+    args = parser.parse_args(argv)
+
+    report = analyze_feed(args.path, feed_format=args.format)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if report['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+import analyzer
+import catalog
+import scheduler
+import tracing
+
+# products.custombatch accepts at most this many entries per request
+CUSTOMBATCH_MAX_ENTRIES = 1000
+
+# Batches sent to the API at the same time
+MAX_BATCHES_IN_FLIGHT = 4
+
+# Each failed entry is sent at most this many times, with exponential backoff in between
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+
+# Entry errors worth retrying; anything else (e.g. an invalid value) will fail again
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'backendError', 'internalError', 'rateLimitExceeded', 'quotaExceeded', 'deadlineExceeded'}
+
+MAX_TITLE_LENGTH = 150
+MAX_DESCRIPTION_LENGTH = 5000
+
+# How many planned changes and errors are kept in a report
+REPORT_SAMPLE_SIZE = 50
+
+# Fix groups offered on the optimize page -> issue codes they resolve
+FIX_GROUPS = {
+    'gtin': ('missing_gtin',),
+    'titles': ('missing_title', 'short_title'),
+    'descriptions': ('missing_description', 'short_description'),
+    'images': ('missing_image',),
+}
+
+
+def _truncate(text, limit):
+    """Cuts text to `limit` characters at a word boundary."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(' ', 1)[0]
+    return cut or text[:limit]
+
+
+def _details(product):
+    """Product attributes that can describe it, as (label, value) pairs."""
+    sizes = product.get('sizes') or []
+    details = [
+        ('Brand', product.get('brand')),
+        ('Color', product.get('color')),
+        ('Material', product.get('material')),
+        ('Pattern', product.get('pattern')),
+        ('Size', ', '.join(sizes)),
+    ]
+    return [(label, str(value)) for label, value in details if value]
+
+
+def fix_title(product):
+    """Extends a missing or short title with the brand and variant attributes."""
+    title = product.get('title', '')
+    base = title or (product.get('description') or '').split('.')[0]
+    parts = [base] if base else []
+    for _, value in _details(product):
+        if value.lower() not in ' '.join(parts).lower():
+            parts.append(value)
+
+    new_title = _truncate(' '.join(parts).strip(), MAX_TITLE_LENGTH)
+    if len(new_title) <= len(title):
+        return None
+    return {'title': new_title}
+
+
+def fix_description(product):
+    """Extends a missing or short description with the title and product attributes."""
+    description = product.get('description', '')
+    sentences = [description.strip()] if description else []
+    if product.get('title') and product['title'] not in description:
+        sentences.insert(0, product['title'].rstrip('.') + '.')
+    for label, value in _details(product):
+        if value.lower() not in description.lower():
+            sentences.append(f'{label}: {value}.')
+    if product.get('productTypes'):
+        sentences.append(f"Category: {product['productTypes'][0].split('>')[-1].strip()}.")
+
+    new_description = _truncate(' '.join(sentences), MAX_DESCRIPTION_LENGTH)
+    if len(new_description) <= len(description):
+        return None
+    return {'description': new_description}
+
+
+def fix_identifier(product):
+    """Marks products without a GTIN, brand and MPN as having no unique identifiers.
+
+    A real GTIN cannot be made up; products that do have a brand and MPN need
+    one from the merchant and are left for manual review.
+    """
+    if product.get('gtin') or (product.get('brand') and product.get('mpn')):
+        return None
+    return {'identifierExists': False}
+
+
+def fix_image(product):
+    """Promotes the first additional image to the main image."""
+    additional = product.get('additionalImageLinks') or []
+    if not additional:
+        return None
+    return {'imageLink': additional[0], 'additionalImageLinks': additional[1:]}
+
+
+# Product attributes read by the checks and the fixers, for a partial-response product list
+PRODUCT_FIELDS = catalog.PRODUCT_FIELDS + ('color', 'material', 'pattern', 'sizes', 'productTypes')
+
+
+# Issue code -> function returning an attribute patch, or None if it cannot be fixed automatically
+FIXERS = {
+    'missing_title': fix_title,
+    'short_title': fix_title,
+    'missing_description': fix_description,
+    'short_description': fix_description,
+    'missing_gtin': fix_identifier,
+    'missing_image': fix_image,
+}
+
+
+def issue_codes(fix_groups):
+    """Returns the issue codes resolved by the selected fix groups."""
+    return {code for group in fix_groups for code in FIX_GROUPS.get(group, ())}
+
+
+def plan_product(product, codes):
+    """Returns the patch for a product's fixable issues among `codes`.
+
+    The result is (plan, skipped), where `plan` is a dict with product_id, codes
+    and patch (or None if nothing can be fixed) and `skipped` lists issue codes
+    found on the product that have no automatic fix.
+    """
+    analysis = analyzer.analyze_product(product, None)
+    found = [
+        issue['code']
+        for severity_issues in analysis['issues'].values()
+        for issue in severity_issues
+        if issue['code'] in codes
+    ]
+
+    patch = {}
+    fixed = []
+    skipped = []
+    for code in found:
+        code_patch = FIXERS[code](product)
+        if code_patch:
+            patch.update(code_patch)
+            fixed.append(code)
+        else:
+            skipped.append(code)
+
+    plan = {'product_id': product['id'], 'codes': fixed, 'patch': patch} if patch else None
+    return plan, skipped
+
+
+def custombatch_entry(batch_id, merchant_id, plan):
+    """products.custombatch entry that updates only the patched attributes."""
+    return {
+        'batchId': batch_id,
+        'merchantId': merchant_id,
+        'method': 'update',
+        'productId': plan['product_id'],
+        'product': plan['patch'],
+        'updateMask': ','.join(plan['patch']),
+    }
+
+
+def _entry_error(errors):
+    """Returns (message, retryable) for the `errors` of a custombatch entry."""
+    reasons = {error.get('reason') for error in errors.get('errors', [])}
+    retryable = errors.get('code') in RETRYABLE_CODES or bool(reasons & RETRYABLE_REASONS)
+    return errors.get('message', 'Unknown error'), retryable
+
+
+def push_batch(client_factory, merchant_id, plans):
+    """Sends one batch of up to CUSTOMBATCH_MAX_ENTRIES patches.
+
+    Entries that fail with a retryable error are sent again on their own, up to
+    MAX_ATTEMPTS times. Returns (updated, failed) where `failed` is a list of
+    (product_id, message).
+    """
+    pending = dict(enumerate(plans))
+    messages = {}
+    failed = []
+    updated = 0
+
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+        entries = [custombatch_entry(batch_id, merchant_id, plan) for batch_id, plan in pending.items()]
+        try:
+            response = scheduler.execute(client_factory().products().custombatch(body={'entries': entries}), merchant_id)
+        except Exception as e:
+            # The scheduler has already retried the request itself, so the whole batch fails
+            messages = {batch_id: str(e) for batch_id in pending}
+            break
+
+        retry = {}
+        for entry in response.get('entries', []):
+            batch_id = entry.get('batchId')
+            if batch_id not in pending:
+                continue
+            if entry.get('errors'):
+                message, retryable = _entry_error(entry['errors'])
+                if retryable:
+                    retry[batch_id] = pending[batch_id]
+                    messages[batch_id] = message
+                else:
+                    failed.append((pending[batch_id]['product_id'], message))
+            else:
+                updated += 1
+            pending.pop(batch_id)
+
+        # Entries missing from the response are retried as well
+        for batch_id, plan in pending.items():
+            retry[batch_id] = plan
+            messages.setdefault(batch_id, 'No response for this entry')
+        pending = retry
+        if not pending:
+            break
+
+    failed.extend((plan['product_id'], messages.get(batch_id, 'Unknown error')) for batch_id, plan in pending.items())
+    return updated, failed
+
+
+def _batches(plans, size):
+    iterator = iter(plans)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def new_report(dry_run, feed=False):
+    return {
+        'dry_run': dry_run,
+        'feed': feed,
+        'products_checked': 0,
+        'products_planned': 0,
+        'fixes': {},
+        'skipped': {},
+        'updated': 0,
+        'failed': 0,
+        'changes': [],
+        'errors': [],
+    }
+
+
+def iter_plans(products, codes, report, progress=None):
+    """Yields plans for the products that have fixable issues, counting fixes in `report`."""
+    for product in products:
+        plan, skipped = plan_product(product, codes)
+        report['products_checked'] += 1
+        if progress:
+            progress.product_analyzed()
+        for code in skipped:
+            report['skipped'][code] = report['skipped'].get(code, 0) + 1
+        if plan is None:
+            continue
+
+        report['products_planned'] += 1
+        for code in plan['codes']:
+            report['fixes'][code] = report['fixes'].get(code, 0) + 1
+        if len(report['changes']) < REPORT_SAMPLE_SIZE:
+            report['changes'].append({
+                'product_id': plan['product_id'],
+                'codes': plan['codes'],
+                'before': {attribute: product.get(attribute) for attribute in plan['patch']},
+                'after': plan['patch'],
+            })
+        yield plan
+
+
+@tracing.traced('fixes', items=lambda report: report['products_checked'])
+def fix_products(client_factory, merchant_id, products, fix_groups, dry_run=True, progress=None,
+                 max_batches_in_flight=MAX_BATCHES_IN_FLIGHT, feed_store=None):
+    """Plans fixes for the selected issue groups and applies them in bulk.
+
+    `products` is any iterable of Content API products (e.g. a catalog stream);
+    it is consumed as batches are sent, so memory stays bounded. `client_factory`
+    is called in each sending thread and returns the shared, pooled client. With
+    `dry_run` nothing is sent and the report only lists the planned changes.
+    With `feed_store` (a supplemental_feed.OverrideStore) the patches become the
+    merchant's supplemental feed instead, and the products are left as they are.
+    """
+    report = new_report(dry_run, feed=feed_store is not None)
+    plans = iter_plans(products, issue_codes(fix_groups), report, progress)
+
+    if dry_run:
+        for _ in plans:
+            pass
+        return report
+
+    if feed_store is not None:
+        for batch in _batches(plans, CUSTOMBATCH_MAX_ENTRIES):
+            feed_store.set_overrides(merchant_id, [(plan['product_id'], plan['patch']) for plan in batch])
+            report['updated'] += len(batch)
+        return report
+
+    def collect(future):
+        updated, failed = future.result()
+        report['updated'] += updated
+        report['failed'] += len(failed)
+        for product_id, message in failed:
+            if len(report['errors']) < REPORT_SAMPLE_SIZE:
+                report['errors'].append({'product_id': product_id, 'message': message})
+
+    with ThreadPoolExecutor(max_workers=max_batches_in_flight, thread_name_prefix='fix-batch') as executor:
+        in_flight = set()
+        for batch in _batches(plans, CUSTOMBATCH_MAX_ENTRIES):
+            # Only a few batches wait at a time, so planning does not run ahead of sending
+            if len(in_flight) >= max_batches_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            in_flight.add(executor.submit(tracing.in_context(push_batch), client_factory, merchant_id, batch))
+
+        for future in in_flight:
+            collect(future)
+
+    return report
@@ -0,0 +1,188 @@
+from itertools import islice
+
+import tracing
+
+# GTIN-8 (EAN-8), GTIN-12 (UPC-A), GTIN-13 (EAN-13) and GTIN-14 (ITF-14)
+GTIN_LENGTHS = (8, 12, 13, 14)
+
+# Weights of the first 13 digits of a GTIN padded to 14 digits; the 14th is the check digit
+GTIN_WEIGHTS = (3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3)
+
+ZERO_GTIN = '0' * 14
+
+# Products streamed between progress updates when checking a whole catalog
+CATALOG_BATCH_SIZE = 2000
+REPORT_SAMPLE_SIZE = 50
+
+# Catalog-wide identifier checks, added with analyzer.add_check_issues: code -> (severity, message, attribute)
+IDENTIFIER_CHECKS = {
+    'duplicate_gtin': ('warning', 'GTIN is also used by a different offer', 'gtin'),
+    'duplicate_mpn': ('warning', 'Brand and MPN are also used by a different offer', 'mpn'),
+}
+
+
+def normalize_gtin(value):
+    """Returns a GTIN-8/12/13/14 as 14 digits, or None if it is not digits of a GTIN length.
+
+    Padding makes a UPC-A and the EAN-13 with a leading zero the same identifier.
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if len(value) not in GTIN_LENGTHS or not value.isdigit() or not value.isascii():
+        return None
+    return value.zfill(14)
+
+
+def gtin_check_digit(digits):
+    """Returns the check digit for the first 13 digits of a padded GTIN."""
+    # Summing the ASCII codes of every other digit is several times faster than int() per digit;
+    # the codes are offset by ord('0'), 27 times in all with the weights
+    codes = digits[:13].encode('ascii')
+    total = 3 * sum(codes[0::2]) + sum(codes[1::2]) - 27 * ord('0')
+    return (10 - total % 10) % 10
+
+
+def is_valid_gtin(value):
+    """True if `value` is a GTIN-8/12/13/14 with a correct check digit (and not all zeros)."""
+    gtin = normalize_gtin(value)
+    return gtin is not None and gtin != ZERO_GTIN and gtin_check_digit(gtin) == ord(gtin[13]) - ord('0')
+
+
+def valid_gtin_mask(values):
+    """is_valid_gtin for a whole column of values at once, as a numpy bool array.
+
+    The check digits are computed as one matrix product over the digits of all
+    well-formed GTINs, so a page of products costs a single numpy call.
+    """
+    import numpy as np
+
+    normalized = [normalize_gtin(value) for value in values]
+    rows = [row for row, gtin in enumerate(normalized) if gtin is not None]
+    mask = np.zeros(len(normalized), dtype=bool)
+    if rows:
+        text = ''.join(normalized[row] for row in rows).encode('ascii')
+        digits = (np.frombuffer(text, dtype=np.uint8) - ord('0')).reshape(len(rows), 14).astype(np.int64)
+        check = (10 - digits[:, :13] @ np.array(GTIN_WEIGHTS, dtype=np.int64) % 10) % 10
+        mask[rows] = (check == digits[:, 13]) & digits.any(axis=1)
+    return mask
+
+
+def offer_key(product):
+    """The offer a product belongs to: one offer is one product per country and language."""
+    return product.get('offerId') or product.get('id')
+
+
+def identifier_keys(product):
+    """Yields (code, key) for the identifiers of a product that must be unique per offer.
+
+    GTINs are keyed by their integer value; brand and MPN only identify a product
+    that has no GTIN, as Merchant Center matches on them in that case.
+    """
+    gtin = normalize_gtin(product.get('gtin'))
+    if gtin is not None:
+        yield 'duplicate_gtin', int(gtin)
+    elif product.get('mpn') and product.get('brand'):
+        yield 'duplicate_mpn', f"{product['brand'].strip().lower()}\x00{product['mpn'].strip().lower()}"
+
+
+class IdentifierIndex:
+    """Identifier -> product ID index of a catalog, built in a single pass.
+
+    Only the first product of each identifier is kept, plus the other
+    products of its offer and the products of identifiers that turn out to be
+    shared, so duplicates are found in O(n) without holding the catalog.
+    Products of the same offer (the same offerId in other countries or
+    languages) share identifiers legitimately.
+    """
+
+    def __init__(self, products=()):
+        self._owners = {}
+        self._siblings = {}
+        self._duplicates = {}
+        for product in products:
+            self.add(product)
+
+    def add(self, product):
+        """Adds a product to the index."""
+        product_id = product.get('id')
+        offer = offer_key(product)
+        for code, key in identifier_keys(product):
+            owner = self._owners.get(key)
+            if owner is None:
+                self._owners[key] = (offer, product_id)
+            elif key in self._duplicates:
+                self._duplicates[key][product_id] = offer
+            elif owner[0] != offer:
+                shared = self._duplicates[key] = {owner[1]: owner[0]}
+                for sibling in self._siblings.pop(key, ()):
+                    shared[sibling] = owner[0]
+                shared[product_id] = offer
+            else:
+                # The first offer in another country or language: a duplicate only once another offer shows up
+                self._siblings.setdefault(key, []).append(product_id)
+
+    def duplicates(self):
+        """Yields (code, identifier, product IDs) for every identifier used by more than one offer."""
+        for key, products in self._duplicates.items():
+            if len(set(products.values())) < 2:
+                continue
+            if isinstance(key, int):
+                yield 'duplicate_gtin', f'{key:014d}', list(products)
+            else:
+                yield 'duplicate_mpn', key.replace('\x00', ' / '), list(products)
+
+    def codes_by_product(self):
+        """Returns {product ID: IDENTIFIER_CHECKS codes} for the products whose identifiers other offers use too."""
+        codes = {}
+        for code, _, product_ids in self.duplicates():
+            for product_id in product_ids:
+                codes.setdefault(product_id, []).append(code)
+        return codes
+
+    def __len__(self):
+        return len(self._owners)
+
+
+@tracing.traced('identifiers', items=lambda report: report['products_checked'])
+def check_catalog(products, progress=None, batch_size=CATALOG_BATCH_SIZE):
+    """Checks GTINs and duplicate identifiers across a stream of products and returns a report.
+
+    One pass validates every GTIN and fills an IdentifierIndex; the duplicates
+    are read from the index at the end. `progress` (a jobs.JobProgress) is told
+    about each checked product.
+    """
+    index = IdentifierIndex()
+    report = {
+        'products_checked': 0,
+        'products_with_gtin': 0,
+        'invalid_gtins': 0,
+        'duplicate_gtins': 0,
+        'duplicate_mpns': 0,
+        'products_with_duplicates': 0,
+        'invalid_examples': [],
+        'duplicate_examples': [],
+    }
+    products = iter(products)
+    while True:
+        batch = list(islice(products, batch_size))
+        if not batch:
+            break
+        for product in batch:
+            index.add(product)
+            if 'gtin' in product:
+                report['products_with_gtin'] += 1
+                if not is_valid_gtin(product['gtin']):
+                    report['invalid_gtins'] += 1
+                    if len(report['invalid_examples']) < REPORT_SAMPLE_SIZE:
+                        report['invalid_examples'].append({'product_id': product.get('id'), 'gtin': product['gtin']})
+        report['products_checked'] += len(batch)
+        if progress:
+            progress.product_analyzed(len(batch))
+
+    for code, identifier, product_ids in index.duplicates():
+        report['duplicate_gtins' if code == 'duplicate_gtin' else 'duplicate_mpns'] += 1
+        report['products_with_duplicates'] += len(product_ids)
+        if len(report['duplicate_examples']) < REPORT_SAMPLE_SIZE:
+            report['duplicate_examples'].append({'code': code, 'identifier': identifier, 'product_ids': product_ids[:10]})
+    return report
@@ -0,0 +1,485 @@
+import http.client
+import ipaddress
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import urljoin, urlsplit
+
+import analyzer
+import storage
+import tracing
+
+DB_NAME = 'images.sqlite'
+
+# Requests in flight across all hosts, and per host; catalogs are usually served from one or two CDNs
+IMAGE_CHECK_WORKERS = int(os.environ.get('IMAGE_CHECK_WORKERS', '64'))
+PER_HOST_CONNECTIONS = int(os.environ.get('IMAGE_CHECK_PER_HOST', '32'))
+
+TIMEOUT = 10
+MAX_REDIRECTS = 5
+
+# The first range covers PNG, GIF, WebP and BMP headers and most JPEGs; a JPEG whose
+# frame header comes after large metadata gets one more range
+HEAD_BYTES = 4096
+JPEG_SCAN_BYTES = 65536
+
+# A server that ignores Range has its body read in full (to keep the connection) up to this size
+DRAIN_LIMIT = 256 * 1024
+
+# Checks newer than this are reused as is; older ones are revalidated with ETag/Last-Modified
+CACHE_TTL = 86400
+CACHE_MAX_AGE = 30 * 86400
+
+# Merchant Center's minimum for non-apparel products
+MIN_IMAGE_SIZE = 100
+
+# Products whose URLs are checked together; identical URLs within a batch are fetched once
+CATALOG_BATCH_SIZE = 2000
+REPORT_SAMPLE_SIZE = 50
+
+USER_AGENT = 'feed-optimizer-image-check/1.0'
+
+SUPPORTED_FORMATS = {'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
+
+# Image checks, added with analyzer.add_check_issues: code -> (severity, message, attribute)
+IMAGE_CHECKS = {
+    'image_link_broken': ('critical', 'Image link is broken', 'imageLink'),
+    'image_wrong_type': ('critical', 'Image is not a JPEG, PNG, GIF, WebP, BMP or TIFF file', 'imageLink'),
+    'image_too_small': ('warning', f'Image is smaller than {MIN_IMAGE_SIZE}x{MIN_IMAGE_SIZE} pixels', 'imageLink'),
+    'additional_image_link_broken': ('warning', 'An additional image link is broken', 'additionalImageLinks'),
+    'additional_image_wrong_type': ('warning', 'An additional image is not in a supported format', 'additionalImageLinks'),
+    'additional_image_too_small': ('info', f'An additional image is smaller than {MIN_IMAGE_SIZE}x{MIN_IMAGE_SIZE} pixels', 'additionalImageLinks'),
+}
+
+
+def sniff_format(data):
+    """Returns the image format from the file's magic bytes, or None."""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:2] == b'BM':
+        return 'bmp'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    return None
+
+
+def _jpeg_size(data):
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            position += 2
+            continue
+        # Start-of-frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[position + 5:position + 9])
+            return width, height
+        position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+    return None
+
+
+def image_size(image_format, data):
+    """Returns (width, height) parsed from the start of an image file, or None if not found."""
+    try:
+        if image_format == 'png' and len(data) >= 24:
+            return struct.unpack('>II', data[16:24])
+        if image_format == 'gif' and len(data) >= 10:
+            return struct.unpack('<HH', data[6:10])
+        if image_format == 'bmp' and len(data) >= 26:
+            width, height = struct.unpack('<ii', data[18:26])
+            return width, abs(height)
+        if image_format == 'webp' and len(data) >= 30:
+            chunk = data[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b'VP8L':
+                b0, b1, b2, b3 = data[21:25]
+                return 1 + (b0 | (b1 & 0x3F) << 8), 1 + (b1 >> 6 | b2 << 2 | (b3 & 0x0F) << 10)
+            if chunk == b'VP8X':
+                return 1 + int.from_bytes(data[24:27], 'little'), 1 + int.from_bytes(data[27:30], 'little')
+        if image_format == 'jpeg':
+            return _jpeg_size(data)
+    except struct.error:
+        pass
+    return None
+
+
+class BlockedAddressError(OSError):
+    """An image host that resolves only to loopback, private, link-local or other non-public addresses."""
+
+
+def is_public_address(address):
+    """True for a globally routable unicast IP address."""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def create_public_connection(address, timeout, source_address=None):
+    """socket.create_connection that only connects to public addresses.
+
+    The check runs on the addresses the connection is actually made to, after
+    DNS resolution, so image links cannot reach the metadata server or other
+    internal hosts, by name or through DNS rebinding.
+    """
+    host, port = address
+    error = None
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        if not is_public_address(sockaddr[0]):
+            error = error or BlockedAddressError(f'{host} resolves to a non-public address {sockaddr[0]}')
+            continue
+        try:
+            return socket.create_connection(sockaddr[:2], timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error or OSError(f'{host} did not resolve to any address')
+
+
+class HostPool:
+    """Keep-alive connections to one host, with at most `limit` requests in flight.
+
+    Connections are only made to public addresses unless `allow_private` is set.
+    """
+
+    def __init__(self, scheme, netloc, limit=PER_HOST_CONNECTIONS, timeout=TIMEOUT, allow_private=False):
+        self.connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self.slots = threading.BoundedSemaphore(limit)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, path, headers, read_limit):
+        """Sends a GET and returns (status, headers, body of at most `read_limit` bytes)."""
+        with self.slots:
+            for attempt in range(2):
+                with self.lock:
+                    connection = self.idle.pop() if self.idle else None
+                reused = connection is not None
+                if connection is None:
+                    connection = self.connection_class(self.netloc, timeout=self.timeout)
+                    if not self.allow_private:
+                        connection._create_connection = create_public_connection
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    body, reusable = self._read(response, read_limit)
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    # The server may have closed an idle keep-alive connection; retry once on a new one
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                if reusable:
+                    with self.lock:
+                        self.idle.append(connection)
+                else:
+                    connection.close()
+                return response.status, response.headers, body
+
+    def _read(self, response, read_limit):
+        # None for chunked bodies; http.client sets 0 for 304 and other bodiless responses
+        length = response.length
+        if response.will_close:
+            return response.read(read_limit), False
+        if length is not None and length <= max(read_limit, DRAIN_LIMIT):
+            return response.read()[:read_limit], True
+        # A large body we do not want: stop reading and drop the connection
+        body = response.read(read_limit)
+        response.close()
+        return body, False
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle.clear()
+
+
+class ImageCache:
+    """Image check results by URL in SQLite, with the validators needed to revalidate them."""
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS image_checks (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    result TEXT NOT NULL,
+                    checked_at REAL NOT NULL
+                );
+            ''')
+        self.prune()
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    def get_many(self, urls):
+        """Returns cached results for `urls` as a dict of URL -> result."""
+        results = {}
+        connection = self._connection()
+        urls = list(urls)
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            rows = connection.execute(
+                f'SELECT url, result, checked_at FROM image_checks WHERE url IN ({",".join("?" * len(chunk))})',
+                chunk
+            )
+            for url, result, checked_at in rows:
+                results[url] = dict(json.loads(result), checked_at=checked_at)
+        return results
+
+    def put_many(self, results):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO image_checks (url, etag, last_modified, result, checked_at) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (result['url'], result.get('etag'), result.get('last_modified'), json.dumps(result), result['checked_at'])
+                    for result in results
+                ]
+            )
+
+    def prune(self, max_age=CACHE_MAX_AGE):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM image_checks WHERE checked_at < ?', (time.time() - max_age,))
+
+
+class ImageValidator:
+    """Checks image URLs with ranged GETs over pooled keep-alive connections.
+
+    Each URL gets its status, content type, format and pixel size; `problem` is
+    'broken', 'wrong_type', 'too_small', 'unreachable' (timeouts, 5xx, 429;
+    not cached, so retried next time) or None. Links to hosts with non-public
+    addresses count as broken; `allow_private` lifts that for local stand-ins.
+    """
+
+    def __init__(self, cache=None, max_workers=IMAGE_CHECK_WORKERS, per_host=PER_HOST_CONNECTIONS,
+                 timeout=TIMEOUT, cache_ttl=CACHE_TTL, allow_private=False):
+        self.cache = cache if cache is not None else ImageCache()
+        self.per_host = per_host
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.allow_private = allow_private
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-check')
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _pool(self, scheme, netloc):
+        with self.lock:
+            pool = self.pools.get((scheme, netloc))
+            if pool is None:
+                pool = self.pools[(scheme, netloc)] = HostPool(
+                    scheme, netloc, self.per_host, self.timeout, allow_private=self.allow_private
+                )
+            return pool
+
+    def check(self, urls):
+        """Checks every distinct URL in `urls` and returns a dict of URL -> result."""
+        unique = list(dict.fromkeys(url for url in urls if url))
+        cached = self.cache.get_many(unique)
+        now = time.time()
+
+        results = {}
+        stale = []
+        for url in unique:
+            entry = cached.get(url)
+            if entry and now - entry['checked_at'] < self.cache_ttl:
+                results[url] = entry
+            else:
+                stale.append((url, entry))
+
+        with tracing.span('images', 'check', items=len(unique), cached=len(results)):
+            fetched = list(self.executor.map(self._check_one, *zip(*stale))) if stale else []
+        results.update((result['url'], result) for result in fetched)
+        self.cache.put_many(result for result in fetched if result['problem'] != 'unreachable')
+        return results
+
+    def _check_one(self, url, cached=None):
+        headers = {'User-Agent': USER_AGENT, 'Range': f'bytes=0-{HEAD_BYTES - 1}'}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        elif cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        result = {'url': url, 'checked_at': time.time()}
+        try:
+            status, response_headers, body, final_url = self._get(url, headers, HEAD_BYTES)
+        except BlockedAddressError as e:
+            return dict(result, status=None, problem='broken', error=str(e))
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            return dict(result, status=None, problem='unreachable', error=str(e) or type(e).__name__)
+
+        if status == 304 and cached:
+            return dict(cached, checked_at=result['checked_at'])
+
+        result.update(
+            status=status,
+            content_type=(response_headers.get('Content-Type') or '').split(';')[0].strip().lower(),
+            etag=response_headers.get('ETag'),
+            last_modified=response_headers.get('Last-Modified'),
+        )
+        if status in (408, 429) or status >= 500:
+            return dict(result, problem='unreachable', error=f'HTTP {status}')
+        if status >= 400:
+            return dict(result, problem='broken', error=f'HTTP {status}')
+
+        image_format = sniff_format(body)
+        size = image_size(image_format, body)
+        if image_format == 'jpeg' and size is None and status == 206:
+            # The frame header is past the first range (e.g. after EXIF data); fetch a longer one
+            try:
+                headers = {'User-Agent': USER_AGENT, 'Range': f'bytes=0-{JPEG_SCAN_BYTES - 1}'}
+                _, _, body, _ = self._get(final_url, headers, JPEG_SCAN_BYTES)
+                size = image_size(image_format, body)
+            except (http.client.HTTPException, OSError, ValueError):
+                pass
+
+        result.update(format=image_format, width=size[0] if size else None, height=size[1] if size else None)
+        if image_format not in SUPPORTED_FORMATS:
+            result['problem'] = 'wrong_type'
+        elif size and min(size) < MIN_IMAGE_SIZE:
+            result['problem'] = 'too_small'
+        else:
+            result['problem'] = None
+        return result
+
+    def _get(self, url, headers, read_limit):
+        """GET following redirects; returns (status, headers, body, final URL)."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                raise ValueError(f'Unsupported image URL: {url}')
+            path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+            status, response_headers, body = self._pool(parts.scheme, parts.netloc).request(path, headers, read_limit)
+            location = response_headers.get('Location')
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            return status, response_headers, body, url
+        raise ValueError(f'Too many redirects: {url}')
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+
+
+_default_validator = None
+_default_lock = threading.Lock()
+
+
+def get_validator():
+    """The process-wide validator, created on first use."""
+    global _default_validator
+    with _default_lock:
+        if _default_validator is None:
+            _default_validator = ImageValidator()
+        return _default_validator
+
+
+def image_urls(product):
+    """The image URLs of a product: imageLink first, then additionalImageLinks."""
+    urls = [product['imageLink']] if product.get('imageLink') else []
+    urls.extend(url for url in product.get('additionalImageLinks') or () if url)
+    return urls
+
+
+# Validator problem -> issue code, for imageLink and for additionalImageLinks
+MAIN_IMAGE_CODES = {'broken': 'image_link_broken', 'wrong_type': 'image_wrong_type', 'too_small': 'image_too_small'}
+ADDITIONAL_IMAGE_CODES = {
+    'broken': 'additional_image_link_broken',
+    'wrong_type': 'additional_image_wrong_type',
+    'too_small': 'additional_image_too_small',
+}
+
+
+def image_issues(product, checks):
+    """Returns (code, url) for each IMAGE_CHECKS issue of a product, given check results by URL.
+
+    Additional images report each kind of problem once, with the first failing URL.
+    """
+    issues = []
+    main = checks.get(product.get('imageLink'))
+    if main and main['problem'] in MAIN_IMAGE_CODES:
+        issues.append((MAIN_IMAGE_CODES[main['problem']], main['url']))
+    seen = set()
+    for url in product.get('additionalImageLinks') or ():
+        problem = (checks.get(url) or {}).get('problem')
+        if problem in ADDITIONAL_IMAGE_CODES and problem not in seen:
+            seen.add(problem)
+            issues.append((ADDITIONAL_IMAGE_CODES[problem], url))
+    return issues
+
+
+def check_results(results, products, validator=None):
+    """Adds image issues to analyze_product results of the matching `products`."""
+    products = list(products)
+    checks = (validator or get_validator()).check(url for product in products for url in image_urls(product))
+    by_id = {product.get('id'): product for product in products}
+    for result in results:
+        product = by_id.get(result['product_id'])
+        if product is not None:
+            analyzer.add_check_issues(result, [code for code, _ in image_issues(product, checks)], IMAGE_CHECKS)
+    return results
+
+
+def check_catalog(products, validator=None, progress=None, batch_size=CATALOG_BATCH_SIZE):
+    """Checks the images of every product in a stream and returns a summary report.
+
+    Products are handled in batches, so memory stays bounded for any catalog
+    size; `progress` (a jobs.JobProgress) is told about each checked product.
+    """
+    validator = validator or get_validator()
+    report = {
+        'products_checked': 0,
+        'products_with_issues': 0,
+        'images_checked': 0,
+        'images_unreachable': 0,
+        'issues': {},
+        'examples': [],
+    }
+    products = iter(products)
+    while True:
+        batch = list(islice(products, batch_size))
+        if not batch:
+            break
+        checks = validator.check(url for product in batch for url in image_urls(product))
+        report['images_checked'] += len(checks)
+        report['images_unreachable'] += sum(1 for check in checks.values() if check['problem'] == 'unreachable')
+        for product in batch:
+            product_issues = image_issues(product, checks)
+            report['products_checked'] += 1
+            if product_issues:
+                report['products_with_issues'] += 1
+            for code, url in product_issues:
+                report['issues'][code] = report['issues'].get(code, 0) + 1
+                if len(report['examples']) < REPORT_SAMPLE_SIZE:
+                    report['examples'].append({'product_id': product.get('id'), 'code': code, 'url': url})
+        if progress:
+            progress.product_analyzed(len(batch))
+    return report
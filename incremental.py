@@ -0,0 +1,516 @@
+import hashlib
+import json
+import time
+import uuid
+from array import array
+from itertools import islice
+
+import analyzer
+import issue_index
+import storage
+import tracing
+
+DB_NAME = 'analysis.sqlite'
+
+# Statuses and products are looked up and written in chunks of this size
+CHUNK_SIZE = 500
+
+# Memoized results not produced or used again within this many seconds are dropped
+RESULT_MAX_AGE = 30 * 86400
+
+# A used result's age is reset at most this often, so cache hits rarely write
+RESULT_TOUCH_INTERVAL = 86400
+
+# Sort orders accepted by page_products / iter_indexed_products
+PRODUCT_SORTS = {
+    '-issues': 'issues_count DESC, product_id',
+    'issues': 'issues_count ASC, product_id',
+    'status': 'status_rank DESC, issues_count DESC, product_id',
+    'title': 'title, product_id',
+}
+DEFAULT_PRODUCT_SORT = '-issues'
+
+# Rank of a product's overall status for sorting
+STATUS_RANK = {'good': 0, 'warning': 1, 'critical': 2}
+
+
+def _digest(value):
+    payload = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+# Part of every product fingerprint, so changing a check invalidates old results
+RULES_DIGEST = _digest([analyzer.CHECKS_VERSION, analyzer.PRODUCT_CHECKS])
+
+
+def _status_parts(product_status):
+    if not product_status:
+        return [None, None]
+    return [product_status.get('itemLevelIssues'), product_status.get('destinationStatuses')]
+
+
+def product_fingerprint(product, product_status):
+    """Stable hash of a product's attributes plus its issues and destination statuses."""
+    return _digest([RULES_DIGEST, product, *_status_parts(product_status)])
+
+
+def _result_issues(result):
+    return [issue for severity_issues in result['issues'].values() for issue in severity_issues]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class AnalysisStore:
+    """SQLite store of analysis results keyed by content fingerprints, and of per-product account counters."""
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS product_results (
+                    fingerprint TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS status_counts (
+                    merchant_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    issues INTEGER NOT NULL,
+                    disapproved INTEGER NOT NULL,
+                    run_id TEXT NOT NULL,
+                    PRIMARY KEY (merchant_id, product_id)
+                );
+                CREATE TABLE IF NOT EXISTS account_totals (
+                    merchant_id TEXT PRIMARY KEY,
+                    products INTEGER NOT NULL,
+                    issues INTEGER NOT NULL,
+                    disapproved INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS status_passes (
+                    merchant_id TEXT PRIMARY KEY,
+                    run_id TEXT NOT NULL,
+                    started_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS product_index (
+                    merchant_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    status_rank INTEGER NOT NULL,
+                    issues_count INTEGER NOT NULL,
+                    result TEXT NOT NULL,
+                    run_id TEXT NOT NULL,
+                    PRIMARY KEY (merchant_id, product_id)
+                );
+                CREATE INDEX IF NOT EXISTS product_index_issues ON product_index (merchant_id, issues_count);
+                CREATE INDEX IF NOT EXISTS product_index_status ON product_index (merchant_id, status, issues_count);
+                CREATE TABLE IF NOT EXISTS product_index_codes (
+                    merchant_id TEXT NOT NULL,
+                    code TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    PRIMARY KEY (merchant_id, code, product_id)
+                );
+                CREATE TABLE IF NOT EXISTS issue_counts (
+                    merchant_id TEXT NOT NULL,
+                    code TEXT NOT NULL,
+                    attribute TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    severity TEXT NOT NULL,
+                    products INTEGER NOT NULL,
+                    PRIMARY KEY (merchant_id, code, attribute, destination, severity)
+                );
+                CREATE TABLE IF NOT EXISTS issue_postings (
+                    merchant_id TEXT NOT NULL,
+                    code TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    product_rows BLOB NOT NULL,
+                    PRIMARY KEY (merchant_id, code, destination)
+                );
+                CREATE TABLE IF NOT EXISTS issue_product_ids (
+                    merchant_id TEXT NOT NULL,
+                    chunk INTEGER NOT NULL,
+                    product_ids TEXT NOT NULL,
+                    PRIMARY KEY (merchant_id, chunk)
+                );
+            ''')
+        self.prune()
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    @tracing.traced('analysis', 'incremental.analyze_products', items=len)
+    def analyze_products(self, products, product_statuses):
+        """Like analyzer.analyze_products, but only re-analyzes products whose fingerprint changed."""
+        if not isinstance(product_statuses, analyzer.ProductStatusIndex):
+            product_statuses = analyzer.ProductStatusIndex(product_statuses)
+
+        connection = self._connection()
+        results = []
+        for chunk in _chunks(products, CHUNK_SIZE):
+            statuses = [product_statuses.get(product.get('id')) for product in chunk]
+            fingerprints = [product_fingerprint(product, status) for product, status in zip(chunk, statuses)]
+            placeholders = ','.join('?' * len(fingerprints))
+            cached = {
+                fingerprint: (result, updated_at)
+                for fingerprint, result, updated_at in connection.execute(
+                    f'SELECT fingerprint, result, updated_at FROM product_results WHERE fingerprint IN ({placeholders})',
+                    fingerprints
+                )
+            }
+
+            now = time.time()
+            fresh = []
+            used = []
+            for product, status, fingerprint in zip(chunk, statuses, fingerprints):
+                if fingerprint in cached:
+                    result, updated_at = cached[fingerprint]
+                    results.append(json.loads(result))
+                    # A result still in use must not be pruned
+                    if updated_at < now - RESULT_TOUCH_INTERVAL:
+                        used.append((now, fingerprint))
+                    continue
+                result = analyzer.analyze_product(product, status)
+                fresh.append((fingerprint, json.dumps(result), now))
+                results.append(result)
+
+            if fresh or used:
+                with connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO product_results (fingerprint, result, updated_at) VALUES (?, ?, ?)',
+                        fresh
+                    )
+                    connection.executemany('UPDATE product_results SET updated_at = ? WHERE fingerprint = ?', used)
+        return results
+
+    @tracing.traced('storage', items=lambda counts: counts[0])
+    def update_account_stats(self, merchant_id, product_statuses):
+        """Applies one full pass of product statuses to the merchant's counters.
+
+        A status is reduced to its issue and disapproval counts, which are
+        cheaper to take than a hash of it; only products whose counts changed
+        since the previous pass are written again, their difference is applied
+        to the stored totals, and products missing from this pass are
+        subtracted at the end.
+
+        Each chunk reads and writes its rows and the totals in one write
+        transaction. A newer pass over the same merchant takes over: an older
+        one that is still running stops at its next chunk and leaves the
+        removal of missing products to the newer one.
+        Returns (products_count, issues_count, disapproved_count).
+        """
+        connection = self._connection()
+        run_id = uuid.uuid4().hex
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO status_passes (merchant_id, run_id, started_at) VALUES (?, ?, ?)',
+                (merchant_id, run_id, time.time())
+            )
+
+        for chunk in _chunks(product_statuses, CHUNK_SIZE):
+            counted = {
+                status.get('productId'): analyzer.status_counts(status)
+                for status in chunk
+                if status.get('productId') is not None
+            }
+            if not counted:
+                continue
+            placeholders = ','.join('?' * len(counted))
+
+            with connection:
+                # IMMEDIATE takes the write lock before the rows and totals are read
+                connection.execute('BEGIN IMMEDIATE')
+                if not self._owns_pass(connection, merchant_id, run_id):
+                    return self._load_totals(connection, merchant_id)
+                totals = list(self._load_totals(connection, merchant_id))
+                existing = {
+                    row[0]: row[1:]
+                    for row in connection.execute(
+                        f'SELECT product_id, issues, disapproved FROM status_counts '
+                        f'WHERE merchant_id = ? AND product_id IN ({placeholders})',
+                        [merchant_id, *counted]
+                    )
+                }
+
+                changed = []
+                unchanged = []
+                for product_id, (issues, disapproved) in counted.items():
+                    previous = existing.get(product_id)
+                    if previous == (issues, disapproved):
+                        unchanged.append((run_id, merchant_id, product_id))
+                        continue
+
+                    if previous:
+                        totals[1] += issues - previous[0]
+                        totals[2] += disapproved - previous[1]
+                    else:
+                        totals[0] += 1
+                        totals[1] += issues
+                        totals[2] += disapproved
+                    changed.append((merchant_id, product_id, issues, disapproved, run_id))
+
+                # Rows and totals are written together so an interrupted pass stays consistent
+                connection.executemany(
+                    'UPDATE status_counts SET run_id = ? WHERE merchant_id = ? AND product_id = ?',
+                    unchanged
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO status_counts '
+                    '(merchant_id, product_id, issues, disapproved, run_id) VALUES (?, ?, ?, ?, ?)',
+                    changed
+                )
+                self._save_totals(connection, merchant_id, totals)
+
+        # Products not seen in this pass were removed from the catalog
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            totals = list(self._load_totals(connection, merchant_id))
+            if not self._owns_pass(connection, merchant_id, run_id):
+                return tuple(totals)
+            removed = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(issues), 0), COALESCE(SUM(disapproved), 0) '
+                'FROM status_counts WHERE merchant_id = ? AND run_id != ?',
+                (merchant_id, run_id)
+            ).fetchone()
+            connection.execute(
+                'DELETE FROM status_counts WHERE merchant_id = ? AND run_id != ?',
+                (merchant_id, run_id)
+            )
+            totals = [total - gone for total, gone in zip(totals, removed)]
+            self._save_totals(connection, merchant_id, totals)
+            connection.execute('DELETE FROM status_passes WHERE merchant_id = ?', (merchant_id,))
+
+        return tuple(totals)
+
+    def _owns_pass(self, connection, merchant_id, run_id):
+        row = connection.execute('SELECT run_id FROM status_passes WHERE merchant_id = ?', (merchant_id,)).fetchone()
+        return row is not None and row[0] == run_id
+
+    def _load_totals(self, connection, merchant_id):
+        return tuple(connection.execute(
+            'SELECT products, issues, disapproved FROM account_totals WHERE merchant_id = ?',
+            (merchant_id,)
+        ).fetchone() or (0, 0, 0))
+
+    def products_count(self, merchant_id):
+        """Returns how many products the last pass over the merchant saw, or None."""
+        row = self._connection().execute(
+            'SELECT products FROM account_totals WHERE merchant_id = ?',
+            (merchant_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @tracing.traced('storage')
+    def index_products(self, merchant_id, results):
+        """Replaces the merchant's browsable product analyses with `results`.
+
+        `results` is an iterable of analyzer.analyze_product results and is
+        written in chunks, so it can be a stream over the whole catalog.
+        """
+        connection = self._connection()
+        run_id = uuid.uuid4().hex
+        for chunk in _chunks(results, CHUNK_SIZE):
+            rows = []
+            codes = []
+            for result in chunk:
+                issues = _result_issues(result)
+                rows.append((
+                    merchant_id,
+                    result['product_id'],
+                    result.get('title') or '',
+                    result['status'],
+                    STATUS_RANK.get(result['status'], 0),
+                    len(issues),
+                    json.dumps(result),
+                    run_id
+                ))
+                codes.extend({(merchant_id, issue['code'], result['product_id']) for issue in issues})
+
+            with connection:
+                # Codes of re-indexed products are rewritten from scratch
+                connection.execute(
+                    f'DELETE FROM product_index_codes WHERE merchant_id = ? AND product_id IN ({",".join("?" * len(rows))})',
+                    [merchant_id, *(row[1] for row in rows)]
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO product_index '
+                    '(merchant_id, product_id, title, status, status_rank, issues_count, result, run_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+                connection.executemany(
+                    'INSERT OR IGNORE INTO product_index_codes (merchant_id, code, product_id) VALUES (?, ?, ?)',
+                    codes
+                )
+
+        # Products left over from an earlier run are no longer part of the analysis
+        with connection:
+            connection.execute(
+                'DELETE FROM product_index_codes WHERE merchant_id = ? AND product_id IN '
+                '(SELECT product_id FROM product_index WHERE merchant_id = ? AND run_id != ?)',
+                (merchant_id, merchant_id, run_id)
+            )
+            connection.execute(
+                'DELETE FROM product_index WHERE merchant_id = ? AND run_id != ?',
+                (merchant_id, run_id)
+            )
+
+    @tracing.traced('storage')
+    def add_product_issues(self, merchant_id, codes_by_product, checks):
+        """Adds issues found at the end of a full pass (e.g. catalog-wide duplicates) to indexed products.
+
+        `codes_by_product` maps product IDs to codes of `checks`, as taken by analyzer.add_check_issues.
+        """
+        connection = self._connection()
+        for chunk in _chunks(codes_by_product.items(), CHUNK_SIZE):
+            chunk = dict(chunk)
+            with connection:
+                found = connection.execute(
+                    f'SELECT product_id, result FROM product_index '
+                    f'WHERE merchant_id = ? AND product_id IN ({",".join("?" * len(chunk))})',
+                    [merchant_id, *chunk]
+                ).fetchall()
+                rows = []
+                codes = []
+                for product_id, result in found:
+                    result = analyzer.add_check_issues(json.loads(result), chunk[product_id], checks)
+                    rows.append((
+                        result['status'],
+                        STATUS_RANK.get(result['status'], 0),
+                        len(_result_issues(result)),
+                        json.dumps(result),
+                        merchant_id,
+                        product_id
+                    ))
+                    codes.extend((merchant_id, code, product_id) for code in chunk[product_id])
+                connection.executemany(
+                    'UPDATE product_index SET status = ?, status_rank = ?, issues_count = ?, result = ? '
+                    'WHERE merchant_id = ? AND product_id = ?',
+                    rows
+                )
+                connection.executemany(
+                    'INSERT OR IGNORE INTO product_index_codes (merchant_id, code, product_id) VALUES (?, ?, ?)',
+                    codes
+                )
+
+    def _product_query(self, columns, merchant_id, status=None, code=None):
+        query = f'SELECT {columns} FROM product_index p WHERE p.merchant_id = ?'
+        params = [merchant_id]
+        if status:
+            query += ' AND p.status = ?'
+            params.append(status)
+        if code:
+            query += (
+                ' AND EXISTS (SELECT 1 FROM product_index_codes c '
+                'WHERE c.merchant_id = p.merchant_id AND c.code = ? AND c.product_id = p.product_id)'
+            )
+            params.append(code)
+        return query, params
+
+    def page_products(self, merchant_id, status=None, code=None, sort=DEFAULT_PRODUCT_SORT, offset=0, limit=50):
+        """Returns (total, results) for one page of indexed product analyses.
+
+        Filters by overall `status` and by issue `code`; `sort` is a key of PRODUCT_SORTS.
+        """
+        connection = self._connection()
+        query, params = self._product_query('COUNT(*)', merchant_id, status, code)
+        total = connection.execute(query, params).fetchone()[0]
+
+        query, params = self._product_query('p.result', merchant_id, status, code)
+        order = PRODUCT_SORTS.get(sort, PRODUCT_SORTS[DEFAULT_PRODUCT_SORT])
+        rows = connection.execute(f'{query} ORDER BY {order} LIMIT ? OFFSET ?', [*params, limit, offset])
+        return total, [json.loads(result) for (result,) in rows]
+
+    def iter_indexed_products(self, merchant_id, status=None, code=None, sort=DEFAULT_PRODUCT_SORT):
+        """Streams every indexed product analysis matching the filters, without loading them all."""
+        query, params = self._product_query('p.result', merchant_id, status, code)
+        order = PRODUCT_SORTS.get(sort, PRODUCT_SORTS[DEFAULT_PRODUCT_SORT])
+        for (result,) in self._connection().execute(f'{query} ORDER BY {order}', params):
+            yield json.loads(result)
+
+    def issue_codes(self, merchant_id):
+        """Returns (code, products_count) for issue codes present in the merchant's index."""
+        return list(self._connection().execute(
+            'SELECT code, COUNT(*) FROM product_index_codes WHERE merchant_id = ? GROUP BY code ORDER BY COUNT(*) DESC',
+            (merchant_id,)
+        ))
+
+    @tracing.traced('storage')
+    def save_issue_histogram(self, merchant_id, histogram):
+        """Replaces the merchant's issue counters and inverted index with a finished IssueHistogram."""
+        connection = self._connection()
+        with connection:
+            for table in ('issue_counts', 'issue_postings', 'issue_product_ids'):
+                connection.execute(f'DELETE FROM {table} WHERE merchant_id = ?', (merchant_id,))
+            connection.executemany(
+                'INSERT INTO issue_counts (merchant_id, code, attribute, destination, severity, products) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(merchant_id, *key, products) for key, products in histogram.counts.items()]
+            )
+            connection.executemany(
+                'INSERT INTO issue_postings (merchant_id, code, destination, product_rows) VALUES (?, ?, ?, ?)',
+                [(merchant_id, code, destination, rows.tobytes()) for (code, destination), rows in histogram.postings.items()]
+            )
+            connection.executemany(
+                'INSERT INTO issue_product_ids (merchant_id, chunk, product_ids) VALUES (?, ?, ?)',
+                [(merchant_id, index, ids) for index, ids in enumerate(histogram.id_chunks)]
+            )
+
+    def issue_histogram(self, merchant_id):
+        """Issue counters of the last full pass, the most widespread issues first."""
+        cursor = self._connection().execute(
+            'SELECT code, attribute, destination, severity, products FROM issue_counts '
+            'WHERE merchant_id = ? ORDER BY products DESC, code, attribute, destination, severity',
+            (merchant_id,)
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def issue_products(self, merchant_id, code, destination=None, offset=0, limit=50):
+        """Returns (total, product IDs) for a page of the products with issue `code`.
+
+        Reads the inverted index of the last full pass: the sorted rows of the
+        products with the issue, in `destination` or in any destination, and
+        only the chunks of product IDs that the page needs. Issues without a
+        destination (the analyzer's checks) count in every destination.
+        """
+        connection = self._connection()
+        query = 'SELECT product_rows FROM issue_postings WHERE merchant_id = ? AND code = ?'
+        params = [merchant_id, code]
+        if destination is not None:
+            query += " AND destination IN (?, '')"
+            params.append(destination)
+        postings = []
+        for (blob,) in connection.execute(query, params):
+            rows = array('I')
+            rows.frombytes(blob)
+            postings.append(rows)
+        rows = postings[0] if len(postings) == 1 else sorted(set().union(*postings))
+
+        def chunk(index):
+            found = connection.execute(
+                'SELECT product_ids FROM issue_product_ids WHERE merchant_id = ? AND chunk = ?',
+                (merchant_id, index)
+            ).fetchone()
+            return found[0].split('\n') if found else []
+
+        return len(rows), issue_index.product_ids(rows[offset:offset + limit], chunk)
+
+    def _save_totals(self, connection, merchant_id, totals):
+        connection.execute(
+            'INSERT OR REPLACE INTO account_totals (merchant_id, products, issues, disapproved) VALUES (?, ?, ?, ?)',
+            (merchant_id, *totals)
+        )
+
+    def prune(self, max_age=RESULT_MAX_AGE):
+        """Drops memoized product results not produced or used within `max_age` seconds."""
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM product_results WHERE updated_at < ?', (time.time() - max_age,))
+
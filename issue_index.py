@@ -0,0 +1,152 @@
+from array import array
+from bisect import insort
+
+import analyzer
+
+# Product IDs are stored in chunks of this many rows, so a lookup only reads the chunks it needs
+ID_CHUNK_SIZE = 4096
+
+
+class IssueHistogram:
+    """Issue counters and an issue -> products inverted index, built in one pass over the catalog.
+
+    Each product is added with its status (Merchant Center issues per
+    destination) and its analyzer result, whose checks (PRODUCT_CHECKS and
+    the like) apply in every destination and are kept under destination ''.
+    Products are numbered in the order they are seen. Counters are keyed by
+    (code, attribute, destination, severity) and count products, so an issue
+    reported twice for one product and destination is counted once. For every
+    (code, destination) the rows of the affected products are kept as a sorted
+    array of 32-bit integers, and product IDs are packed in chunks of
+    ID_CHUNK_SIZE rows; a million products with a few issues each take some
+    tens of megabytes.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.postings = {}
+        self.destinations = {}
+        self.products_count = 0
+        self.disapproved_count = 0
+        self.id_chunks = []
+        self._pending_ids = []
+
+    def add(self, status, result=None):
+        """Adds a product as the next row, from its status and/or its analyzer.analyze_product result."""
+        status = status or {}
+        row = self.products_count
+        self.products_count += 1
+        self._pending_ids.append(status.get('productId') or (result or {}).get('product_id') or '')
+        if len(self._pending_ids) == ID_CHUNK_SIZE:
+            self.id_chunks.append('\n'.join(self._pending_ids))
+            self._pending_ids = []
+
+        keys = set()
+        for issue in status.get('itemLevelIssues') or ():
+            keys.add((
+                issue.get('code', 'unknown'),
+                analyzer.issue_attribute(issue) or '',
+                issue.get('destination') or '',
+                analyzer.issue_severity(issue),
+            ))
+        if result:
+            # Status issues are in the result too; only the issues of the checks are taken from it
+            status_codes = {key[0] for key in keys}
+            for severity, issues in result['issues'].items():
+                for issue in issues:
+                    if issue['code'] not in status_codes:
+                        keys.add((issue['code'], issue.get('attribute') or '', '', severity))
+        postings = set()
+        for key in keys:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            postings.add((key[0], key[2]))
+        for key in postings:
+            rows = self.postings.get(key)
+            if rows is None:
+                rows = self.postings[key] = array('I')
+            rows.append(row)
+
+        disapproved = False
+        for dest_status in status.get('destinationStatuses') or ():
+            destination = self.destinations.setdefault(dest_status.get('destination') or '', {})
+            state = dest_status.get('status') or 'unknown'
+            destination[state] = destination.get(state, 0) + 1
+            disapproved = disapproved or state == 'disapproved'
+        self.disapproved_count += disapproved
+
+    def add_check_issues(self, codes_by_product, checks):
+        """Counts issues found at the end of the pass, such as catalog-wide duplicates.
+
+        `codes_by_product` maps product IDs to codes of `checks`, as taken by
+        analyzer.add_check_issues; they count in every destination. Finds the
+        rows with one scan of the product IDs.
+        """
+        if not codes_by_product:
+            return
+        for index in range(len(self.id_chunks) + bool(self._pending_ids)):
+            for position, product_id in enumerate(self._chunk(index)):
+                codes = codes_by_product.get(product_id)
+                if not codes:
+                    continue
+                row = index * ID_CHUNK_SIZE + position
+                for code in set(codes):
+                    severity, _, attribute = checks[code]
+                    key = (code, attribute, '', severity)
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                    rows = self.postings.get((code, ''))
+                    if rows is None:
+                        rows = self.postings[(code, '')] = array('I')
+                    insort(rows, row)
+
+    def finish(self):
+        """Packs the last, partial chunk of product IDs; call once the pass is over."""
+        if self._pending_ids:
+            self.id_chunks.append('\n'.join(self._pending_ids))
+            self._pending_ids = []
+        return self
+
+    def rows(self, code, destination=None):
+        """Rows of the products with issue `code`, in `destination` or in any destination, in order.
+
+        Issues without a destination (the analyzer's checks) count in every destination.
+        """
+        if destination is not None:
+            keys = {(code, destination), (code, '')}
+        else:
+            keys = {key for key in self.postings if key[0] == code}
+        matching = [self.postings[key] for key in keys if key in self.postings]
+        if not matching:
+            return array('I')
+        if len(matching) == 1:
+            return matching[0]
+        return array('I', sorted(set().union(*matching)))
+
+    def products(self, code, destination=None):
+        """Product IDs with issue `code` (in `destination`, if given)."""
+        return product_ids(self.rows(code, destination), self._chunk)
+
+    def _chunk(self, index):
+        if index < len(self.id_chunks):
+            return self.id_chunks[index].split('\n')
+        return self._pending_ids
+
+    def histogram(self):
+        """Counters as dicts, the most widespread issues first."""
+        return [
+            {'code': code, 'attribute': attribute, 'destination': destination, 'severity': severity, 'products': products}
+            for (code, attribute, destination, severity), products in sorted(
+                self.counts.items(), key=lambda item: (-item[1], item[0])
+            )
+        ]
+
+
+def product_ids(rows, chunk):
+    """Maps sorted rows to product IDs; `chunk(index)` returns the IDs of one chunk of rows as a list."""
+    ids = []
+    loaded_index, loaded = None, None
+    for row in rows:
+        index, position = divmod(row, ID_CHUNK_SIZE)
+        if index != loaded_index:
+            loaded_index, loaded = index, chunk(index)
+        ids.append(loaded[position])
+    return ids
@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+import tracing
+
+DB_NAME = 'jobs.sqlite'
+
+# Analysis threads per gunicorn worker, separate from the threads serving requests
+JOB_WORKERS = int(os.environ.get('ANALYSIS_JOB_WORKERS', '2'))
+
+# Progress is written to SQLite at most this often
+PROGRESS_INTERVAL = 1.0
+
+# A job without a progress update or heartbeat for this long is treated as lost (e.g. its worker was restarted)
+JOB_STALE_AFTER = 600
+
+# How often a runner refreshes the heartbeat of its queued and running jobs
+HEARTBEAT_INTERVAL = 60
+
+# Finished jobs are kept this long so their results can still be rendered
+JOB_MAX_AGE = 86400
+
+ACTIVE_STATES = ('queued', 'running')
+
+
+class JobProgress:
+    """Progress of a running job, handed to the job function.
+
+    Counters live in memory and are flushed to the job store at most once per
+    PROGRESS_INTERVAL, so reporting progress per product stays cheap.
+    """
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.pages_fetched = 0
+        self.products_analyzed = 0
+        self.products_expected = None
+        self._flushed_at = 0
+
+    def expect(self, products):
+        """Sets how many products the job is expected to analyze, used for the ETA."""
+        self.products_expected = products
+        self.flush()
+
+    def page_fetched(self, count=1):
+        self.pages_fetched += count
+        self._maybe_flush()
+
+    def product_analyzed(self, count=1):
+        self.products_analyzed += count
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed_at >= PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Writes the current counters to the job store."""
+        self._flushed_at = time.time()
+        self.store.update(
+            self.job_id,
+            pages_fetched=self.pages_fetched,
+            products_analyzed=self.products_analyzed,
+            products_expected=self.products_expected
+        )
+
+
+class JobStore:
+    """Job state in SQLite, shared by every gunicorn worker on the instance."""
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    merchant_id TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    updated_at REAL NOT NULL,
+                    pages_fetched INTEGER NOT NULL DEFAULT 0,
+                    products_analyzed INTEGER NOT NULL DEFAULT 0,
+                    products_expected INTEGER,
+                    result TEXT,
+                    error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS jobs_merchant ON jobs (merchant_id, state);
+            ''')
+        self.prune()
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    def create(self, merchant_id):
+        """Creates a queued job, unless the merchant already has an active one.
+
+        Returns (job_id, created).
+        """
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            # IMMEDIATE takes the write lock up front so two workers cannot both create a job
+            connection.execute('BEGIN IMMEDIATE')
+            placeholders = ','.join('?' * len(ACTIVE_STATES))
+            active = connection.execute(
+                f'SELECT id FROM jobs WHERE merchant_id = ? AND state IN ({placeholders}) AND updated_at > ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (merchant_id, *ACTIVE_STATES, now - JOB_STALE_AFTER)
+            ).fetchone()
+            if active:
+                return active[0], False
+
+            job_id = uuid.uuid4().hex
+            connection.execute(
+                'INSERT INTO jobs (id, merchant_id, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, merchant_id, 'queued', now, now)
+            )
+        return job_id, True
+
+    def update(self, job_id, **fields):
+        """Updates job columns and its heartbeat."""
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        connection = self._connection()
+        with connection:
+            connection.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def touch(self, job_ids):
+        """Refreshes the heartbeat of jobs that are still queued or running."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                f'UPDATE jobs SET updated_at = ? WHERE state IN ({",".join("?" * len(ACTIVE_STATES))}) '
+                f'AND id IN ({",".join("?" * len(job_ids))})',
+                (time.time(), *ACTIVE_STATES, *job_ids)
+            )
+
+    def get(self, job_id):
+        """Returns a job as a dict with an ETA, or None if there is no such job."""
+        cursor = self._connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        job = dict(zip([column[0] for column in cursor.description], row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+
+        now = time.time()
+        if job['state'] in ACTIVE_STATES and now - job['updated_at'] > JOB_STALE_AFTER:
+            job['state'] = 'failed'
+            job['error'] = 'Analysis was interrupted'
+
+        job['eta'] = None
+        analyzed, expected = job['products_analyzed'], job['products_expected']
+        if job['state'] == 'running' and job['started_at'] and analyzed and expected:
+            elapsed = now - job['started_at']
+            job['eta'] = max(0.0, elapsed / analyzed * (expected - analyzed))
+        return job
+
+    def prune(self, max_age=JOB_MAX_AGE):
+        """Drops jobs created more than `max_age` seconds ago."""
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM jobs WHERE created_at < ?', (time.time() - max_age,))
+
+
+class JobRunner:
+    """Runs jobs on a bounded thread pool and records their state in a JobStore.
+
+    While the process lives, a heartbeat thread keeps its queued and running
+    jobs alive, so neither a busy pool nor a long step without progress makes
+    them look lost; the jobs of a worker that died stop getting heartbeats.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis-job')
+        self.heartbeat_interval = heartbeat_interval
+        self.active = set()
+        self.lock = threading.Lock()
+        self._heartbeat = None
+
+    def submit(self, merchant_id, fn):
+        """Queues `fn(progress)` for a merchant and returns the job ID.
+
+        A merchant has at most one active job; submitting again returns that job,
+        so one large account cannot fill the pool on its own.
+        """
+        return self.start(merchant_id, fn)[0]
+
+    def start(self, merchant_id, fn):
+        """Like submit(), but returns (job_id, created).
+
+        `created` is False when the merchant's active job was returned and `fn`
+        will never run, so the caller can clean up what it prepared for it.
+        """
+        job_id, created = self.store.create(merchant_id)
+        if created:
+            with self.lock:
+                self.active.add(job_id)
+                # Started with the first job, so importing the app starts no threads
+                if self._heartbeat is None:
+                    self._heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                    self._heartbeat.start()
+            self.executor.submit(self._run, job_id, fn)
+        return job_id, created
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.lock:
+                active = list(self.active)
+            try:
+                self.store.touch(active)
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+
+    def _run(self, job_id, fn):
+        with tracing.trace('job', job_id=job_id):
+            try:
+                self.store.update(job_id, state='running', started_at=time.time())
+                progress = JobProgress(self.store, job_id)
+                try:
+                    result = fn(progress)
+                    progress.flush()
+                    self.store.update(job_id, state='done', finished_at=time.time(), result=json.dumps(result))
+                except Exception as e:
+                    print(f"Analysis job {job_id} failed: {e}")
+                    self.store.update(job_id, state='failed', finished_at=time.time(), error=str(e))
+            finally:
+                with self.lock:
+                    self.active.discard(job_id)
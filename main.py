@@ -1,6 +1,9 @@
 import os
 import logging
 from flask import Flask, render_template, redirect, url_for, session, flash, request
+from session_file import create_session_interface
+import csrf
+import tracing
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,18 +15,28 @@ app = Flask(__name__)
 # Configure secret key
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
 
-# Simple session configuration - use app engine default storage
-app.config['SESSION_TYPE'] = 'cookie'
+# Server-side sessions: the cookie only carries an opaque session ID
+app.config['SESSION_TYPE'] = os.environ.get('SESSION_TYPE', 'sqlite')  # 'sqlite' or 'filesystem'
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400 * 7  # 7 days in seconds
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # no session cookie on cross-site POSTs
+app.session_interface = create_session_interface(app)
+
+# Per-request traces (JSON lines on stderr) and Prometheus metrics at /metrics
+tracing.init_app(app)
+
+# csrf_token() for forms that change data, e.g. on the optimize page
+csrf.init_app(app)
 
 # Try to import modules, log errors if they occur
 try:
     from auth import auth_bp
     from merchant import merchant_bp
+    from supplemental_feed import feeds_bp
     
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(merchant_bp, url_prefix='/merchant')
+    app.register_blueprint(feeds_bp, url_prefix='/feeds')
     logger.info("Blueprints registered successfully")
 except Exception as e:
     logger.error(f"Error registering blueprints: {e}")
@@ -78,6 +91,16 @@ def optimize():
         logger.error(f"Error in optimize route: {e}")
         return f"Error in optimization page: {str(e)}", 500
 
+@app.route('/_ah/warmup')
+def warmup():
+    """App Engine warmup request: load the Google client libraries before traffic arrives."""
+    try:
+        import content_api
+        content_api.warm_up()
+    except Exception as e:
+        logger.error(f"Warmup failed: {e}")
+    return '', 200
+
 @app.errorhandler(500)
 def server_error(e):
     logging.exception('An error occurred during a request.')
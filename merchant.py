@@ -1,12 +1,63 @@
 import os
-from flask import Blueprint, render_template, redirect, url_for, session, request, flash
-from googleapiclient.discovery import build
+from flask import Blueprint, render_template, redirect, url_for, session, request, flash, jsonify
 from googleapiclient.errors import HttpError
 from auth import get_credentials
+import content_api
+import jobs
+import multi_account
+import scheduler
+import storage
 
 # Create Blueprint for Merchant Center routes
 merchant_bp = Blueprint('merchant', __name__)
 
+# Content API accepts at most 1000 entries per custombatch call
+CUSTOMBATCH_MAX_ENTRIES = 1000
+
+# "Analyze all accounts" sweeps run as background jobs; a user has at most one active sweep
+account_job_store = jobs.JobStore(storage.data_path('account_jobs.sqlite'))
+account_job_runner = jobs.JobRunner(account_job_store)
+account_results = multi_account.AccountResultStore()
+
+def sweep_owner(credentials):
+    """Job key of the current user's sweeps, derived from their credentials without exposing them."""
+    return f'accounts:{content_api.credential_key(credentials)}'
+
+def get_accounts_info(service, merchant_ids):
+    """Fetch details of many accounts with accounts.custombatch.
+    
+    Returns a dict of merchant ID -> (account_info, error). A failure on one
+    account, or on a whole chunk, is reported as that account's error.
+    """
+    results = {}
+    for start in range(0, len(merchant_ids), CUSTOMBATCH_MAX_ENTRIES):
+        chunk = merchant_ids[start:start + CUSTOMBATCH_MAX_ENTRIES]
+        entries = [
+            {'batchId': batch_id, 'merchantId': merchant_id, 'accountId': merchant_id, 'method': 'get'}
+            for batch_id, merchant_id in enumerate(chunk)
+        ]
+        
+        try:
+            response = scheduler.execute(service.accounts().custombatch(body={'entries': entries}))
+        except HttpError as e:
+            for merchant_id in chunk:
+                results[merchant_id] = (None, str(e))
+            continue
+        
+        for entry in response.get('entries', []):
+            merchant_id = chunk[entry['batchId']]
+            errors = entry.get('errors')
+            if errors:
+                results[merchant_id] = (None, errors.get('message') or str(errors.get('errors', '')))
+            else:
+                results[merchant_id] = (entry.get('account', {}), None)
+        
+        # Entries missing from the response are reported rather than dropped
+        for merchant_id in chunk:
+            results.setdefault(merchant_id, (None, 'No response for account'))
+    
+    return results
+
 @merchant_bp.route('/accounts')
 def list_accounts():
     """Display list of available Merchant Center accounts."""
@@ -17,41 +68,41 @@ def list_accounts():
     
     try:
         # Create Content API client
-        service = build('content', 'v2.1', credentials=credentials)
+        service = content_api.get_service(credentials)
         
         # Get list of accounts
-        accounts_response = service.accounts().authinfo().execute()
+        accounts_response = scheduler.execute(service.accounts().authinfo())
         
         # Check if accounts exist
         if 'accountIdentifiers' not in accounts_response:
             flash('No Merchant Center accounts found for this Google account.', 'warning')
             return redirect(url_for('index'))
         
-        # Get information about each account
+        # Get information about all accounts in a few batched round trips
+        merchant_ids = [
+            account_id.get('merchantId')
+            for account_id in accounts_response['accountIdentifiers']
+            if account_id.get('merchantId')
+        ]
+        accounts_info = get_accounts_info(service, merchant_ids)
+        
         accounts = []
-        for account_id in accounts_response['accountIdentifiers']:
-            merchant_id = account_id.get('merchantId')
-            if merchant_id:
-                try:
-                    # Get account details
-                    account_info = service.accounts().get(
-                        merchantId=merchant_id,
-                        accountId=merchant_id
-                    ).execute()
-                    
-                    accounts.append({
-                        'id': merchant_id,
-                        'name': account_info.get('name', f'Account {merchant_id}'),
-                        'websiteUrl': account_info.get('websiteUrl', '')
-                    })
-                except HttpError as e:
-                    # If no access to account, add just the ID
-                    accounts.append({
-                        'id': merchant_id,
-                        'name': f'Account {merchant_id}',
-                        'websiteUrl': '',
-                        'error': str(e)
-                    })
+        for merchant_id in merchant_ids:
+            account_info, error = accounts_info[merchant_id]
+            if error is None:
+                accounts.append({
+                    'id': merchant_id,
+                    'name': account_info.get('name', f'Account {merchant_id}'),
+                    'websiteUrl': account_info.get('websiteUrl', '')
+                })
+            else:
+                # If no access to account, add just the ID
+                accounts.append({
+                    'id': merchant_id,
+                    'name': f'Account {merchant_id}',
+                    'websiteUrl': '',
+                    'error': error
+                })
         
         # Display list of accounts
         return render_template('merchant/accounts.html', accounts=accounts)
@@ -70,13 +121,13 @@ def select_account(merchant_id):
     
     try:
         # Create Content API client
-        service = build('content', 'v2.1', credentials=credentials)
+        service = content_api.get_service(credentials)
         
         # Check access to account
-        account_info = service.accounts().get(
+        account_info = scheduler.execute(service.accounts().get(
             merchantId=merchant_id,
             accountId=merchant_id
-        ).execute()
+        ), merchant_id)
         
         # Save selected account info in session
         session['merchant_id'] = merchant_id
@@ -88,3 +139,60 @@ def select_account(merchant_id):
     except HttpError as e:
         flash(f'Error accessing Merchant Center account: {str(e)}', 'error')
         return redirect(url_for('merchant.list_accounts'))
+
+@merchant_bp.route('/accounts/analyze', methods=['POST'])
+def analyze_all_accounts():
+    """Start analyzing every accessible account in the background."""
+    credentials = get_credentials()
+    if not credentials:
+        return redirect(url_for('auth.login'))
+    
+    try:
+        service = content_api.get_service(credentials)
+        accounts = multi_account.discover_accounts(service)
+    except HttpError as e:
+        flash(f'Error accessing Merchant Center accounts: {str(e)}', 'error')
+        return redirect(url_for('merchant.list_accounts'))
+    
+    if not accounts:
+        flash('No Merchant Center accounts found for this Google account.', 'warning')
+        return redirect(url_for('merchant.list_accounts'))
+    
+    job_id = account_job_runner.submit(
+        sweep_owner(credentials),
+        lambda progress: multi_account.analyze_accounts(
+            account_results, progress.job_id, accounts, credentials, progress=progress
+        )
+    )
+    return redirect(url_for('merchant.accounts_dashboard', job=job_id))
+
+@merchant_bp.route('/accounts/dashboard')
+def accounts_dashboard():
+    """Ranked health overview of all accounts, filled in as each account finishes."""
+    credentials = get_credentials()
+    if not credentials:
+        return redirect(url_for('auth.login'))
+    
+    job_id = request.args.get('job')
+    job = account_job_store.get(job_id) if job_id else None
+    if not job or job['merchant_id'] != sweep_owner(credentials):
+        return redirect(url_for('merchant.list_accounts'))
+    
+    return render_template('merchant/dashboard.html', job_id=job_id)
+
+@merchant_bp.route('/accounts/dashboard/<job_id>.json')
+def accounts_dashboard_status(job_id):
+    """Sweep state and the accounts ranked so far, polled by the dashboard."""
+    credentials = get_credentials()
+    job = account_job_store.get(job_id) if credentials else None
+    if not job or job['merchant_id'] != sweep_owner(credentials):
+        return jsonify({'error': 'Job not found'}), 404
+    
+    accounts = account_results.ranked(job_id)
+    return jsonify({
+        'state': job['state'],
+        'error': job['error'],
+        'accounts_total': len(accounts),
+        'accounts_finished': sum(1 for account in accounts if account['state'] != 'pending'),
+        'accounts': accounts
+    })
@@ -1,16 +1,13 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import json
+from itertools import islice
+import catalog
+import content_api
+import scheduler
 
 def create_content_api_client(service_account_file):
     """Создает клиент для работы с Content API for Shopping."""
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_file,
-            scopes=['https://www.googleapis.com/auth/content']
-        )
-        
-        return build('content', 'v2.1', credentials=credentials)
+        return content_api.get_service_account_service(service_account_file)
     except Exception as e:
         print(f"Ошибка при создании клиента Content API: {e}")
         return None
@@ -18,50 +15,78 @@ def create_content_api_client(service_account_file):
 def get_account_info(client, merchant_id):
     """Получает информацию об аккаунте Merchant Center."""
     try:
-        return client.accounts().get(merchantId=merchant_id, accountId=merchant_id).execute()
+        return scheduler.execute(client.accounts().get(merchantId=merchant_id, accountId=merchant_id), merchant_id)
     except Exception as e:
         print(f"Ошибка при получении информации об аккаунте: {e}")
         return None
 
 def get_datafeeds(client, merchant_id):
-    """Получает список фидов в аккаунте."""
+    """Получает список фидов в аккаунте.
+    
+    Ошибка API пробрасывается дальше, чтобы сбой не выглядел как аккаунт без фидов.
+    """
     try:
         request = client.datafeeds().list(merchantId=merchant_id)
-        response = request.execute()
+        response = scheduler.execute(request, merchant_id)
         return response.get('resources', [])
     except Exception as e:
         print(f"Ошибка при получении списка фидов: {e}")
-        return []
+        raise
+
+def _fields_params(fields):
+    # fields=None запрашивает ресурсы целиком
+    return {'fields': catalog.list_fields(fields)} if fields else {}
+
+def iter_products(client, merchant_id, page_size=catalog.MAX_PAGE_SIZE, prefetch=catalog.DEFAULT_PREFETCH, on_page=None,
+                  fields=catalog.PRODUCT_FIELDS):
+    """Постранично перебирает все товары аккаунта, подгружая следующую страницу в фоне.
+    
+    Загружаются только атрибуты `fields` (partial response).
+    """
+    return catalog.iter_resources(client.products(), merchant_id, page_size=page_size, prefetch=prefetch, on_page=on_page,
+                                  **_fields_params(fields))
+
+def iter_product_statuses(client, merchant_id, page_size=catalog.MAX_PAGE_SIZE, prefetch=catalog.DEFAULT_PREFETCH, on_page=None,
+                          fields=catalog.STATUS_FIELDS):
+    """Постранично перебирает статусы всех товаров аккаунта (только поля `fields`)."""
+    return catalog.iter_resources(client.productstatuses(), merchant_id, page_size=page_size, prefetch=prefetch, on_page=on_page,
+                                  **_fields_params(fields))
 
 def get_products(client, merchant_id, max_results=250):
     """Получает список товаров из аккаунта."""
-    products = []
     try:
-        request = client.products().list(merchantId=merchant_id, maxResults=max_results)
-        
-        while request is not None:
-            response = request.execute()
-            products.extend(response.get('resources', []))
-            request = client.products().list_next(request, response)
-            
-            # Для тестового MVP ограничиваем количество товаров
-            if len(products) >= max_results:
-                break
-                
-        return products
+        return list(islice(iter_products(client, merchant_id, page_size=max_results), max_results))
     except Exception as e:
         print(f"Ошибка при получении списка товаров: {e}")
-        return []
+        raise
 
 def get_product_issues(client, merchant_id, max_results=250):
     """Получает информацию о проблемах с товарами."""
     try:
-        request = client.productstatuses().list(merchantId=merchant_id, maxResults=max_results)
-        response = request.execute()
-        return response.get('resources', [])
+        return list(islice(iter_product_statuses(client, merchant_id, page_size=max_results), max_results))
     except Exception as e:
         print(f"Ошибка при получении статусов товаров: {e}")
+        raise
+
+def get_product_statuses_by_id(client, merchant_id, product_ids):
+    """Получает статусы указанных товаров одним запросом productstatuses.custombatch."""
+    entries = [
+        {'batchId': batch_id, 'merchantId': merchant_id, 'productId': product_id, 'method': 'get'}
+        for batch_id, product_id in enumerate(product_ids)
+    ]
+    if not entries:
         return []
+    
+    try:
+        request = client.productstatuses().custombatch(
+            body={'entries': entries},
+            fields=f"entries(batchId,errors,productStatus({','.join(catalog.STATUS_FIELDS)}))"
+        )
+        response = scheduler.execute(request, merchant_id)
+        return [entry['productStatus'] for entry in response.get('entries', []) if 'productStatus' in entry]
+    except Exception as e:
+        print(f"Ошибка при получении статусов товаров: {e}")
+        raise
 
 def create_supplemental_feed(client, merchant_id, feed_name, feed_file_url):
     """Создает дополнительный фид (supplemental feed)."""
@@ -82,7 +107,7 @@ def create_supplemental_feed(client, merchant_id, feed_name, feed_file_url):
             }
         }
         
-        return client.datafeeds().insert(merchantId=merchant_id, body=body).execute()
+        return scheduler.execute(client.datafeeds().insert(merchantId=merchant_id, body=body), merchant_id)
     except Exception as e:
         print(f"Ошибка при создании supplemental feed: {e}")
         return None
@@ -0,0 +1,174 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import analyzer
+import catalog
+import scheduler
+import storage
+import tracing
+
+DB_NAME = 'account_results.sqlite'
+
+# Accounts analyzed at the same time by one sweep; each also fans out into a few API calls
+ACCOUNT_WORKERS = int(os.environ.get('MCA_ACCOUNT_WORKERS', '4'))
+
+# Content API calls one account may use in a sweep (about 500k products at 250 per page), so a
+# single huge sub-account cannot use up the quota everyone else's analysis needs
+ACCOUNT_REQUEST_BUDGET = int(os.environ.get('MCA_ACCOUNT_REQUEST_BUDGET', '2000'))
+
+# How often a sweep refreshes its job heartbeat while accounts are still running
+HEARTBEAT_INTERVAL = 30
+
+# Per-account results are kept as long as the jobs they belong to
+RESULT_MAX_AGE = 86400
+
+
+def discover_accounts(service):
+    """Returns every account the user can analyze as dicts with `id` and `name`.
+
+    Accounts come from authinfo; for an advanced account (MCA) the sub-accounts
+    are listed too. The order is stable and each account appears once.
+    """
+    response = scheduler.execute(service.accounts().authinfo())
+    accounts = {}
+    for identifier in response.get('accountIdentifiers', []):
+        merchant_id = identifier.get('merchantId')
+        aggregator_id = identifier.get('aggregatorId')
+        if merchant_id:
+            accounts.setdefault(str(merchant_id), None)
+        elif aggregator_id:
+            accounts.setdefault(str(aggregator_id), None)
+            for account in catalog.iter_resources(service.accounts(), aggregator_id):
+                accounts.setdefault(str(account['id']), account.get('name'))
+    return [{'id': merchant_id, 'name': name} for merchant_id, name in accounts.items()]
+
+
+class AccountResultStore:
+    """Per-account results of multi-account sweeps, in SQLite so every gunicorn worker sees them."""
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS account_results (
+                    job_id TEXT NOT NULL,
+                    merchant_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    name TEXT,
+                    state TEXT NOT NULL,
+                    disapproved_count INTEGER,
+                    issues_count INTEGER,
+                    products_count INTEGER,
+                    analysis TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, merchant_id)
+                );
+            ''')
+        self.prune()
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    def add_accounts(self, job_id, accounts):
+        """Registers the accounts of a sweep as pending, so the dashboard can list them right away."""
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO account_results (job_id, merchant_id, position, name, state, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (job_id, account['id'], position, account.get('name'), 'pending', now)
+                    for position, account in enumerate(accounts)
+                ]
+            )
+
+    def save(self, job_id, merchant_id, analysis=None, error=None):
+        """Records the outcome of one account: its analyze_account result or an error message."""
+        stats = (analysis or {}).get('stats', {})
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'UPDATE account_results SET state = ?, name = COALESCE(?, name), disapproved_count = ?, '
+                'issues_count = ?, products_count = ?, analysis = ?, error = ? WHERE job_id = ? AND merchant_id = ?',
+                (
+                    'failed' if error else 'done',
+                    stats.get('name') if stats.get('name') != 'Unknown' else None,
+                    stats.get('disapproved_count'),
+                    stats.get('issues_count'),
+                    stats.get('products_count'),
+                    json.dumps(analysis) if analysis else None,
+                    error,
+                    job_id,
+                    merchant_id,
+                )
+            )
+
+    def ranked(self, job_id):
+        """Returns the sweep's accounts, most disapproved products first.
+
+        Accounts without counts (failed or partial) follow, and accounts still
+        being analyzed come last.
+        """
+        cursor = self._connection().execute(
+            'SELECT merchant_id, name, state, disapproved_count, issues_count, products_count, analysis, error '
+            'FROM account_results WHERE job_id = ? '
+            "ORDER BY state = 'pending', disapproved_count IS NULL, disapproved_count DESC, "
+            'issues_count DESC, position',
+            (job_id,)
+        )
+        columns = [column[0] for column in cursor.description]
+        accounts = []
+        for row in cursor:
+            account = dict(zip(columns, row))
+            analysis = json.loads(account.pop('analysis')) if account['analysis'] else None
+            account['account_status'] = analysis['account_status'] if analysis else None
+            account['issues'] = analysis['issues'] if analysis else None
+            accounts.append(account)
+        return accounts
+
+    def prune(self, max_age=RESULT_MAX_AGE):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM account_results WHERE created_at < ?', (time.time() - max_age,))
+
+
+def analyze_accounts(store, job_id, accounts, credentials, progress=None, max_workers=ACCOUNT_WORKERS,
+                     request_budget=ACCOUNT_REQUEST_BUDGET):
+    """Runs analyzer.analyze_account on every account in parallel.
+
+    Each result is written to `store` as soon as its account finishes, so the
+    dashboard fills in without waiting for the slowest account. Every account
+    gets its own request budget on top of the scheduler's per-merchant rate
+    limits. Returns a summary of how many accounts were analyzed and failed.
+    """
+    store.add_accounts(job_id, accounts)
+
+    def analyze(merchant_id):
+        with scheduler.request_budget(request_budget):
+            return analyzer.analyze_account(merchant_id, credentials=credentials)
+
+    summary = {'accounts': len(accounts), 'analyzed': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='account-analysis') as executor:
+        pending = {
+            executor.submit(tracing.in_context(analyze), account['id']): account['id']
+            for account in accounts
+        }
+        while pending:
+            done, _ = wait(pending, timeout=HEARTBEAT_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                merchant_id = pending.pop(future)
+                try:
+                    store.save(job_id, merchant_id, analysis=future.result())
+                    summary['analyzed'] += 1
+                except Exception as e:
+                    print(f"Analysis of account {merchant_id} failed: {e}")
+                    store.save(job_id, merchant_id, error=str(e))
+                    summary['failed'] += 1
+            if progress:
+                # Also keeps the job from being taken for lost while a large account is still running
+                progress.flush()
+    return summary
@@ -0,0 +1,289 @@
+import re
+import zlib
+from itertools import chain, islice
+
+import tracing
+
+# MinHash values per text; the LSH index splits them into BANDS bands of NUM_PERM // BANDS rows.
+# Texts collide in some band with probability 1 - (1 - J^8)^8 for Jaccard similarity J:
+# 77% at J=0.8, 99% at J=0.9, and 13% at J=0.6 (ruled out when candidates are verified)
+NUM_PERM = 64
+BANDS = 8
+
+# Estimated Jaccard similarity of shingle sets above which two texts are near-duplicates
+SIMILARITY_THRESHOLD = 0.8
+
+# Titles are compared by character 3-grams, so a changed size or colour still leaves most shingles
+# in common; descriptions by word 3-grams over their first words, which is where copies show
+TITLE_SHINGLE_SIZE = 3
+DESCRIPTION_SHINGLE_SIZE = 3
+DESCRIPTION_WORDS = 200
+
+# Texts of a bucket verified as leaders at most; past that, a large bucket of unrelated texts
+# (short texts sharing common shingles, or a band key collision) would be verified in O(k^2)
+MAX_BUCKET_LEADERS = 64
+
+# Products hashed together; also the granularity of progress updates
+CATALOG_BATCH_SIZE = 2000
+REPORT_SAMPLE_SIZE = 50
+CLUSTER_SAMPLE_SIZE = 10
+
+SEED = 20240601
+
+# Catalog-wide near-duplicate checks, added with analyzer.add_check_issues: code -> (severity, message, attribute)
+NEAR_DUPLICATE_CHECKS = {
+    'near_duplicate_title': ('warning', 'Title is nearly identical to titles of other offers', 'title'),
+    'near_duplicate_description': ('info', 'Description is nearly identical to descriptions of other offers', 'description'),
+}
+
+# Attribute compared by each check
+CHECK_ATTRIBUTES = {'near_duplicate_title': 'title', 'near_duplicate_description': 'description'}
+
+NON_WORD = re.compile(r'\W+')
+
+
+def title_shingles(text):
+    """Returns the CRC32 hashes of the character 3-grams of a normalized title."""
+    text = NON_WORD.sub(' ', text.lower()).strip().encode('utf-8')
+    if not text:
+        return []
+    if len(text) <= TITLE_SHINGLE_SIZE:
+        return [zlib.crc32(text)]
+    return [zlib.crc32(text[start:start + TITLE_SHINGLE_SIZE]) for start in range(len(text) - TITLE_SHINGLE_SIZE + 1)]
+
+
+def description_shingles(text):
+    """Returns the CRC32 hashes of the word 3-grams of the first DESCRIPTION_WORDS words."""
+    words = NON_WORD.sub(' ', text.lower()).split()[:DESCRIPTION_WORDS]
+    if len(words) <= DESCRIPTION_SHINGLE_SIZE:
+        return [zlib.crc32(' '.join(words).encode('utf-8'))] if words else []
+    return [
+        zlib.crc32(' '.join(words[start:start + DESCRIPTION_SHINGLE_SIZE]).encode('utf-8'))
+        for start in range(len(words) - DESCRIPTION_SHINGLE_SIZE + 1)
+    ]
+
+
+SHINGLERS = {'title': title_shingles, 'description': description_shingles}
+
+
+class MinHashLSH:
+    """Banded MinHash index of texts that finds near-duplicates without comparing every pair.
+
+    For each text only its band keys (BANDS 32-bit hashes) and the low byte of
+    each MinHash value are kept, about 100 bytes per text, so a million texts
+    fit in about 100 MB. Texts sharing a band key are candidates; a candidate
+    is confirmed when enough of its MinHash bytes match (b-bit MinHash).
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, threshold=SIMILARITY_THRESHOLD, seed=SEED):
+        import numpy as np
+
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        # Multiply-shift hashing: (a * x + b) >> 32 with wrapping 64-bit arithmetic and odd a
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = generator.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self._rows = []
+        self._band_keys = []
+        self._sketches = []
+
+    def add_batch(self, rows, shingle_lists):
+        """Indexes a batch of texts given as lists of shingle hashes; `rows` identifies each text.
+
+        Texts without shingles are skipped.
+        """
+        import numpy as np
+
+        kept = [(row, shingles) for row, shingles in zip(rows, shingle_lists) if shingles]
+        if not kept:
+            return
+        lengths = np.fromiter((len(shingles) for _, shingles in kept), dtype=np.int64, count=len(kept))
+        hashes = np.fromiter(
+            chain.from_iterable(shingles for _, shingles in kept), dtype=np.uint64, count=int(lengths.sum())
+        )
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # One permutation at a time keeps the temporary arrays at the size of the batch's shingles
+        signatures = np.empty((len(kept), self.num_perm), dtype=np.uint32)
+        for position in range(self.num_perm):
+            permuted = (self._a[position] * hashes + self._b[position]) >> np.uint64(32)
+            signatures[:, position] = np.minimum.reduceat(permuted, starts)
+
+        rows_per_band = self.num_perm // self.bands
+        band_keys = np.empty((len(kept), self.bands), dtype=np.uint32)
+        for band in range(self.bands):
+            columns = signatures[:, band * rows_per_band:(band + 1) * rows_per_band].astype(np.uint64)
+            # Mixing the band's values into one 32-bit key; unrelated texts rarely share it, and
+            # those that do are dropped when verified
+            key = np.full(len(kept), band + 1, dtype=np.uint64)
+            for column in columns.T:
+                key = (key * np.uint64(0x100000001B3)) ^ column
+            band_keys[:, band] = (key ^ (key >> np.uint64(32))).astype(np.uint32)
+
+        self._rows.append(np.fromiter((row for row, _ in kept), dtype=np.int64, count=len(kept)))
+        self._band_keys.append(band_keys)
+        self._sketches.append((signatures & 0xFF).astype(np.uint8))
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows)
+
+    def similar_pairs(self, groups=None):
+        """Yields (row, row) pairs of near-duplicate texts from different item groups.
+
+        `groups` gives the item group of each row (by default every row is its
+        own group). A bucket's members are verified against its first text.
+        Those linked to it leave the bucket but one, which goes first, and the
+        rest (including the first text's own group-mates) are verified against
+        it in turn, until one group is left or MAX_BUCKET_LEADERS texts have
+        led, so a bucket costs O(k) comparisons. Similarity is not transitive,
+        so two texts linked to different first texts can still be missed as a
+        pair, and so can two texts that are both past the last leader of a
+        large bucket in every band they share.
+        """
+        import numpy as np
+
+        if not self._rows:
+            return
+        rows = np.concatenate(self._rows)
+        band_keys = np.concatenate(self._band_keys)
+        sketches = np.concatenate(self._sketches)
+        row_groups = rows if groups is None else np.asarray(groups, dtype=np.int64)[rows]
+        # With 8-bit values, unrelated MinHashes still match 1 time in 256
+        needed = self.threshold + (1 - self.threshold) / 256
+
+        seen = set()
+        for band in range(self.bands):
+            keys = band_keys[:, band]
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+            starts = np.concatenate(([0], boundaries))
+            ends = np.concatenate((boundaries, [len(sorted_keys)]))
+            for start, end in zip(starts[ends - starts > 1].tolist(), ends[ends - starts > 1].tolist()):
+                members = order[start:end]
+                member_groups = row_groups[members]
+                leaders = 0
+                while len(members) > 1 and leaders < MAX_BUCKET_LEADERS and (member_groups != member_groups[0]).any():
+                    leaders += 1
+                    leader, others, other_groups = int(members[0]), members[1:], member_groups[1:]
+                    linked = ((sketches[others] == sketches[leader]).mean(axis=1) >= needed) & (other_groups != member_groups[0])
+                    for other in others[linked].tolist():
+                        if (leader, other) not in seen:
+                            seen.add((leader, other))
+                            yield int(rows[leader]), int(rows[other])
+                    # One linked text leads the next pass, so the leader's group-mates meet another group
+                    rest = ~linked
+                    next_leader = np.flatnonzero(linked)[:1]
+                    members = np.concatenate((others[next_leader], others[rest]))
+                    member_groups = np.concatenate((other_groups[next_leader], other_groups[rest]))
+
+
+def group_key(product):
+    """Products with the same key are variants of one item (or one offer in other countries)."""
+    return product.get('itemGroupId') or product.get('offerId') or product.get('id')
+
+
+def clusters(pairs, groups):
+    """Joins near-duplicate pairs into clusters (lists of rows), leaving out pairs of the same item group.
+
+    A cluster whose members all belong to one item group is not reported.
+    """
+    parent = {}
+
+    def find(row):
+        root = row
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while row != root:
+            parent[row], row = root, parent.get(row, row)
+        return root
+
+    for left, right in pairs:
+        if groups[left] == groups[right]:
+            continue
+        left_root, right_root = find(left), find(right)
+        if left_root != right_root:
+            parent[max(left_root, right_root)] = min(left_root, right_root)
+
+    members = {}
+    for row in parent:
+        members.setdefault(find(row), []).append(row)
+    for root in list(members):
+        members[root].append(root)
+    return [sorted(rows) for rows in members.values() if len({groups[row] for row in rows}) > 1]
+
+
+class NearDuplicateIndex:
+    """MinHash LSH indexes of product titles and descriptions, filled batch by batch.
+
+    Besides the indexes only product IDs and item groups are kept, so a catalog
+    is streamed through once and memory grows by a few hundred bytes per product.
+    """
+
+    def __init__(self, **options):
+        self.indexes = {code: MinHashLSH(**options) for code in CHECK_ATTRIBUTES}
+        self.product_ids = []
+        self.groups = []
+
+    def add_batch(self, products):
+        """Indexes the titles and descriptions of a batch of products."""
+        first_row = len(self.product_ids)
+        rows = range(first_row, first_row + len(products))
+        self.product_ids.extend(product.get('id') for product in products)
+        self.groups.extend(hash(group_key(product)) for product in products)
+        for code, attribute in CHECK_ATTRIBUTES.items():
+            shingle = SHINGLERS[attribute]
+            self.indexes[code].add_batch(rows, [shingle(product.get(attribute) or '') for product in products])
+
+    def clusters(self):
+        """Returns {code: clusters of rows} for both checks, largest clusters first."""
+        return {
+            code: sorted(clusters(index.similar_pairs(self.groups), self.groups), key=len, reverse=True)
+            for code, index in self.indexes.items()
+        }
+
+    def codes_by_product(self):
+        """Returns {product ID: NEAR_DUPLICATE_CHECKS codes} for the products in some cluster."""
+        codes = {}
+        for code, code_clusters in self.clusters().items():
+            for cluster in code_clusters:
+                for row in cluster:
+                    codes.setdefault(self.product_ids[row], []).append(code)
+        return codes
+
+    def __len__(self):
+        return len(self.product_ids)
+
+
+@tracing.traced('near_duplicates', items=lambda report: report['products_checked'])
+def check_catalog(products, progress=None, batch_size=CATALOG_BATCH_SIZE):
+    """Finds clusters of near-duplicate titles and descriptions in a stream of products.
+
+    Returns a report with cluster counts per check and the largest clusters.
+    `progress` (a jobs.JobProgress) is told about each indexed product.
+    """
+    index = NearDuplicateIndex()
+    products = iter(products)
+    while True:
+        batch = list(islice(products, batch_size))
+        if not batch:
+            break
+        index.add_batch(batch)
+        if progress:
+            progress.product_analyzed(len(batch))
+
+    report = {'products_checked': len(index), 'checks': {}}
+    for code, code_clusters in index.clusters().items():
+        report['checks'][code] = {
+            'clusters': len(code_clusters),
+            'products': sum(len(cluster) for cluster in code_clusters),
+            'examples': [
+                {'size': len(cluster), 'product_ids': [index.product_ids[row] for row in cluster[:CLUSTER_SAMPLE_SIZE]]}
+                for cluster in code_clusters[:REPORT_SAMPLE_SIZE]
+            ],
+        }
+    return report
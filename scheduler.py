@@ -0,0 +1,351 @@
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+import content_api
+import tracing
+
+# Requests per second allowed per merchant and API method, with bursts up to DEFAULT_BURST
+DEFAULT_RATE = float(os.environ.get('CONTENT_API_RATE', '10'))
+DEFAULT_BURST = 20
+
+# Batch calls carry up to 1000 operations each, so they get a much smaller share
+METHOD_RATES = {
+    'content.products.custombatch': 2.0,
+    'content.productstatuses.custombatch': 2.0,
+    'content.accounts.custombatch': 2.0,
+}
+
+# Concurrent requests per merchant: grows slowly while calls succeed, halves on quota errors
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32.0
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+QUOTA_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'dailyLimitExceeded'}
+
+# Content API URIs start with /content/v2.1/<merchantId>/
+MERCHANT_IN_URI = re.compile(r'/content/v2\.1/(\d+)/')
+
+
+class ContentApiError(HttpError):
+    """A Content API call that failed for good, after any retries.
+
+    Still an HttpError, so existing handlers catch it, but it also records the
+    merchant, the API method, the error reason and how many attempts were made.
+    """
+
+    def __init__(self, error, merchant_id, method, attempts):
+        super().__init__(error.resp, error.content, uri=error.uri)
+        self.merchant_id = merchant_id
+        self.method = method
+        self.attempts = attempts
+        self.status = error.resp.status
+        self.error_reason = error_reason(error)
+        self.retryable = is_retryable(self.status, self.error_reason)
+
+    def __str__(self):
+        return (
+            f'{self.method} for merchant {self.merchant_id} failed after {self.attempts} attempt(s): '
+            f'HTTP {self.status} {self.error_reason}: {self.reason}'
+        )
+
+    __repr__ = __str__
+
+
+class RequestBudgetExceeded(Exception):
+    """The Content API calls allowed by an enclosing request_budget() are used up."""
+
+
+class RequestBudget:
+    """Counts Content API calls against a limit; shared by every thread of one unit of work."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.used >= self.limit:
+                raise RequestBudgetExceeded(f'Request budget of {self.limit} Content API calls used up')
+            self.used += 1
+
+
+_current_budget = contextvars.ContextVar('content_api_request_budget', default=None)
+
+
+@contextmanager
+def request_budget(limit):
+    """Caps the Content API calls, retries included, made inside the block.
+
+    Calls beyond the limit raise RequestBudgetExceeded. The budget follows work
+    handed to other threads with tracing.in_context, as the catalog prefetcher
+    and fanout do.
+    """
+    budget = RequestBudget(limit)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+def error_reason(error):
+    """Returns the machine-readable reason of an HttpError, e.g. 'rateLimitExceeded'."""
+    try:
+        data = json.loads(error.content.decode('utf-8'))
+        return data['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return str(error.resp.status)
+
+
+def is_quota_error(status, reason):
+    return status == 429 or reason in QUOTA_REASONS
+
+
+def is_retryable(status, reason):
+    # dailyLimitExceeded will not clear up within any reasonable backoff
+    return reason != 'dailyLimitExceeded' and (status in RETRYABLE_STATUSES or reason in QUOTA_REASONS)
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it sent a Retry-After header."""
+    try:
+        return float(error.resp.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter for the given (1-based) attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, in bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveLimit:
+    """Concurrency limit that adapts to quota errors (additive increase, multiplicative decrease)."""
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, succeeded, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """Runs Content API requests under per-merchant rate and concurrency limits, with retries.
+
+    State is kept per process, so each gunicorn worker throttles on its own;
+    the adaptive limit still converges because every worker sees the same
+    quota errors.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, method_rates=None, max_attempts=MAX_ATTEMPTS):
+        self.rate = rate
+        self.burst = burst
+        self.method_rates = METHOD_RATES if method_rates is None else method_rates
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.limits = {}
+        self.counters = {}
+
+    def _state(self, merchant_id, method):
+        key = (merchant_id, method)
+        with self.lock:
+            if key not in self.buckets:
+                rate = self.method_rates.get(method, self.rate)
+                self.buckets[key] = TokenBucket(rate, max(1, min(self.burst, rate * 2)))
+                self.counters[key] = {
+                    'requests': 0,
+                    'succeeded': 0,
+                    'failed': 0,
+                    'retries': 0,
+                    'quota_errors': 0,
+                    'wait_seconds': 0.0,
+                }
+            if merchant_id not in self.limits:
+                self.limits[merchant_id] = AdaptiveLimit()
+            return self.buckets[key], self.limits[merchant_id], self.counters[key]
+
+    def _count(self, counters, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                counters[name] += value
+
+    def execute(self, request, merchant_id=None, **attributes):
+        """Executes a googleapiclient request and returns its response.
+
+        The merchant is taken from the request URI when not given. Rate-limit and
+        server errors are retried with backoff; a final HTTP failure is raised as
+        ContentApiError. `attributes` (e.g. page) are added to the call's trace span.
+        """
+        # Not imported at module level: the transport is loaded with googleapiclient, on first use
+        import httplib2
+
+        method = getattr(request, 'methodId', None) or 'unknown'
+        if merchant_id is None:
+            match = MERCHANT_IN_URI.search(getattr(request, 'uri', '') or '')
+            merchant_id = match.group(1) if match else '-'
+        merchant_id = str(merchant_id)
+        bucket, limit, counters = self._state(merchant_id, method)
+        budget = _current_budget.get()
+
+        with tracing.span('content_api', method, merchant_id=merchant_id, **attributes) as span:
+            postproc = getattr(request, 'postproc', None)
+
+            # The raw body is only visible here, before it is parsed
+            def measured_postproc(resp, content):
+                span.add(bytes=len(content or b''))
+                return postproc(resp, content)
+
+            for attempt in range(1, self.max_attempts + 1):
+                if budget is not None:
+                    budget.spend()
+                waited = bucket.acquire()
+                limit.acquire()
+                self._count(counters, requests=1, wait_seconds=waited)
+                try:
+                    if postproc is not None:
+                        request.postproc = measured_postproc
+                    # Requests of a shared service are sent over a transport lent to this call only
+                    with content_api.transports.checkout(getattr(request, 'http', None)) as http:
+                        response = request.execute(http=http)
+                except HttpError as e:
+                    reason = error_reason(e)
+                    throttled = is_quota_error(e.resp.status, reason)
+                    limit.release(succeeded=False, throttled=throttled)
+                    self._count(counters, quota_errors=int(throttled))
+                    if attempt == self.max_attempts or not is_retryable(e.resp.status, reason):
+                        self._count(counters, failed=1)
+                        span.set(status=e.resp.status, reason=reason)
+                        raise ContentApiError(e, merchant_id, method, attempt) from e
+                    delay = retry_after(e) or backoff(attempt)
+                except (OSError, httplib2.HttpLib2Error):
+                    # Connection resets and timeouts are transient too
+                    limit.release(succeeded=False, throttled=False)
+                    if attempt == self.max_attempts:
+                        self._count(counters, failed=1)
+                        raise
+                    delay = backoff(attempt)
+                except Exception:
+                    # E.g. a revoked token or an unparsable body: not retried, but the slot is given back
+                    limit.release(succeeded=False, throttled=False)
+                    self._count(counters, failed=1)
+                    raise
+                else:
+                    limit.release(succeeded=True, throttled=False)
+                    self._count(counters, succeeded=1)
+                    if isinstance(response, dict):
+                        span.set(items=len(response.get('resources') or response.get('entries') or ()))
+                    return response
+                finally:
+                    # list_next() copies the request for the next page, which must not inherit this span's wrapper
+                    if postproc is not None:
+                        request.postproc = postproc
+                    if waited:
+                        span.add(throttled_ms=round(waited * 1000, 2))
+
+                self._count(counters, retries=1)
+                span.add(retries=1)
+                time.sleep(delay)
+
+    def stats(self, merchant_id=None):
+        """Quota usage counters per merchant and API method, for dashboards."""
+        with self.lock:
+            return [
+                {
+                    'merchant_id': key[0],
+                    'method': key[1],
+                    'concurrency_limit': int(self.limits[key[0]].limit),
+                    **counters,
+                }
+                for key, counters in self.counters.items()
+                if merchant_id is None or key[0] == str(merchant_id)
+            ]
+
+
+default_scheduler = RequestScheduler()
+
+
+def execute(request, merchant_id=None, **attributes):
+    """Executes a Content API request through the shared scheduler."""
+    return default_scheduler.execute(request, merchant_id, **attributes)
+
+
+def stats(merchant_id=None):
+    return default_scheduler.stats(merchant_id)
+
+
+def quota_metrics():
+    """Quota counters summed per API method, in Prometheus text format."""
+    totals = {}
+    for row in default_scheduler.stats():
+        method_totals = totals.setdefault(row['method'], {})
+        for name in ('requests', 'succeeded', 'failed', 'retries', 'quota_errors'):
+            method_totals[name] = method_totals.get(name, 0) + row[name]
+
+    lines = []
+    for name in ('requests', 'succeeded', 'failed', 'retries', 'quota_errors'):
+        metric = f'feed_optimizer_content_api_{name}_total'
+        lines.append(f'# HELP {metric} Content API {name.replace("_", " ")} seen by the request scheduler.')
+        lines.append(f'# TYPE {metric} counter')
+        for method, method_totals in sorted(totals.items()):
+            lines.append(f'{metric}{{method="{method}"}} {method_totals[name]}')
+    return lines
+
+
+tracing.collectors.append(quota_metrics)
@@ -1 +1,222 @@
+import hashlib
+import os
+import re
+import secrets
+import tempfile
+import time
 
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import storage
+
+# Session IDs are URL-safe tokens; anything else in the cookie is ignored
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{32,128}$')
+
+# Expired sessions are swept on roughly one request in this many
+PRUNE_EVERY = 500
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept on the server; the cookie only carries `sid`."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new ID, e.g. on login; the old one is deleted when the session is saved."""
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+def regenerate_session(session):
+    """Issues a new session ID if the session is stored on the server.
+
+    Call it when the session gains privileges (login), so an ID planted
+    before login (session fixation) cannot be used afterwards.
+    """
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+class FileSystemSessionBackend:
+    """One file per session in a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        # Hash the ID so it never reaches the filesystem as a path component
+        return os.path.join(self.directory, hashlib.sha256(sid.encode('ascii')).hexdigest())
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid), 'r', encoding='utf-8') as f:
+                expires_at = float(f.readline())
+                payload = f.read()
+        except (OSError, ValueError):
+            return None
+
+        if expires_at < time.time():
+            self.delete(sid)
+            return None
+        return payload
+
+    def save(self, sid, payload, expires_at):
+        # Write to a temporary file and rename it, so readers never see half a session
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.session-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(f'{expires_at}\n{payload}')
+        os.replace(temp_path, self._path(sid))
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except OSError:
+            pass
+
+    def prune(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    expires_at = float(f.readline())
+                if expires_at < now:
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+
+
+class SQLiteSessionBackend:
+    """Sessions in a SQLite table, shared by every worker on the instance."""
+
+    def __init__(self, path):
+        self.path = path
+        with storage.connect(path) as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+    def load(self, sid):
+        row = storage.connect(self.path).execute(
+            'SELECT payload FROM sessions WHERE sid = ? AND expires_at >= ?',
+            (sid, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, payload, expires_at):
+        connection = storage.connect(self.path)
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (sid, payload, expires_at) VALUES (?, ?, ?)',
+                (sid, payload, expires_at)
+            )
+
+    def delete(self, sid):
+        connection = storage.connect(self.path)
+        with connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def prune(self):
+        connection = storage.connect(self.path)
+        with connection:
+            connection.execute('DELETE FROM sessions WHERE expires_at < ?', (time.time(),))
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface that stores session data in a pluggable backend.
+
+    A backend needs load(sid), save(sid, payload, expires_at), delete(sid) and prune().
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SESSION_ID_PATTERN.match(sid):
+            payload = self.backend.load(sid)
+            if payload is not None:
+                try:
+                    return ServerSession(self.serializer.loads(payload), sid=sid)
+                except ValueError:
+                    pass
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if secrets.randbelow(PRUNE_EVERY) == 0:
+            self.backend.prune()
+
+        if session.replaced_sid:
+            self.backend.delete(session.replaced_sid)
+
+        # An emptied session is removed from the backend along with its cookie
+        if not session:
+            if session.modified and (session.replaced_sid or not session.new):
+                if not session.new:
+                    self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        if not (session.modified or self.should_set_cookie(app, session)):
+            return
+
+        expires = self.get_expiration_time(app, session)
+        # Sessions without a cookie expiry are still dropped on the server eventually
+        expires_at = expires.timestamp() if expires else time.time() + app.permanent_session_lifetime.total_seconds()
+        self.backend.save(session.sid, self.serializer.dumps(dict(session)), expires_at)
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=expires,
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
+        response.vary.add('Cookie')
+
+
+def create_session_interface(app):
+    """Builds the session interface configured by SESSION_TYPE ('sqlite' or 'filesystem')."""
+    session_type = app.config.get('SESSION_TYPE', 'sqlite')
+    if session_type == 'filesystem':
+        # The app directory is read-only on App Engine, so files go to the data directory by default
+        directory = app.config.get('SESSION_FILE_DIR') or storage.data_path('flask_session')
+        return ServerSessionInterface(FileSystemSessionBackend(directory))
+    if session_type == 'sqlite':
+        path = app.config.get('SESSION_SQLITE_PATH') or storage.data_path('sessions.sqlite')
+        return ServerSessionInterface(SQLiteSessionBackend(path))
+    raise ValueError(f'Unsupported SESSION_TYPE: {session_type}')
@@ -0,0 +1,220 @@
+import json
+import threading
+import time
+import uuid
+from itertools import islice
+
+import storage
+
+DB_NAME = 'snapshots.sqlite'
+
+# Seconds a cached resource is served as fresh before a background refresh starts
+RESOURCE_TTLS = {
+    'account_info': 3600,
+    'datafeeds': 900,
+    'products': 600,
+    'product_statuses': 600,
+}
+DEFAULT_TTL = 600
+
+# A refresh that has not finished within this many seconds may be taken over by another worker
+REFRESH_LEASE = 600
+
+CHUNK_SIZE = 500
+
+
+class SnapshotCache:
+    """Catalog snapshots per merchant on local disk, served stale-while-revalidate.
+
+    The cache lives in SQLite so every gunicorn worker on an instance shares it.
+    Collections are stored one item per row and read back as a stream.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS snapshot_meta (
+                    merchant_id TEXT NOT NULL,
+                    resource TEXT NOT NULL,
+                    generation TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    refreshing_until REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (merchant_id, resource)
+                );
+                CREATE TABLE IF NOT EXISTS snapshot_items (
+                    merchant_id TEXT NOT NULL,
+                    resource TEXT NOT NULL,
+                    generation TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (merchant_id, resource, generation, position)
+                );
+            ''')
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    def get(self, merchant_id, resource, fetch, refresh=False):
+        """Returns a cached value, calling `fetch()` on a miss or when `refresh` is set.
+
+        A stale value is returned immediately while `fetch()` runs in the background.
+        `None` results are not cached, so failed lookups are retried on the next call.
+        """
+        meta = self._meta(merchant_id, resource)
+        if meta is None or refresh:
+            value = fetch()
+            if value is not None:
+                self._store(merchant_id, resource, [value])
+            return value
+
+        if self._is_stale(resource, meta):
+            def fetch_value():
+                value = fetch()
+                if value is None:
+                    raise ValueError('nothing was fetched')
+                return [value]
+
+            self._refresh_in_background(merchant_id, resource, fetch_value)
+        return next(self._read(merchant_id, resource, meta[0]), None)
+
+    def iter(self, merchant_id, resource, fetch, refresh=False, on_page=None):
+        """Iterates over a cached collection, where `fetch(on_page)` returns an iterable of items.
+
+        On a miss the items are streamed from `fetch(on_page)` and written to the
+        cache as they pass; the snapshot is only kept if the iteration runs to the
+        end. A background refresh outlives the caller, so it gets no `on_page`.
+        """
+        meta = self._meta(merchant_id, resource)
+        if meta is None or refresh:
+            return self._fetch_through(merchant_id, resource, fetch(on_page))
+
+        if self._is_stale(resource, meta):
+            self._refresh_in_background(merchant_id, resource, lambda: fetch(None))
+        return self._read(merchant_id, resource, meta[0])
+
+    def fetched_at(self, merchant_id, resource):
+        """Returns when a resource was last fetched, or None if it is not cached."""
+        meta = self._meta(merchant_id, resource)
+        return meta[1] if meta else None
+
+    def invalidate(self, merchant_id):
+        """Drops every cached resource of a merchant."""
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM snapshot_meta WHERE merchant_id = ?', (merchant_id,))
+            connection.execute('DELETE FROM snapshot_items WHERE merchant_id = ?', (merchant_id,))
+
+    def _meta(self, merchant_id, resource):
+        return self._connection().execute(
+            'SELECT generation, fetched_at FROM snapshot_meta WHERE merchant_id = ? AND resource = ?',
+            (merchant_id, resource)
+        ).fetchone()
+
+    def _is_stale(self, resource, meta):
+        return time.time() - meta[1] > RESOURCE_TTLS.get(resource, DEFAULT_TTL)
+
+    def _read(self, merchant_id, resource, generation):
+        # A single statement reads from one consistent WAL snapshot, even while a refresh swaps generations
+        cursor = self._connection().execute(
+            'SELECT payload FROM snapshot_items '
+            'WHERE merchant_id = ? AND resource = ? AND generation = ? ORDER BY position',
+            (merchant_id, resource, generation)
+        )
+        for (payload,) in cursor:
+            yield json.loads(payload)
+
+    def _write_items(self, merchant_id, resource, generation, start, items):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT INTO snapshot_items (merchant_id, resource, generation, position, payload) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [
+                    (merchant_id, resource, generation, position, json.dumps(item))
+                    for position, item in enumerate(items, start)
+                ]
+            )
+
+    def _activate(self, merchant_id, resource, generation):
+        connection = self._connection()
+        with connection:
+            previous = self._meta(merchant_id, resource)
+            connection.execute(
+                'INSERT OR REPLACE INTO snapshot_meta (merchant_id, resource, generation, fetched_at, refreshing_until) '
+                'VALUES (?, ?, ?, ?, 0)',
+                (merchant_id, resource, generation, time.time())
+            )
+            if previous:
+                self._drop_generation(connection, merchant_id, resource, previous[0])
+
+    def _drop_generation(self, connection, merchant_id, resource, generation):
+        connection.execute(
+            'DELETE FROM snapshot_items WHERE merchant_id = ? AND resource = ? AND generation = ?',
+            (merchant_id, resource, generation)
+        )
+
+    def _store(self, merchant_id, resource, items):
+        generation = uuid.uuid4().hex
+        iterator = iter(items)
+        position = 0
+        while True:
+            chunk = list(islice(iterator, CHUNK_SIZE))
+            if not chunk:
+                break
+            self._write_items(merchant_id, resource, generation, position, chunk)
+            position += len(chunk)
+        self._activate(merchant_id, resource, generation)
+
+    def _fetch_through(self, merchant_id, resource, items):
+        generation = uuid.uuid4().hex
+        position = 0
+        chunk = []
+        completed = False
+        try:
+            for item in items:
+                chunk.append(item)
+                yield item
+                if len(chunk) >= CHUNK_SIZE:
+                    self._write_items(merchant_id, resource, generation, position, chunk)
+                    position += len(chunk)
+                    chunk = []
+            self._write_items(merchant_id, resource, generation, position, chunk)
+            self._activate(merchant_id, resource, generation)
+            completed = True
+        finally:
+            # A partially read collection is not a snapshot; throw away what was written
+            if not completed:
+                connection = self._connection()
+                with connection:
+                    self._drop_generation(connection, merchant_id, resource, generation)
+
+    def _claim_refresh(self, merchant_id, resource):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            claimed = connection.execute(
+                'UPDATE snapshot_meta SET refreshing_until = ? '
+                'WHERE merchant_id = ? AND resource = ? AND refreshing_until < ?',
+                (now + REFRESH_LEASE, merchant_id, resource, now)
+            )
+        return claimed.rowcount == 1
+
+    def _refresh_in_background(self, merchant_id, resource, fetch):
+        # The lease makes sure only one worker refreshes a resource at a time
+        if not self._claim_refresh(merchant_id, resource):
+            return
+
+        def refresh():
+            try:
+                self._store(merchant_id, resource, fetch())
+            except Exception as e:
+                print(f"Error refreshing {resource} snapshot for {merchant_id}: {e}")
+                connection = self._connection()
+                with connection:
+                    connection.execute(
+                        'UPDATE snapshot_meta SET refreshing_until = 0 WHERE merchant_id = ? AND resource = ?',
+                        (merchant_id, resource)
+                    )
+
+        threading.Thread(target=refresh, name=f'snapshot-refresh-{resource}', daemon=True).start()
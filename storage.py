@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+# App Engine only allows writes under /tmp, so local state lives there by default
+DATA_DIR = os.environ.get('FEED_OPTIMIZER_DATA_DIR', os.path.join(tempfile.gettempdir(), 'feed-optimizer'))
+
+_local = threading.local()
+
+
+def data_path(name):
+    """Returns the path of a file in the local data directory, creating the directory."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, name)
+
+
+def connect(path):
+    """Returns this thread's SQLite connection to `path`.
+
+    Databases use WAL mode so several gunicorn workers can read while one writes.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connections[path] = connection
+    return connection
@@ -0,0 +1,256 @@
+import hashlib
+import hmac
+import os
+import time
+import zlib
+from itertools import groupby
+
+from flask import Blueprint, Response, abort, request, stream_with_context, url_for
+
+import storage
+
+DB_NAME = 'feeds.sqlite'
+
+# Content API attribute -> column name in a tab-delimited feed file
+FEED_COLUMNS = {
+    'title': 'title',
+    'description': 'description',
+    'gtin': 'gtin',
+    'mpn': 'mpn',
+    'brand': 'brand',
+    'imageLink': 'image_link',
+    'googleProductCategory': 'google_product_category',
+    'additionalImageLinks': 'additional_image_link',
+    'identifierExists': 'identifier_exists',
+}
+
+# Persistent secret the feed URL tokens are derived from
+TOKEN_SECRET_ENV = 'FEED_TOKEN_SECRET'
+
+# Rows are encoded and flushed to the client in chunks of about this many bytes
+CHUNK_BYTES = 64 * 1024
+
+feeds_bp = Blueprint('feeds', __name__)
+
+
+def offer_id(product_id):
+    """Returns the offer ID (the feed `id` column) of a Content API product ID.
+
+    Product IDs look like `online:en:US:<offerId>`; the offer ID may itself contain colons.
+    """
+    parts = product_id.split(':', 3)
+    return parts[3] if len(parts) == 4 else product_id
+
+
+def clean_value(value):
+    """Makes a value safe for a tab-delimited cell; lists become comma-separated, booleans yes/no."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    if isinstance(value, (list, tuple)):
+        value = ','.join(str(item).replace(',', '%2C') for item in value)
+    return ' '.join(str(value).replace('\t', ' ').splitlines())
+
+
+class OverrideStore:
+    """Attribute overrides per merchant that make up the supplemental feed."""
+
+    def __init__(self, path=None):
+        self.path = path or storage.data_path(DB_NAME)
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS feed_overrides (
+                    merchant_id TEXT NOT NULL,
+                    offer_id TEXT NOT NULL,
+                    attribute TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (merchant_id, offer_id, attribute)
+                );
+                CREATE TABLE IF NOT EXISTS feed_versions (
+                    merchant_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            ''')
+
+    def _connection(self):
+        return storage.connect(self.path)
+
+    def set_overrides(self, merchant_id, overrides):
+        """Stores overrides given as (product_id, {attribute: value}) pairs.
+
+        Only attributes listed in FEED_COLUMNS are accepted. Returns how many
+        attribute values were written.
+        """
+        now = time.time()
+        rows = [
+            (merchant_id, offer_id(product_id), attribute, clean_value(value), now)
+            for product_id, attributes in overrides
+            for attribute, value in attributes.items()
+            if attribute in FEED_COLUMNS
+        ]
+        if not rows:
+            return 0
+
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO feed_overrides (merchant_id, offer_id, attribute, value, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._bump_version(connection, merchant_id, now)
+        return len(rows)
+
+    def clear(self, merchant_id):
+        """Removes every override of a merchant."""
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM feed_overrides WHERE merchant_id = ?', (merchant_id,))
+            self._bump_version(connection, merchant_id, time.time())
+
+    def _bump_version(self, connection, merchant_id, now):
+        connection.execute(
+            'INSERT INTO feed_versions (merchant_id, version, updated_at) VALUES (?, 1, ?) '
+            'ON CONFLICT (merchant_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at',
+            (merchant_id, now)
+        )
+
+    def version(self, merchant_id):
+        """Returns (version, updated_at) of a merchant's feed; (0, None) if it has none."""
+        row = self._connection().execute(
+            'SELECT version, updated_at FROM feed_versions WHERE merchant_id = ?',
+            (merchant_id,)
+        ).fetchone()
+        return row if row else (0, None)
+
+    def columns(self, merchant_id):
+        """Returns the attributes that have at least one override, in FEED_COLUMNS order."""
+        present = {
+            attribute for (attribute,) in self._connection().execute(
+                'SELECT DISTINCT attribute FROM feed_overrides WHERE merchant_id = ?',
+                (merchant_id,)
+            )
+        }
+        return [attribute for attribute in FEED_COLUMNS if attribute in present]
+
+    def iter_rows(self, merchant_id):
+        """Yields (offer_id, {attribute: value}) per product, streamed from one query."""
+        cursor = self._connection().execute(
+            'SELECT offer_id, attribute, value FROM feed_overrides WHERE merchant_id = ? ORDER BY offer_id',
+            (merchant_id,)
+        )
+        for product_offer_id, values in groupby(cursor, key=lambda row: row[0]):
+            yield product_offer_id, {attribute: value for _, attribute, value in values}
+
+
+def iter_feed_lines(rows, attributes):
+    """Yields the lines of a tab-delimited feed: a header, then one line per row."""
+    yield '\t'.join(['id'] + [FEED_COLUMNS[attribute] for attribute in attributes]) + '\n'
+    for product_offer_id, values in rows:
+        cells = [clean_value(product_offer_id)] + [values.get(attribute, '') for attribute in attributes]
+        yield '\t'.join(cells) + '\n'
+
+
+def iter_feed_chunks(rows, attributes, compress=False):
+    """Yields the feed as utf-8 byte chunks of about CHUNK_BYTES, optionally gzip-compressed."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+
+    def flush():
+        data = ''.join(buffer).encode('utf-8')
+        buffer.clear()
+        return compressor.compress(data) if compressor else data
+
+    for line in iter_feed_lines(rows, attributes):
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            size = 0
+            chunk = flush()
+            if chunk:
+                yield chunk
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def write_feed(path, rows, attributes, compress=False):
+    """Writes a feed file incrementally; memory use does not depend on the feed size."""
+    with open(path, 'wb') as f:
+        for chunk in iter_feed_chunks(rows, attributes, compress=compress):
+            f.write(chunk)
+
+
+def feed_token(merchant_id):
+    """Token for the feed URL, so only Merchant Center (which is given the URL) can fetch it.
+
+    The URL is registered once and fetched for months, so the key must be the
+    same in every worker and after every restart; the app's secret key falls
+    back to a random one per process and cannot be used. Returns None while
+    it is not set.
+    """
+    key = os.environ.get(TOKEN_SECRET_ENV)
+    if not key:
+        return None
+    return hmac.new(key.encode('utf-8'), f'supplemental-feed:{merchant_id}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def feed_url(merchant_id):
+    """Signed URL of a merchant's supplemental feed, or None while feeds cannot be signed."""
+    token = feed_token(merchant_id)
+    if token is None:
+        return None
+    return url_for('feeds.supplemental_feed', merchant_id=merchant_id, compress=False, token=token, _external=True)
+
+
+override_store = None
+
+
+def get_override_store():
+    global override_store
+    if override_store is None:
+        override_store = OverrideStore()
+    return override_store
+
+
+@feeds_bp.route('/<merchant_id>/supplemental.tsv', defaults={'compress': False})
+@feeds_bp.route('/<merchant_id>/supplemental.tsv.gz', defaults={'compress': True})
+def supplemental_feed(merchant_id, compress):
+    """Serve a merchant's supplemental feed for Merchant Center's scheduled fetch."""
+    token = feed_token(merchant_id)
+    if token is None:
+        # Not configured on this deployment
+        abort(503)
+    if not hmac.compare_digest(request.args.get('token', ''), token):
+        abort(404)
+
+    store = get_override_store()
+    version, updated_at = store.version(merchant_id)
+    etag = hashlib.sha1(f'{merchant_id}:{version}:{compress}'.encode('utf-8')).hexdigest()
+
+    response = Response(mimetype='application/gzip' if compress else 'text/tab-separated-values')
+    response.set_etag(etag)
+    if updated_at:
+        response.last_modified = updated_at
+    response.cache_control.no_cache = True
+
+    # Merchant Center can skip downloading a feed that has not changed since its last fetch
+    if request.if_none_match.contains(etag) or (
+        not request.if_none_match and updated_at and request.if_modified_since
+        and int(updated_at) <= request.if_modified_since.timestamp()
+    ):
+        response.status_code = 304
+        return response
+
+    attributes = store.columns(merchant_id)
+    response.response = stream_with_context(
+        iter_feed_chunks(store.iter_rows(merchant_id), attributes, compress=compress)
+    )
+    return response
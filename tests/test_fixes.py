@@ -0,0 +1,134 @@
+"""products.custombatch partitioning and retry tests, with a stand-in Content API client."""
+import unittest
+from unittest import mock
+
+import fixes
+
+
+def plan(index):
+    return {'product_id': f'online:en:US:{index}', 'patch': {'title': f'Title {index}'}}
+
+
+def error(code, reason, message='Failed'):
+    return {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}
+
+
+class StubProducts:
+    """Records the entries of each custombatch call; the patched scheduler answers them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def products(self):
+        return self
+
+    def custombatch(self, body):
+        self.calls.append(body['entries'])
+        return body['entries']
+
+
+class PushBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(fixes.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def push(self, plans, respond):
+        self.client = StubProducts()
+        with mock.patch.object(fixes.scheduler, 'execute', lambda entries, merchant_id: respond(entries)):
+            return fixes.push_batch(lambda: self.client, '123', plans)
+
+    def sent(self):
+        return [[entry['productId'] for entry in entries] for entries in self.client.calls]
+
+    def test_all_entries_succeed(self):
+        def respond(entries):
+            return {'entries': [{'batchId': entry['batchId']} for entry in entries]}
+
+        self.assertEqual(self.push([plan(index) for index in range(3)], respond), (3, []))
+        self.assertEqual(len(self.client.calls), 1)
+        entry = self.client.calls[0][0]
+        self.assertEqual((entry['method'], entry['merchantId'], entry['updateMask']), ('update', '123', 'title'))
+        self.sleep.assert_not_called()
+
+    def test_only_retryable_entries_are_sent_again(self):
+        responses = iter([
+            lambda entry: error(503, 'backendError') if entry['batchId'] == 1 else
+                          error(400, 'invalid', 'Invalid GTIN') if entry['batchId'] == 2 else {},
+            lambda entry: {},
+        ])
+
+        def respond(entries):
+            answer = next(responses)
+            return {'entries': [{'batchId': entry['batchId'], 'errors': answer(entry) or None} for entry in entries]}
+
+        updated, failed = self.push([plan(index) for index in range(3)], respond)
+        self.assertEqual(updated, 2)
+        self.assertEqual(failed, [('online:en:US:2', 'Invalid GTIN')])
+        self.assertEqual(self.sent(), [['online:en:US:0', 'online:en:US:1', 'online:en:US:2'], ['online:en:US:1']])
+
+    def test_entries_missing_from_the_response_are_retried(self):
+        def respond(entries):
+            return {'entries': [{'batchId': entry['batchId']} for entry in entries if entry['batchId'] != 0 or len(entries) == 1]}
+
+        self.assertEqual(self.push([plan(0), plan(1)], respond), (2, []))
+        self.assertEqual(self.sent(), [['online:en:US:0', 'online:en:US:1'], ['online:en:US:0']])
+
+    def test_retries_give_up_after_max_attempts(self):
+        def respond(entries):
+            return {'entries': [{'batchId': entry['batchId'], 'errors': error(429, 'rateLimitExceeded', 'Slow down')} for entry in entries]}
+
+        self.assertEqual(self.push([plan(0)], respond), (0, [('online:en:US:0', 'Slow down')]))
+        self.assertEqual(len(self.client.calls), fixes.MAX_ATTEMPTS)
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [fixes.RETRY_DELAY, fixes.RETRY_DELAY * 2])
+
+    def test_failed_request_fails_every_entry(self):
+        def respond(entries):
+            raise RuntimeError('Token revoked')
+
+        self.assertEqual(
+            self.push([plan(0), plan(1)], respond),
+            (0, [('online:en:US:0', 'Token revoked'), ('online:en:US:1', 'Token revoked')])
+        )
+        self.assertEqual(len(self.client.calls), 1)
+
+
+class FixProductsTest(unittest.TestCase):
+
+    def products(self, count):
+        return [{'id': f'online:en:US:{index}', 'title': 'Shirt', 'brand': 'Acme', 'color': 'Red'} for index in range(count)]
+
+    def test_plans_are_sent_in_batches(self):
+        sent = []
+
+        def push_batch(client_factory, merchant_id, plans):
+            sent.append([plan['product_id'] for plan in plans])
+            return len(plans) - 1, [(plans[-1]['product_id'], 'Invalid')]
+
+        with mock.patch.object(fixes, 'CUSTOMBATCH_MAX_ENTRIES', 2), mock.patch.object(fixes, 'push_batch', push_batch):
+            report = fixes.fix_products(None, '123', self.products(5), ['titles'], dry_run=False, max_batches_in_flight=2)
+        self.assertEqual(sorted(len(batch) for batch in sent), [1, 2, 2])
+        self.assertEqual(sorted(product_id for batch in sent for product_id in batch), [p['id'] for p in self.products(5)])
+        self.assertEqual((report['products_planned'], report['updated'], report['failed']), (5, 2, 3))
+        self.assertEqual(len(report['errors']), 3)
+
+    def test_dry_run_sends_nothing(self):
+        with mock.patch.object(fixes, 'push_batch') as push_batch:
+            report = fixes.fix_products(None, '123', self.products(3), ['titles'])
+        push_batch.assert_not_called()
+        self.assertEqual((report['products_planned'], report['updated']), (3, 0))
+
+    def test_feed_store_receives_the_patches(self):
+        feed_store = mock.Mock()
+        with mock.patch.object(fixes, 'push_batch') as push_batch:
+            report = fixes.fix_products(None, '123', self.products(3), ['titles'], dry_run=False, feed_store=feed_store)
+        push_batch.assert_not_called()
+        (merchant_id, overrides), _ = feed_store.set_overrides.call_args
+        self.assertEqual(merchant_id, '123')
+        self.assertEqual([product_id for product_id, _ in overrides], [p['id'] for p in self.products(3)])
+        self.assertEqual(report['updated'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
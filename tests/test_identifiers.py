@@ -0,0 +1,129 @@
+"""GTIN checksum and duplicate-identifier index tests."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import identifiers
+import incremental
+import issue_index
+
+VALID_GTINS = ('4006381333931', '036000291452', '96385074', '10012345678902', '0036000291452')
+
+
+def product(product_id, offer_id=None, **attributes):
+    return {'id': product_id, 'offerId': offer_id or product_id, **attributes}
+
+
+class GtinTest(unittest.TestCase):
+
+    def test_valid(self):
+        for gtin in VALID_GTINS:
+            self.assertTrue(identifiers.is_valid_gtin(gtin), gtin)
+        self.assertTrue(identifiers.is_valid_gtin(' 4006381333931 '))
+
+    def test_wrong_check_digit(self):
+        self.assertFalse(identifiers.is_valid_gtin('4006381333932'))
+        self.assertFalse(identifiers.is_valid_gtin('036000291453'))
+
+    def test_malformed(self):
+        for value in ('', '1234567', '400638133393a', '４００６３８１３３３９３１', '0' * 13, 4006381333931, None):
+            self.assertFalse(identifiers.is_valid_gtin(value), value)
+
+    def test_upc_and_ean_are_the_same_identifier(self):
+        self.assertEqual(identifiers.normalize_gtin('036000291452'), identifiers.normalize_gtin('0036000291452'))
+
+    def test_mask_matches_single_checks(self):
+        values = [*VALID_GTINS, '4006381333932', '00000000', 'abc', None, '12345678901234567']
+        self.assertEqual(
+            identifiers.valid_gtin_mask(values).tolist(),
+            [identifiers.is_valid_gtin(value) for value in values]
+        )
+        self.assertEqual(identifiers.valid_gtin_mask([]).tolist(), [])
+
+
+class IdentifierIndexTest(unittest.TestCase):
+
+    def test_shared_gtin(self):
+        index = identifiers.IdentifierIndex([
+            product('a', gtin='036000291452'),
+            product('b', gtin='0036000291452'),
+            product('c', gtin='4006381333931'),
+            product('d', gtin='036000291452'),
+        ])
+        self.assertEqual(list(index.duplicates()), [('duplicate_gtin', '00036000291452', ['a', 'b', 'd'])])
+        self.assertEqual(index.codes_by_product(), {'a': ['duplicate_gtin'], 'b': ['duplicate_gtin'], 'd': ['duplicate_gtin']})
+
+    def test_same_offer_in_other_countries(self):
+        index = identifiers.IdentifierIndex([
+            product('online:en:US:1', '1', gtin='4006381333931'),
+            product('online:en:GB:1', '1', gtin='4006381333931'),
+        ])
+        self.assertEqual(list(index.duplicates()), [])
+        index.add(product('online:en:US:2', '2', gtin='4006381333931'))
+        self.assertEqual(
+            sorted(index.codes_by_product()),
+            ['online:en:GB:1', 'online:en:US:1', 'online:en:US:2']
+        )
+
+    def test_brand_and_mpn_without_gtin(self):
+        index = identifiers.IdentifierIndex([
+            product('a', brand='Acme', mpn='X-1'),
+            product('b', brand=' acme ', mpn='x-1'),
+            product('c', brand='Acme', mpn='X-1', gtin='4006381333931'),
+            product('d', mpn='X-1'),
+        ])
+        self.assertEqual(list(index.duplicates()), [('duplicate_mpn', 'acme / x-1', ['a', 'b'])])
+
+    def test_check_catalog(self):
+        report = identifiers.check_catalog([
+            product('a', gtin='4006381333931'),
+            product('b', gtin='4006381333931'),
+            product('c', gtin='4006381333932'),
+            product('d'),
+        ], batch_size=2)
+        self.assertEqual(report['products_checked'], 4)
+        self.assertEqual(report['products_with_gtin'], 3)
+        self.assertEqual(report['invalid_gtins'], 1)
+        self.assertEqual(report['duplicate_gtins'], 1)
+        self.assertEqual(report['products_with_duplicates'], 2)
+
+
+class CatalogDuplicatesTest(unittest.TestCase):
+    """Duplicates found at the end of an analysis pass reach the product index and the issue histogram."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        self.store = incremental.AnalysisStore(os.path.join(self.data_dir, 'analysis.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_duplicates_are_attached(self):
+        products = [
+            product(str(index), title='A title that is long enough', description='x' * 100, imageLink='i',
+                    **({'gtin': '4006381333931'} if index in (1, 5000) else {'identifierExists': False}))
+            for index in range(issue_index.ID_CHUNK_SIZE + 1000)
+        ]
+        results = self.store.analyze_products(products, [])
+        histogram = issue_index.IssueHistogram()
+        for result in results:
+            histogram.add(None, result)
+        self.store.index_products('1', results)
+        histogram.finish()
+
+        duplicates = identifiers.IdentifierIndex(products).codes_by_product()
+        self.store.add_product_issues('1', duplicates, identifiers.IDENTIFIER_CHECKS)
+        histogram.add_check_issues(duplicates, identifiers.IDENTIFIER_CHECKS)
+
+        self.assertEqual(histogram.products('duplicate_gtin', 'Shopping'), ['1', '5000'])
+        self.assertIn(('duplicate_gtin', 'gtin', '', 'warning'), histogram.counts)
+        total, page = self.store.page_products('1', code='duplicate_gtin')
+        self.assertEqual(total, 2)
+        self.assertEqual({result['status'] for result in page}, {'warning'})
+        self.assertEqual(self.store.page_products('1', status='warning')[0], 2)
+        self.assertEqual(self.store.page_products('1', status='good')[0], len(products) - 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
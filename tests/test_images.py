@@ -0,0 +1,180 @@
+"""Image link validator tests, against the local HTTP stand-in in bench/."""
+import http.client
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from itertools import count
+
+import images
+from bench import content_api_server
+
+
+def image_name(predicate):
+    """First synthetic image name whose (content type, body) matches `predicate`."""
+    for index in count():
+        name = f'test-{index}.img'
+        if predicate(*content_api_server.synthetic_image(name)):
+            return name
+
+
+def is_image(image_format, min_size=images.MIN_IMAGE_SIZE):
+    def predicate(content_type, body):
+        size = images.image_size(image_format, body) if body else None
+        return content_type == f'image/{image_format}' and size is not None and min(size) >= min_size
+    return predicate
+
+
+def late_jpeg(content_type, body):
+    """A JPEG whose frame header is past the first range."""
+    return content_type == 'image/jpeg' and images.image_size('jpeg', body[:images.HEAD_BYTES]) is None
+
+
+class SniffTest(unittest.TestCase):
+
+    def test_synthetic_formats(self):
+        for image_format in ('jpeg', 'png', 'webp', 'gif'):
+            _, body = content_api_server.synthetic_image(image_name(is_image(image_format)))
+            self.assertEqual(images.sniff_format(body), image_format)
+            width, height = images.image_size(image_format, body)
+            self.assertEqual(width, height)
+            self.assertIn(width, (400, 800, 1200))
+
+    def test_bmp_and_tiff(self):
+        bmp = b'BM' + bytes(16) + struct.pack('<ii', 640, -480)
+        self.assertEqual(images.sniff_format(bmp), 'bmp')
+        self.assertEqual(images.image_size('bmp', bmp), (640, 480))
+        self.assertEqual(images.sniff_format(b'II*\x00' + bytes(8)), 'tiff')
+
+    def test_not_an_image(self):
+        self.assertIsNone(images.sniff_format(b'<!doctype html>'))
+        self.assertIsNone(images.image_size(None, b'<!doctype html>'))
+
+    def test_truncated_jpeg(self):
+        _, body = content_api_server.synthetic_image(image_name(late_jpeg))
+        self.assertIsNone(images.image_size('jpeg', body[:images.HEAD_BYTES]))
+        self.assertIsNotNone(images.image_size('jpeg', body[:images.JPEG_SCAN_BYTES]))
+
+
+class ValidatorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base_url, cls.config = content_api_server.serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        with self.config.lock:
+            self.config.requests.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def validator(self, **options):
+        options.setdefault('allow_private', True)
+        validator = images.ImageValidator(cache=images.ImageCache(os.path.join(self.data_dir, 'images.sqlite')), **options)
+        self.addCleanup(validator.close)
+        return validator
+
+    def requests(self, route):
+        with self.config.lock:
+            return self.config.requests.get(route, 0)
+
+    def test_results(self):
+        names = {
+            'ok': image_name(is_image('png')),
+            'broken': image_name(lambda content_type, body: body is None),
+            'wrong_type': image_name(lambda content_type, body: body is not None and content_type.startswith('text/html')),
+            'too_small': image_name(lambda content_type, body: body is not None and images.image_size('gif', body) == (60, 60)),
+        }
+        urls = {expected: f'{self.base_url}/img/{name}' for expected, name in names.items()}
+        results = self.validator().check(urls.values())
+        self.assertEqual(results[urls['ok']]['problem'], None)
+        self.assertEqual(results[urls['ok']]['format'], 'png')
+        self.assertEqual(results[urls['broken']]['problem'], 'broken')
+        self.assertEqual(results[urls['broken']]['status'], 404)
+        self.assertEqual(results[urls['wrong_type']]['problem'], 'wrong_type')
+        self.assertEqual(results[urls['too_small']]['problem'], 'too_small')
+
+    def test_range_requests(self):
+        url = f'{self.base_url}/img/{image_name(is_image("png"))}'
+        result = self.validator().check([url])[url]
+        # The stand-in honours Range, so only the head of the file is sent
+        self.assertEqual(result['status'], 206)
+        self.assertEqual(self.requests('image'), 1)
+
+    def test_jpeg_with_late_frame_header(self):
+        name = image_name(late_jpeg)
+        _, body = content_api_server.synthetic_image(name)
+        url = f'{self.base_url}/img/{name}'
+        result = self.validator().check([url])[url]
+        self.assertEqual((result['width'], result['height']), images.image_size('jpeg', body))
+        # A second, longer range is fetched for the frame header
+        self.assertEqual(self.requests('image'), 2)
+
+    def test_redirect(self):
+        name = image_name(is_image('webp'))
+        url = f'{self.base_url}/redirect/{name}'
+        result = self.validator().check([url])[url]
+        self.assertEqual(result['problem'], None)
+        self.assertEqual(result['format'], 'webp')
+        self.assertEqual(self.requests('redirect'), 1)
+        self.assertEqual(self.requests('image'), 1)
+
+    def test_cached_results_are_revalidated(self):
+        url = f'{self.base_url}/img/{image_name(is_image("jpeg"))}'
+        validator = self.validator(cache_ttl=0)
+        first = validator.check([url])[url]
+        self.assertTrue(first['etag'])
+
+        second = validator.check([url])[url]
+        self.assertEqual(self.requests('image_not_modified'), 1)
+        for key in ('status', 'format', 'width', 'height', 'etag', 'problem'):
+            self.assertEqual(second[key], first[key])
+        self.assertGreaterEqual(second['checked_at'], first['checked_at'])
+
+    def test_fresh_results_come_from_the_cache(self):
+        url = f'{self.base_url}/img/{image_name(is_image("png"))}'
+        validator = self.validator()
+        validator.check([url])
+        validator.check([url])
+        self.assertEqual(self.requests('image'), 1)
+
+    def test_connections_are_reused(self):
+        created = []
+
+        class CountingConnection(http.client.HTTPConnection):
+            def connect(self):
+                created.append(self)
+                super().connect()
+
+        validator = self.validator(max_workers=4)
+        pool = validator._pool('http', self.base_url.split('://', 1)[1])
+        pool.connection_class = CountingConnection
+        urls = [f'{self.base_url}/img/reuse-{index}.img' for index in range(100)]
+        validator.check(urls)
+        self.assertGreaterEqual(self.requests('image'), 100)
+        self.assertLessEqual(len(created), 4)
+
+    def test_private_addresses_are_refused(self):
+        url = f'{self.base_url}/img/{image_name(is_image("png"))}'
+        result = self.validator(allow_private=False).check([url])[url]
+        self.assertEqual(result['problem'], 'broken')
+        self.assertEqual(self.requests('image'), 0)
+
+    def test_public_address_check(self):
+        for address in ('8.8.8.8', '2001:4860:4860::8888'):
+            self.assertTrue(images.is_public_address(address), address)
+        for address in ('127.0.0.1', '10.1.2.3', '192.168.0.1', '169.254.169.254', '100.64.0.1',
+                        '::1', 'fe80::1%eth0', '::ffff:127.0.0.1', '224.0.0.1', '0.0.0.0'):
+            self.assertFalse(images.is_public_address(address), address)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Fingerprint cache and incremental account counter tests, on a temporary SQLite store."""
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import analyzer
+import incremental
+
+
+def product(index, **attributes):
+    return {
+        'id': f'online:en:US:{index}',
+        'title': f'Organic cotton t-shirt number {index}',
+        'description': 'A soft t-shirt. ' * 10,
+        'gtin': '4006381333931',
+        'imageLink': f'https://shop.example.com/{index}.jpg',
+        **attributes,
+    }
+
+
+def status(index, issues=(), disapproved=False):
+    return {
+        'productId': f'online:en:US:{index}',
+        'itemLevelIssues': [{'code': code, 'servability': 'demoted', 'destination': 'Shopping'} for code in issues],
+        'destinationStatuses': [{'destination': 'Shopping', 'status': 'disapproved' if disapproved else 'approved'}],
+    }
+
+
+class FingerprintCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        self.store = incremental.AnalysisStore(os.path.join(self.data_dir, 'analysis.sqlite'))
+        patcher = mock.patch.object(incremental.analyzer, 'analyze_product', wraps=analyzer.analyze_product)
+        self.analyze_product = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_miss_then_hit(self):
+        products = [product(index) for index in range(3)]
+        statuses = [status(index) for index in range(3)]
+        first = self.store.analyze_products(products, statuses)
+        self.assertEqual(self.analyze_product.call_count, 3)
+
+        self.analyze_product.reset_mock()
+        self.assertEqual(self.store.analyze_products(products, statuses), first)
+        self.analyze_product.assert_not_called()
+
+    def test_changed_product_or_status_is_analyzed_again(self):
+        products = [product(index) for index in range(3)]
+        statuses = [status(index) for index in range(3)]
+        self.store.analyze_products(products, statuses)
+
+        self.analyze_product.reset_mock()
+        products[0] = product(0, title='Short')
+        statuses[1] = status(1, issues=['image_too_small'])
+        results = self.store.analyze_products(products, statuses)
+        self.assertEqual(self.analyze_product.call_count, 2)
+        self.assertEqual([issue['code'] for issue in results[0]['issues']['warning']], ['short_title'])
+        self.assertEqual([issue['code'] for issue in results[1]['issues']['warning']], ['image_too_small'])
+
+    def test_changed_checks_invalidate_results(self):
+        products = [product(0)]
+        self.store.analyze_products(products, [])
+        self.analyze_product.reset_mock()
+        with mock.patch.object(incremental, 'RULES_DIGEST', 'other rules'):
+            self.store.analyze_products(products, [])
+        self.assertEqual(self.analyze_product.call_count, 1)
+
+    def test_hit_keeps_the_result_from_being_pruned(self):
+        used, unused = product(0), product(1)
+        self.store.analyze_products([used, unused], [])
+        connection = self.store._connection()
+        with connection:
+            connection.execute('UPDATE product_results SET updated_at = 0')
+
+        self.store.analyze_products([used], [])
+        self.store.prune()
+        self.analyze_product.reset_mock()
+        self.store.analyze_products([used, unused], [])
+        self.assertEqual([call.args[0] for call in self.analyze_product.call_args_list], [unused])
+
+
+class AccountStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        self.store = incremental.AnalysisStore(os.path.join(self.data_dir, 'analysis.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_passes_apply_changes_and_removals(self):
+        statuses = [status(index, issues=['a'] * (index % 3), disapproved=index % 4 == 0) for index in range(20)]
+        self.assertEqual(self.store.update_account_stats('1', statuses), analyzer.count_statuses(statuses))
+
+        statuses = copy.deepcopy(statuses[:15])
+        statuses[0] = status(0, issues=['a', 'b', 'c'])
+        statuses[1] = status(1, disapproved=True)
+        self.assertEqual(self.store.update_account_stats('1', statuses), analyzer.count_statuses(statuses))
+        self.assertEqual(self.store.products_count('1'), 15)
+
+    def test_merchants_are_counted_apart(self):
+        self.store.update_account_stats('1', [status(0, issues=['a'])])
+        self.assertEqual(self.store.update_account_stats('2', [status(0), status(1)]), (2, 0, 0))
+        self.assertEqual(self.store.products_count('1'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""MinHash/LSH near-duplicate detection tests."""
+import unittest
+from unittest import mock
+
+import near_duplicates
+
+TITLE = 'Organic cotton crew neck t-shirt for men, heather grey, regular fit'
+OTHER_TITLE = 'Stainless steel espresso machine with milk frother and grinder'
+
+
+def pairs(texts, groups=None):
+    index = near_duplicates.MinHashLSH()
+    index.add_batch(range(len(texts)), [near_duplicates.title_shingles(text) for text in texts])
+    return sorted(tuple(sorted(pair)) for pair in index.similar_pairs(groups))
+
+
+def product(product_id, title, group=None, description=''):
+    return {'id': product_id, 'itemGroupId': group, 'title': title, 'description': description}
+
+
+class ShingleTest(unittest.TestCase):
+
+    def test_titles_are_normalized(self):
+        self.assertEqual(
+            near_duplicates.title_shingles('T-Shirt, GREY!'),
+            near_duplicates.title_shingles('t shirt grey')
+        )
+        self.assertEqual(near_duplicates.title_shingles(' ... '), [])
+        self.assertEqual(len(near_duplicates.title_shingles('ab')), 1)
+
+    def test_descriptions_use_the_first_words(self):
+        words = ' '.join(f'word{index}' for index in range(near_duplicates.DESCRIPTION_WORDS + 50))
+        shingles = near_duplicates.description_shingles(words)
+        self.assertEqual(len(shingles), near_duplicates.DESCRIPTION_WORDS - near_duplicates.DESCRIPTION_SHINGLE_SIZE + 1)
+        self.assertEqual(near_duplicates.description_shingles('two words'), near_duplicates.description_shingles('Two, words.'))
+
+
+class MinHashLSHTest(unittest.TestCase):
+
+    def test_identical_and_near_identical_texts(self):
+        # Texts linked to a bucket's first text are not compared with each other; clusters join them
+        found = pairs([TITLE, OTHER_TITLE, TITLE, TITLE.replace('grey', 'gray')])
+        self.assertEqual(found, [(0, 2), (0, 3)])
+        self.assertEqual(near_duplicates.clusters(found, [0, 1, 2, 3]), [[0, 2, 3]])
+
+    def test_unrelated_texts(self):
+        self.assertEqual(pairs([TITLE, OTHER_TITLE, 'Wireless noise cancelling headphones, black']), [])
+
+    def test_texts_without_shingles_are_skipped(self):
+        self.assertEqual(pairs(['', TITLE, '', TITLE]), [(1, 3)])
+
+    def test_pairs_within_a_group_are_left_out(self):
+        self.assertEqual(pairs([TITLE, TITLE, OTHER_TITLE], groups=[7, 7, 8]), [])
+
+    def test_group_mates_of_the_first_text_meet_the_other_groups(self):
+        found = pairs([TITLE, TITLE, TITLE], groups=[1, 1, 2])
+        self.assertEqual(near_duplicates.clusters(found, [1, 1, 2]), [[0, 1, 2]])
+
+    def test_bucket_leaders_are_capped(self):
+        # Every text shares the bucket, and only the first MAX_BUCKET_LEADERS texts lead it
+        with mock.patch.object(near_duplicates, 'MAX_BUCKET_LEADERS', 1):
+            found = pairs([TITLE] * 6, groups=list(range(6)))
+        self.assertEqual(found, [(0, row) for row in range(1, 6)])
+
+    def test_bands_must_divide_the_permutations(self):
+        with self.assertRaises(ValueError):
+            near_duplicates.MinHashLSH(num_perm=10, bands=3)
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+
+    def test_codes_by_product(self):
+        index = near_duplicates.NearDuplicateIndex()
+        index.add_batch([product('a', TITLE, 'g1'), product('b', TITLE, 'g1'), product('c', OTHER_TITLE)])
+        index.add_batch([product('d', TITLE, 'g2')])
+        self.assertEqual(
+            index.codes_by_product(),
+            {'a': ['near_duplicate_title'], 'b': ['near_duplicate_title'], 'd': ['near_duplicate_title']}
+        )
+
+    def test_variants_of_one_item_are_not_duplicates(self):
+        index = near_duplicates.NearDuplicateIndex()
+        index.add_batch([product('a', TITLE, 'g1'), product('b', TITLE, 'g1')])
+        self.assertEqual(index.codes_by_product(), {})
+
+    def test_check_catalog(self):
+        description = 'A soft and breathable shirt made from organic cotton, cut for everyday wear. ' * 3
+        report = near_duplicates.check_catalog([
+            product('a', TITLE, description=description),
+            product('b', TITLE.upper(), description=description),
+            product('c', OTHER_TITLE),
+        ], batch_size=2)
+        self.assertEqual(report['products_checked'], 3)
+        for code in near_duplicates.NEAR_DUPLICATE_CHECKS:
+            self.assertEqual(report['checks'][code]['clusters'], 1)
+            self.assertEqual(report['checks'][code]['examples'], [{'size': 2, 'product_ids': ['a', 'b']}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Request scheduler tests with stand-in googleapiclient requests."""
+import json
+import unittest
+from unittest import mock
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import scheduler
+
+
+def http_error(status, reason):
+    content = json.dumps({'error': {'errors': [{'reason': reason}], 'message': reason}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content, uri='https://example.com')
+
+
+class StubRequest:
+    """Raises or returns the given outcomes in turn, like HttpRequest.execute()."""
+
+    methodId = 'content.products.list'
+    uri = 'https://shoppingcontent.googleapis.com/content/v2.1/123/products'
+    http = None
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def execute(self, http=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.RequestScheduler(rate=1000, burst=1000, max_attempts=3)
+        patcher = mock.patch.object(scheduler.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def limit(self, merchant_id='123'):
+        return self.scheduler.limits[merchant_id]
+
+    def test_success(self):
+        request = StubRequest({'resources': [{'id': '1'}]})
+        self.assertEqual(self.scheduler.execute(request), {'resources': [{'id': '1'}]})
+        self.assertEqual(self.limit().in_flight, 0)
+        self.assertEqual(self.scheduler.stats('123')[0]['succeeded'], 1)
+
+    def test_retryable_errors_are_retried(self):
+        request = StubRequest(http_error(503, 'backendError'), ConnectionResetError(), {'ok': True})
+        self.assertEqual(self.scheduler.execute(request), {'ok': True})
+        self.assertEqual(request.calls, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(self.limit().in_flight, 0)
+        self.assertEqual(self.scheduler.stats('123')[0]['retries'], 2)
+
+    def test_quota_errors_halve_the_limit(self):
+        request = StubRequest(http_error(429, 'rateLimitExceeded'), {'ok': True})
+        self.scheduler.execute(request)
+        self.assertLess(self.limit().limit, scheduler.INITIAL_CONCURRENCY)
+        self.assertEqual(self.scheduler.stats('123')[0]['quota_errors'], 1)
+
+    def test_final_failure_is_raised(self):
+        request = StubRequest(*[http_error(500, 'backendError')] * 3)
+        with self.assertRaises(scheduler.ContentApiError) as raised:
+            self.scheduler.execute(request)
+        self.assertEqual(raised.exception.attempts, 3)
+        self.assertEqual(raised.exception.merchant_id, '123')
+        self.assertEqual(self.limit().in_flight, 0)
+
+    def test_errors_that_are_not_retryable_fail_at_once(self):
+        request = StubRequest(http_error(404, 'notFound'))
+        with self.assertRaises(scheduler.ContentApiError):
+            self.scheduler.execute(request)
+        self.assertEqual(request.calls, 1)
+
+    def test_unexpected_errors_release_the_slot(self):
+        for _ in range(scheduler.INITIAL_CONCURRENCY + 1):
+            with self.assertRaises(ValueError):
+                self.scheduler.execute(StubRequest(ValueError('unparsable body')))
+        self.assertEqual(self.limit().in_flight, 0)
+        # Would block in AdaptiveLimit.acquire() if the failed calls had kept their slots
+        self.assertEqual(self.scheduler.execute(StubRequest({'ok': True})), {'ok': True})
+        self.assertEqual(self.scheduler.stats('123')[0]['failed'], scheduler.INITIAL_CONCURRENCY + 1)
+
+    def test_postproc_is_restored(self):
+        request = StubRequest(ValueError('unparsable body'))
+        postproc = request.postproc = lambda resp, content: content
+        with self.assertRaises(ValueError):
+            self.scheduler.execute(request)
+        self.assertIs(request.postproc, postproc)
+
+    def test_request_budget(self):
+        with scheduler.request_budget(1):
+            self.scheduler.execute(StubRequest({'ok': True}))
+            with self.assertRaises(scheduler.RequestBudgetExceeded):
+                self.scheduler.execute(StubRequest({'ok': True}))
+
+
+if __name__ == '__main__':
+    unittest.main()
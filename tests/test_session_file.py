@@ -0,0 +1,134 @@
+"""Server-side session tests: session IDs, regeneration on login and both backends."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask import Flask, session
+
+import session_file
+import storage
+
+
+class ServerSessionTest(unittest.TestCase):
+
+    session_type = 'sqlite'
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.app = Flask(__name__)
+        self.app.secret_key = 'test'
+        self.app.config.update(
+            SESSION_TYPE=self.session_type,
+            SESSION_FILE_DIR=f'{self.data_dir}/sessions',
+            SESSION_SQLITE_PATH=f'{self.data_dir}/sessions.sqlite',
+        )
+        self.app.session_interface = session_file.create_session_interface(self.app)
+        self.backend = self.app.session_interface.backend
+
+        @self.app.route('/start')
+        def start():
+            session['oauth_state'] = 'state'
+            return 'ok'
+
+        @self.app.route('/login')
+        def login():
+            session_file.regenerate_session(session)
+            session['credentials'] = {'token': 'secret'}
+            return 'ok'
+
+        @self.app.route('/whoami')
+        def whoami():
+            return repr(session.get('credentials'))
+
+        @self.app.route('/logout')
+        def logout():
+            session.clear()
+            return 'ok'
+
+        self.client = self.app.test_client()
+
+    def sid(self, client=None):
+        cookie = (client or self.client).get_cookie('session')
+        return cookie.value if cookie else None
+
+    def test_cookie_only_carries_the_id(self):
+        self.client.get('/start')
+        sid = self.sid()
+        self.assertRegex(sid, session_file.SESSION_ID_PATTERN)
+        self.assertIn('state', self.backend.load(sid))
+        self.assertNotIn('state', sid)
+
+    def test_no_session_is_stored_until_it_has_data(self):
+        self.client.get('/whoami')
+        self.assertIsNone(self.sid())
+
+    def test_login_moves_the_session_to_a_new_id(self):
+        self.client.get('/start')
+        planted = self.sid()
+        self.client.get('/login')
+        self.assertNotEqual(self.sid(), planted)
+        self.assertIsNone(self.backend.load(planted))
+        self.assertEqual(self.client.get('/whoami').text, "{'token': 'secret'}")
+
+        # Whoever knew the ID from before the login does not get the logged in session
+        attacker = self.app.test_client()
+        attacker.set_cookie('session', planted)
+        self.assertEqual(attacker.get('/whoami').text, 'None')
+
+    def test_login_without_a_previous_session(self):
+        self.client.get('/login')
+        self.assertEqual(self.client.get('/whoami').text, "{'token': 'secret'}")
+
+    def test_logout_deletes_the_session(self):
+        self.client.get('/login')
+        sid = self.sid()
+        self.client.get('/logout')
+        self.assertIsNone(self.sid())
+        self.assertIsNone(self.backend.load(sid))
+
+    def test_malformed_or_unknown_ids_get_a_new_session(self):
+        for value in ('../../etc/passwd', 'x' * 40):
+            client = self.app.test_client()
+            client.set_cookie('session', value)
+            client.get('/start')
+            self.assertNotEqual(self.sid(client), value)
+
+    def stored_sessions(self):
+        return storage.connect(self.backend.path).execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def test_expired_sessions_are_pruned(self):
+        self.backend.save('a' * 43, '{}', 0)
+        self.backend.save('b' * 43, '{}', time.time() + 60)
+        self.assertIsNone(self.backend.load('a' * 43))
+        self.backend.prune()
+        self.assertEqual(self.stored_sessions(), 1)
+        self.assertEqual(self.backend.load('b' * 43), '{}')
+
+    def test_regenerate_ignores_cookie_sessions(self):
+        cookie_session = {'credentials': 'x'}
+        session_file.regenerate_session(cookie_session)
+        self.assertEqual(cookie_session, {'credentials': 'x'})
+
+
+class FileSystemSessionTest(ServerSessionTest):
+
+    session_type = 'filesystem'
+
+    def stored_sessions(self):
+        return len(os.listdir(self.backend.directory))
+
+
+class UnsupportedSessionTypeTest(unittest.TestCase):
+
+    def test_unknown_type(self):
+        app = Flask(__name__)
+        app.config['SESSION_TYPE'] = 'redis'
+        with self.assertRaises(ValueError):
+            session_file.create_session_interface(app)
+
+
+if __name__ == '__main__':
+    unittest.main()
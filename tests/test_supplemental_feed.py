@@ -0,0 +1,124 @@
+"""Supplemental feed tests: signed URLs and conditional GET, on a temporary override store."""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+import supplemental_feed
+
+
+class SupplementalFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='feed-optimizer-test-')
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.store = supplemental_feed.OverrideStore(os.path.join(self.data_dir, 'feeds.sqlite'))
+        self.store.set_overrides('123', [
+            ('online:en:US:1', {'title': 'Organic cotton t-shirt', 'gtin': '4006381333931'}),
+            ('online:en:US:2', {'title': 'Tab\tseparated', 'price': 'ignored'}),
+        ])
+        for patcher in (
+            mock.patch.object(supplemental_feed, 'override_store', self.store),
+            mock.patch.dict(os.environ, {supplemental_feed.TOKEN_SECRET_ENV: 'secret'}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.app = Flask(__name__)
+        self.app.config['SERVER_NAME'] = 'feeds.example.com'
+        self.app.register_blueprint(supplemental_feed.feeds_bp, url_prefix='/feeds')
+        self.client = self.app.test_client()
+
+    def get(self, merchant_id='123', gz=False, token=None, headers=None):
+        if token is None:
+            token = supplemental_feed.feed_token(merchant_id)
+        suffix = '.gz' if gz else ''
+        return self.client.get(
+            f'/feeds/{merchant_id}/supplemental.tsv{suffix}',
+            query_string={'token': token},
+            headers=headers or {}
+        )
+
+    def test_feed_url_is_signed(self):
+        with self.app.app_context():
+            url = supplemental_feed.feed_url('123')
+        self.assertTrue(url.startswith('http://feeds.example.com/feeds/123/supplemental.tsv?'))
+        self.assertIn(f"token={supplemental_feed.feed_token('123')}", url)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_feed_rows(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/tab-separated-values')
+        self.assertEqual(response.text.splitlines(), [
+            'id\ttitle\tgtin',
+            '1\tOrganic cotton t-shirt\t4006381333931',
+            '2\tTab separated\t',
+        ])
+
+    def test_compressed_feed(self):
+        response = self.get(gz=True)
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertEqual(gzip.decompress(response.data).decode('utf-8'), self.get().text)
+        self.assertNotEqual(response.get_etag()[0], self.get().get_etag()[0])
+
+    def test_unchanged_feed_is_not_sent_again(self):
+        first = self.get()
+        etag, _ = first.get_etag()
+        self.assertTrue(etag)
+        self.assertTrue(first.cache_control.no_cache)
+
+        response = self.get(headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.get_etag()[0], etag)
+
+        response = self.get(headers={'If-Modified-Since': first.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_feed_is_sent_again(self):
+        first = self.get()
+        etag, _ = first.get_etag()
+        self.store.set_overrides('123', [('online:en:US:3', {'brand': 'Acme'})])
+
+        response = self.get(headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        self.assertIn('3\t\t\tAcme', response.text.splitlines())
+
+    def test_stale_etag_wins_over_if_modified_since(self):
+        first = self.get()
+        self.store.clear('123')
+        response = self.get(headers={
+            'If-None-Match': f'"{first.get_etag()[0]}"',
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'id\n')
+
+    def test_merchant_without_overrides(self):
+        response = self.get('456')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'id\n')
+        self.assertNotIn('Last-Modified', response.headers)
+
+    def test_wrong_token(self):
+        self.assertEqual(self.get(token='').status_code, 404)
+        self.assertEqual(self.get(token=supplemental_feed.feed_token('456')).status_code, 404)
+        self.assertEqual(self.get(gz=True, token='0' * 64).status_code, 404)
+
+    def test_unset_secret(self):
+        token = supplemental_feed.feed_token('123')
+        with mock.patch.dict(os.environ, {supplemental_feed.TOKEN_SECRET_ENV: ''}):
+            self.assertIsNone(supplemental_feed.feed_token('123'))
+            with self.app.app_context():
+                self.assertIsNone(supplemental_feed.feed_url('123'))
+            self.assertEqual(self.get(token=token).status_code, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
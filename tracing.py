@@ -0,0 +1,356 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Requests faster than this are not logged (their spans still count towards /metrics)
+LOG_MIN_MS = float(os.environ.get('TRACE_LOG_MIN_MS', '0'))
+
+# Spans kept per logged trace; the rest are only counted
+MAX_SPANS = 500
+
+# If set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+METRICS_PATH = '/metrics'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Path segments that look like IDs are collapsed so request labels stay few
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-f]{16,}|[A-Za-z0-9_-]{32,})(?=/|$)')
+
+logger = logging.getLogger('feed_optimizer.trace')
+if not logger.handlers:
+    # One JSON object per line on stderr, independent of how the app configures logging
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_trace = contextvars.ContextVar('feed_optimizer_trace', default=None)
+
+
+class Histogram:
+    """Prometheus-style histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                label_text = _labels(self.label_names, labels)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+                lines.append(f'{self.name}_count{{{label_text}}} {count}')
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{{{_labels(self.label_names, labels)}}} {value}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+REQUEST_SECONDS = Histogram(
+    'feed_optimizer_http_request_seconds', 'Time spent serving HTTP requests.', ('method', 'path', 'status')
+)
+SPAN_SECONDS = Histogram('feed_optimizer_span_seconds', 'Duration of traced stages.', ('stage', 'name'))
+SPAN_ITEMS = Counter('feed_optimizer_span_items_total', 'Items processed by traced stages.', ('stage', 'name'))
+SPAN_BYTES = Counter('feed_optimizer_span_bytes_total', 'Response bytes received by traced stages.', ('stage', 'name'))
+SPAN_RETRIES = Counter('feed_optimizer_span_retries_total', 'Retries made by traced stages.', ('stage', 'name'))
+SPAN_ERRORS = Counter('feed_optimizer_span_errors_total', 'Traced stages that raised.', ('stage', 'name'))
+
+METRICS = [REQUEST_SECONDS, SPAN_SECONDS, SPAN_ITEMS, SPAN_BYTES, SPAN_RETRIES, SPAN_ERRORS]
+
+# Extra exposition lines from other modules (e.g. quota counters), called on every scrape
+collectors = []
+
+
+class Span:
+    """A timed stage; attributes set on it end up in the trace log."""
+
+    def __init__(self, stage, name, attributes):
+        self.stage = stage
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **increments):
+        for key, value in increments.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+
+class Trace:
+    """Spans recorded while handling one request or background job."""
+
+    def __init__(self, kind, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def record(self, span, started, duration, error):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        entry = {
+            'stage': span.stage,
+            'name': span.name,
+            'start_ms': round((started - self.started) * 1000, 2),
+            'duration_ms': round(duration * 1000, 2),
+        }
+        entry.update(span.attributes)
+        if error:
+            entry['error'] = error
+        self.spans.append(entry)
+
+    def log(self, **attributes):
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        if duration_ms < LOG_MIN_MS:
+            return
+        entry = {'trace_id': self.id, 'kind': self.kind, 'duration_ms': round(duration_ms, 2)}
+        entry.update(self.attributes)
+        entry.update(attributes)
+        entry['spans'] = self.spans
+        if self.dropped:
+            entry['spans_dropped'] = self.dropped
+        logger.info(json.dumps(entry, default=str))
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(kind, **attributes):
+    """Collects the spans of a unit of work (e.g. a background job) and logs them at the end."""
+    current = Trace(kind, **attributes)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current.log()
+
+
+@contextmanager
+def span(stage, name, **attributes):
+    """Times a block as a span of the current trace and in the /metrics histograms.
+
+    Known numeric attributes `items`, `bytes` and `retries` also feed the counters.
+    """
+    current = Span(stage, name, attributes)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except GeneratorExit:
+        # A consumer stopping early is not an error
+        raise
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        labels = (stage, name)
+        SPAN_SECONDS.observe(labels, duration)
+        for counter, key in ((SPAN_ITEMS, 'items'), (SPAN_BYTES, 'bytes'), (SPAN_RETRIES, 'retries')):
+            if current.attributes.get(key):
+                counter.inc(labels, current.attributes[key])
+        if error:
+            SPAN_ERRORS.inc(labels)
+        active = _current_trace.get()
+        if active is not None:
+            active.record(current, started, duration, error)
+
+
+def traced(stage, name=None, items=None):
+    """Decorator that runs a function inside a span.
+
+    `items`, if given, is called with the result to set the span's item count.
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage, span_name) as current:
+                result = function(*args, **kwargs)
+                if items is not None:
+                    current.set(items=items(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def in_context(function):
+    """Wraps a callable so it runs with the caller's trace, e.g. in a pool thread."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collector in collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+def route_label(path):
+    return ID_SEGMENT.sub('/:id', path) or '/'
+
+
+class TracedIterator:
+    """Response iterator that keeps the request's trace active while the body is produced."""
+
+    def __init__(self, app_iter, trace, on_close):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.trace = trace
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = _current_trace.set(self.trace)
+        try:
+            return next(self.iterator)
+        finally:
+            _current_trace.reset(token)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.on_close()
+
+
+class TracingMiddleware:
+    """WSGI middleware that traces every request and serves /metrics."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == METRICS_PATH:
+            return self.metrics(environ, start_response)
+
+        current = Trace('request', method=environ.get('REQUEST_METHOD'), path=path)
+        token = _current_trace.set(current)
+        status = ['500']
+
+        def traced_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            duration = time.perf_counter() - current.started
+            REQUEST_SECONDS.observe((current.attributes['method'], route_label(path), status[0]), duration)
+            current.log(status=int(status[0]))
+
+        try:
+            app_iter = self.wsgi_app(environ, traced_start_response)
+        except BaseException:
+            finish()
+            raise
+        finally:
+            _current_trace.reset(token)
+        # Streamed bodies are still being produced here, so the trace ends when the server closes the iterator
+        return TracedIterator(app_iter, current, finish)
+
+    def metrics(self, environ, start_response):
+        if METRICS_TOKEN and environ.get('HTTP_AUTHORIZATION') != f'Bearer {METRICS_TOKEN}':
+            start_response('401 Unauthorized', [('Content-Type', 'text/plain')])
+            return [b'Unauthorized\n']
+        body = render_metrics().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+def init_app(app):
+    """Adds request tracing, template render spans and /metrics to a Flask app."""
+    from flask import before_render_template, template_rendered
+
+    render_started = threading.local()
+
+    def on_before_render(sender, template, context, **extra):
+        render_started.value = time.perf_counter()
+
+    def on_rendered(sender, template, context, **extra):
+        started = getattr(render_started, 'value', None)
+        if started is None:
+            return
+        render_started.value = None
+        duration = time.perf_counter() - started
+        name = template.name or 'string'
+        SPAN_SECONDS.observe(('render', name), duration)
+        active = _current_trace.get()
+        if active is not None:
+            active.record(Span('render', name, {}), started, duration, None)
+
+    before_render_template.connect(on_before_render, app, weak=False)
+    template_rendered.connect(on_rendered, app, weak=False)
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)